@@ -1,6 +1,10 @@
 //basetype
 typedef unsigned char uint8_t;
 typedef uint8_t bool_t;
+//locals only, they get as many registers as they need
+typedef unsigned short uint16_t;
+typedef unsigned long uint24_t;
+typedef unsigned long uint32_t;
 #define true    1
 #define false   0
 
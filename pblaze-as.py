@@ -356,6 +356,9 @@ regex_extract_char = re.compile(r'^\'' + r'([\\]?)' + r'(.)' + r'\'$')
 
 regex_label = re.compile(r'([a-zA-Z_][0-9a-zA-Z_]*):')
 
+#address byte of a label: label'upper or label'lower
+regex_label_byte = re.compile(r'^([a-zA-Z_][0-9a-zA-Z_]*)\'(upper|lower)$')
+
 #preprocess instruct
 lst_regex_preprocess = []
 lst_regex_preprocess.append(re.compile(r'\W*`(cond)' + r'[ \t]*' + \
@@ -386,6 +389,19 @@ map_escap_char = {
 
 regex_embedded_python = re.compile(r'\W*(;#!python)\W*(.*)$')
 
+#loop bound for --wcet: the loop the next instruction is in goes back to
+#its top at most N times each time it's entered
+regex_loop_bound = re.compile(r'^\s*;#!bound\s+(\w+)\s*$')
+
+#every instruction takes 2 clocks, on both cores
+CLOCKS_PER_INSTRUCTION = 2
+
+#return addresses the hardware call stack holds
+STACK_DEPTH = {'--kcpsm3': 31, '--kcpsm6': 30}
+
+#rom sizes (words) each core can address, the first is the default
+ROM_SIZES = {'--kcpsm3': [1024], '--kcpsm6': [1024, 2048, 4096]}
+
 #///////////////////////////////////////////////////////////////////////////////
 def file_get_contents(filename):
     fin = open(filename)
@@ -623,6 +639,9 @@ def _preprocess_normal(instructions, lst_inner_asm, symbols):
             if instructions[0] in ['jump', 'call', 'return',
                                    'returni', 'enable', 'disable','regbank']:
                 newinstructions.append(elem)
+            elif regex_label_byte.match(elem):
+                #resolved with the other labels
+                newinstructions.append(elem)
             elif is_register(elem):
                 newinstructions.append(elem)
             elif is_cdigit(elem):
@@ -659,6 +678,11 @@ def _format_asm(lines):
             lst_kcpsm3_asm.append([])
             continue
 
+        #loop bound stays a decimal comment
+        if instructions[0] == 'bound':
+            lst_kcpsm3_asm.append([';#!bound', '%d' % instructions[1]])
+            continue
+
         newinstructions = []
         newinstructions.append(instructions[0])
 
@@ -686,6 +710,8 @@ class PSMBlock(object):
         self.labels     = []
         self.address    = -1
         self.codes      = []
+        self.bounds     = []
+        self.fixed      = False
 
     def __len__(self):
         return len(self.codes)
@@ -704,6 +730,7 @@ def _convert_list_to_blocks(lines):
                 inst_block = PSMBlock()
                 lst_blocks.append(inst_block)
             inst_block.address = address
+            inst_block.fixed = True
         elif regex_label.match(lst_instructions[0]):
             res = regex_label.search(lst_instructions[0])
             label = res.groups()[0]
@@ -711,25 +738,116 @@ def _convert_list_to_blocks(lines):
                 inst_block = PSMBlock()
                 lst_blocks.append(inst_block)
             inst_block.labels.append(label)
+        elif lst_instructions[0] == 'bound':
+            #offset of the instruction it's about
+            inst_block.bounds.append((len(inst_block.codes), lst_instructions[1]))
         else:
             inst_block.codes.append(lst_instructions)
 
     return lst_blocks
 
-def _arrange_address_to_rom(lst_blocks):
-    #arrange codes to rom address
+def _falls_through(inst_block):
+    #can running off the end of the block carry on into the next one
+    if len(inst_block.codes) == 0:
+        return True
+    instruction = inst_block.codes[-1]
+    if instruction[0] == 'jump' and len(instruction) == 2:
+        return False
+    if instruction[0] == 'return' and len(instruction) == 1:
+        return False
+    return instruction[0] not in ['returni', 'jump@', 'load&return']
+
+def _convert_blocks_to_sections(lst_blocks):
+    #runs of blocks that have to stay together, a new one starts at an
+    #address directive or after a block that can't fall into it
+    lst_sections = []
+    for inst_block in lst_blocks:
+        if len(lst_sections) == 0 or inst_block.fixed or \
+                not _falls_through(lst_sections[-1][-1]):
+            lst_sections.append([inst_block])
+        else:
+            lst_sections[-1].append(inst_block)
+    return lst_sections
+
+def _arrange_address_to_rom(lst_blocks, size):
+    #arrange codes to rom address. Reset and address directives go where
+    #they're written, with a section that falls into one right in front
+    #of it. The sections nothing falls into or out of are packed into the
+    #gaps: biggest first, each into the gap it leaves least of, in source
+    #order inside a gap. Past the last address directive only makes the
+    #rom longer, so that's last, and whatever falls off the end of the
+    #source stays at the end. Code that runs off its end into the padding
+    #before the next address directive keeps that padding.
+    lst_sections = _convert_blocks_to_sections(lst_blocks)
+    section_len = lambda i: sum([len(inst_block) for inst_block in lst_sections[i]])
+
+    lst_movable = []
+    lst_gaps = []
+    falling = None
+    closed = False
     address = 0
-    for i in range(len(lst_blocks)):
-        inst_block = lst_blocks[i]
-        if inst_block.address != -1:
-            if inst_block.address < address:
-                raise PSMPPException('Can not arrange codes, you special addre too small')
+    for i in range(len(lst_sections)):
+        section = lst_sections[i]
+        if i > 0 and not section[0].fixed:
+            if _falls_through(section[-1]):
+                falling = i
             else:
-                address = inst_block.address
-        else:
+                lst_movable.append(i)
+            continue
+
+        if section[0].fixed:
+            start = section[0].address
+            if falling is not None:
+                start -= section_len(falling)
+            if start < address:
+                raise PSMPPException('Can not arrange codes, you special addre too small')
+            if start > address and not closed:
+                lst_gaps.append([address, start, []])
+            address = start
+        if falling is not None:
+            section = lst_sections[falling] + section
+            falling = None
+        for inst_block in section:
             inst_block.address = address
+            address += len(inst_block)
+        closed = _falls_through(section[-1])
+    if address < size and not closed or falling is not None:
+        lst_gaps.append([address, size, []])
+
+    for i in sorted(lst_movable, key=lambda i: -section_len(i)):
+        best = None
+        for gap in lst_gaps:
+            left = gap[1] - gap[0] - sum([section_len(j) for j in gap[2]])
+            if left < section_len(i) or gap[1] == size and best is not None:
+                continue
+            if best is None or left < best[0]:
+                best = (left, gap)
+        if best is None:
+            inst_block = lst_sections[i][0]
+            name = inst_block.labels[0] if len(inst_block.labels) else str(inst_block.codes[0])
+            msg = 'no room in %d words of rom for %s (%d words)' % (size, name, section_len(i))
+            raise PSMPPException(msg)
+        best[1][2].append(i)
 
-        address += len(inst_block)
+    for (address, end, lst_placed) in lst_gaps:
+        if falling is not None and end == size:
+            lst_placed.append(falling)
+        for i in sorted(lst_placed):
+            for inst_block in lst_sections[i]:
+                inst_block.address = address
+                address += len(inst_block)
+
+    lst_blocks.sort(key=lambda inst_block: inst_block.address)
+
+def _rom_padding(lst_blocks):
+    #(first, last) address of each run of padding between the blocks
+    lst_padding = []
+    address = 0
+    for inst_block in lst_blocks:
+        if inst_block.address > address:
+            lst_padding.append((address, inst_block.address - 1))
+        address = max(address, inst_block.address + len(inst_block))
+    return lst_padding
 
 def _convert_label_to_address(lst_blocks):
     #remember all label address
@@ -746,6 +864,20 @@ def _convert_label_to_address(lst_blocks):
     for i in range(len(lst_blocks)):
         inst_block = lst_blocks[i]
         for lst_instructions in inst_block.codes:
+            #label'upper is address[11:8], label'lower is address[7:0]
+            for j in range(1, len(lst_instructions)):
+                res = regex_label_byte.match(str(lst_instructions[j]))
+                if not res:
+                    continue
+                l = res.groups()[0]
+                if l not in map_label_address:
+                    msg = 'not found label "%s"!' % l
+                    raise PSMPPException(msg)
+                if res.groups()[1] == 'upper':
+                    lst_instructions[j] = (map_label_address[l] >> 8) & 0xF
+                else:
+                    lst_instructions[j] = map_label_address[l] & 0xFF
+
             if lst_instructions[0] in ['jump', 'call']:
                 l = lst_instructions[-1]
                 if l in map_label_address:
@@ -781,6 +913,468 @@ def _combine_blocks_to_list(lst_blocks):
 
     return nr_codes, lst_assembly
 
+#///////////////////////////////////////////////////////////////////////////////
+#timing, on the rom after labels are addresses
+def _rom_successors(rom, address):
+    #(addresses that can run next in the same function, leaves the
+    #function here, goes somewhere unknown)
+    instruction = rom[address]
+    opname = instruction[0]
+    following = []
+    if address + 1 < len(rom):
+        following = [address + 1]
+
+    if opname == 'jump':
+        if len(instruction) == 2:
+            return ([instruction[-1]], False, False)
+        return (following + [instruction[-1]], False, False)
+    elif opname in ['jump@', 'call@']:
+        return ([], False, True)
+    elif opname == 'return':
+        if len(instruction) == 1:
+            return ([], True, False)
+        return (following, True, False)
+    elif opname in ['returni', 'load&return']:
+        return ([], True, False)
+
+    #falling off the end of the rom
+    return (following, False, len(following) == 0)
+
+def _rom_region(rom, entry, stops=()):
+    #every address a function can run, not following calls, nor jumps
+    #into stops (code it leaves for, like a soft reset's jump to boot)
+    region = set()
+    todo = [entry]
+    while len(todo):
+        address = todo.pop()
+        if address in region or address >= len(rom) or \
+                address != entry and address in stops:
+            continue
+        region.add(address)
+        todo.extend(_rom_successors(rom, address)[0])
+    return region
+
+def _rom_loops(rom, entry, region):
+    #natural loops as (header, body), innermost first. None if one
+    #can be entered other than through its top.
+    succs = {}
+    preds = dict([(address, set()) for address in region])
+    for address in region:
+        succs[address] = [a for a in _rom_successors(rom, address)[0] if a in region]
+        for a in succs[address]:
+            preds[a].add(address)
+
+    #a jump back to something still on the depth-first stack closes a loop
+    tails = {}
+    state = {entry: 'open'}
+    stack = [(entry, iter(succs[entry]))]
+    while len(stack):
+        (address, it) = stack[-1]
+        for a in it:
+            if state.get(a) == 'open':
+                tails.setdefault(a, set()).add(address)
+            elif a not in state:
+                state[a] = 'open'
+                stack.append((a, iter(succs[a])))
+                break
+        else:
+            state[address] = 'done'
+            stack.pop()
+
+    loops = []
+    for header in tails:
+        body = set([header])
+        todo = list(tails[header])
+        while len(todo):
+            address = todo.pop()
+            if address not in body:
+                body.add(address)
+                todo.extend(preds[address])
+        for address in body:
+            if address != header and (address == entry or not preds[address] <= body):
+                return None
+        loops.append((header, body))
+    return sorted(loops, key=lambda loop: (len(loop[1]), loop[0]))
+
+def _dag_clocks(succs, start, ends, cost_min, cost_max, stop=False):
+    #(min, max) clocks of a path from start to any of ends, which count
+    #themselves, and with stop the path can't go on past one. succs
+    #can't have cycles. (inf, -inf) if there's no such path.
+    inf = float('inf')
+    order = []
+    seen = set([start])
+    stack = [(start, iter(succs[start]))]
+    while len(stack):
+        (node, it) = stack[-1]
+        for a in it:
+            if a not in seen:
+                seen.add(a)
+                stack.append((a, iter(succs[a])))
+                break
+        else:
+            order.append(node)
+            stack.pop()
+
+    lo = {}
+    hi = {}
+    for node in order:
+        if node in ends and stop:
+            (lo[node], hi[node]) = (cost_min[node], cost_max[node])
+            continue
+        least = min([0 if node in ends else inf] + [lo[a] for a in succs[node]])
+        most = max([0 if node in ends else -inf] + [hi[a] for a in succs[node]])
+        lo[node] = least + cost_min[node]
+        hi[node] = most + cost_max[node] if most != -inf else -inf
+    return (lo[start], hi[start])
+
+def _rom_timing(rom, entry, bounds, timing, notes):
+    #clocks from entry to leaving the function (its return included),
+    #calls as long as the callee takes, loops as many times round as
+    #their bound. Returns {'min', 'max', 'forever', 'windows'}: max is
+    #inf without a bound, forever is (min, max) of one pass of a loop
+    #that never ends and windows is the clocks from each disable
+    #interrupt to the next enable.
+    inf = float('inf')
+    if entry in timing:
+        if timing[entry] is None:
+            notes.append('0x%03X calls itself, no bound' % entry)
+            return {'min': 0, 'max': inf, 'forever': None, 'windows': {}}
+        return timing[entry]
+    timing[entry] = None
+
+    region = _rom_region(rom, entry)
+    succs = {}
+    leaves = {}
+    cost_min = {}
+    cost_max = {}
+    for address in sorted(region):
+        (following, leave, unknown) = _rom_successors(rom, address)
+        instruction = rom[address]
+        succs[address] = set([a for a in following if a in region])
+        leaves[address] = leave or unknown
+        cost_min[address] = CLOCKS_PER_INSTRUCTION
+        cost_max[address] = CLOCKS_PER_INSTRUCTION
+        if unknown:
+            notes.append('0x%03X goes somewhere unknown' % address)
+            cost_max[address] = inf
+        if instruction[0] == 'call':
+            callee = _rom_timing(rom, instruction[-1], bounds, timing, notes)
+            if len(instruction) == 2:
+                cost_min[address] += callee['min']
+            cost_max[address] += callee['max']
+
+    loops = _rom_loops(rom, entry, region)
+    if loops is None:
+        notes.append('0x%03X has a loop with more than one way in' % entry)
+        result = {'min': 0, 'max': inf, 'forever': None, 'windows': {}}
+        timing[entry] = result
+        return result
+
+    #the innermost loop gets the bound
+    limit = {}
+    for (address, bound) in bounds:
+        for (header, body) in loops:
+            if address in body:
+                limit.setdefault(header, bound)
+                break
+
+    #interrupts stay off until the next enable. Loops the disable is in
+    #are gone round once at most, others are as long as they take.
+    enables = set([a for a in region if rom[a][0] == 'enable'])
+    windows = {}
+    for address in sorted(region):
+        if rom[address][0] != 'disable':
+            continue
+        opened = [loop for loop in loops if address in loop[1]]
+        w_succs = dict([(a, set(succs[a])) for a in succs])
+        w_leaves = dict(leaves)
+        (w_min, w_max) = (dict(cost_min), dict(cost_max))
+        node = _rom_collapse([loop for loop in loops if loop not in opened],
+                             region, w_succs, w_leaves, w_min, w_max, limit, [])[0]
+        for (header, body) in opened:
+            for a in body:
+                if a in w_succs:
+                    w_succs[a].discard(header)
+        (x, clocks) = _dag_clocks(w_succs, node[address],
+                                  set([node[a] for a in enables]), w_min, w_max, True)
+        if clocks != -inf:
+            windows[address] = clocks
+
+    #each loop, innermost first, turns into one node at its header
+    (node, forever) = _rom_collapse(loops, region, succs, leaves,
+                                    cost_min, cost_max, limit, notes)
+
+    ends = set([a for a in succs if leaves[a] or a in forever])
+    (least, most) = _dag_clocks(succs, entry, ends, cost_min, cost_max)
+    if most == -inf:
+        most = inf
+
+    #an enable that's only there next time round: the whole loop
+    for address in sorted(region):
+        if rom[address][0] == 'disable' and address not in windows:
+            (x, clocks) = _dag_clocks(succs, node[address],
+                                      set([node[a] for a in enables]),
+                                      cost_min, cost_max, True)
+            if clocks == -inf:
+                notes.append('interrupts stay disabled after 0x%03X' % address)
+                clocks = inf
+            windows[address] = clocks
+
+    result = {'min': least, 'max': most, 'windows': windows, 'forever': None}
+    if len(forever):
+        result['forever'] = (min([forever[a][0] for a in forever]),
+                             max([forever[a][1] for a in forever]))
+    timing[entry] = result
+    return result
+
+def _rom_collapse(loops, region, succs, leaves, cost_min, cost_max, limit, notes):
+    #turn each loop, innermost first, into one node at its header that
+    #costs what going round it does. Changes succs, leaves and the costs,
+    #returns (node of each address, (min, max) of a pass of each loop
+    #that never ends).
+    inf = float('inf')
+    node = dict([(address, address) for address in region])
+    forever = {}
+    for (header, body) in loops:
+        nodes = set([node[address] for address in body])
+        inner = {}
+        for a in nodes:
+            inner[a] = set([b for b in succs[a] if b in nodes and b != header])
+        back = set([a for a in nodes if header in succs[a]])
+        out = set([a for a in nodes if leaves[a] or len(succs[a] - nodes)])
+        (pass_min, pass_max) = _dag_clocks(inner, header, back, cost_min, cost_max)
+        (out_min, out_max) = _dag_clocks(inner, header, out, cost_min, cost_max)
+        if len(out) == 0:
+            forever[header] = (pass_min, pass_max)
+            (cost_min[header], cost_max[header]) = (pass_min, pass_max)
+        elif header in limit:
+            cost_min[header] = out_min
+            cost_max[header] = limit[header] * pass_max + out_max
+        else:
+            notes.append('loop at 0x%03X has no bound' % header)
+            (cost_min[header], cost_max[header]) = (out_min, inf)
+        succs[header] = set()
+        for a in nodes:
+            succs[header] |= succs[a] - nodes
+        leaves[header] = any([leaves[a] for a in nodes])
+        for a in nodes - set([header]):
+            del succs[a]
+        for address in region:
+            if node[address] in nodes:
+                node[address] = header
+    return (node, forever)
+
+def _rom_roots(lst_blocks, rom):
+    #(where the core starts running: reset, then anything at an address
+    #of its own that nothing jumps, calls or falls into, which is the
+    #interrupt vector; the name of each labelled address)
+    names = {}
+    for inst_block in lst_blocks:
+        if len(inst_block.labels):
+            names.setdefault(inst_block.address, inst_block.labels[0])
+
+    referenced = set()
+    for instruction in rom:
+        if instruction[0] in ['jump', 'call']:
+            referenced.add(instruction[-1])
+    roots = [0]
+    for i in range(1, len(lst_blocks)):
+        inst_block = lst_blocks[i]
+        last = lst_blocks[i - 1]
+        if not inst_block.fixed or len(inst_block) == 0 or \
+                inst_block.address in referenced:
+            continue
+        if len(last) and last.address + len(last) == inst_block.address and \
+                inst_block.address in _rom_successors(rom, inst_block.address - 1)[0]:
+            continue
+        roots.append(inst_block.address)
+        #the vector is just a jump to the handler, go by its name
+        if inst_block.address not in names and rom[inst_block.address][0] == 'jump' and \
+                len(rom[inst_block.address]) == 2:
+            target = rom[inst_block.address][-1]
+            if target in names:
+                names[inst_block.address] = names[target]
+    return (roots, names)
+
+def _rom_interrupts(rom, roots):
+    #the roots that end in returni
+    return [entry for entry in roots if entry != 0 and \
+            any([rom[a][0] == 'returni' for a in _rom_region(rom, entry)])]
+
+def rom_timing(lst_blocks, rom):
+    #min/max clocks of every function reachable from reset and the
+    #interrupt vector, and the longest an interrupt has to wait
+    bounds = []
+    for inst_block in lst_blocks:
+        for (offset, bound) in inst_block.bounds:
+            bounds.append((inst_block.address + offset, bound))
+    (roots, names) = _rom_roots(lst_blocks, rom)
+
+    timing = {}
+    notes = []
+    functions = []
+    todo = list(roots)
+    while len(todo):
+        entry = todo.pop(0)
+        if entry in functions or entry >= len(rom):
+            continue
+        functions.append(entry)
+        _rom_timing(rom, entry, bounds, timing, notes)
+        for address in sorted(_rom_region(rom, entry)):
+            if rom[address][0] == 'call':
+                todo.append(rom[address][-1])
+
+    interrupts = _rom_interrupts(rom, roots)
+    mainline = [entry for entry in functions if entry not in interrupts]
+
+    report = {'clocks per instruction': CLOCKS_PER_INSTRUCTION,
+              'functions': [], 'interrupt latency': None, 'notes': []}
+    inf = float('inf')
+    clocks = lambda c: None if c == inf else c
+    for entry in functions:
+        result = timing[entry]
+        if result is None:
+            continue
+        forever = result['forever']
+        if forever is not None:
+            forever = [clocks(c) for c in forever]
+        report['functions'].append({
+            'name': names.get(entry, '0x%03X' % entry),
+            'address': entry,
+            'interrupt': entry in interrupts,
+            'min': clocks(result['min']),
+            'max': clocks(result['max']),
+            'forever': forever})
+
+    #a request waits out the longest stretch with interrupts off (a
+    #whole handler, or disable to enable in the mainline), the
+    #instruction in progress and the call to the vector
+    if len(interrupts):
+        waits = [timing[entry]['max'] for entry in interrupts]
+        for entry in mainline:
+            waits += list(timing[entry]['windows'].values())
+        report['interrupt latency'] = clocks(max(waits) + 2 * CLOCKS_PER_INSTRUCTION)
+
+    for note in notes:
+        if note not in report['notes']:
+            report['notes'].append(note)
+    return report
+
+def _rom_call_depth(rom, entry, names, depths, outer, notes):
+    #(return addresses on the stack at most while entry runs, the
+    #functions called on the way there). A jump to a root or back into
+    #a caller's code (outer) leaves the function, the stack under it
+    #is thrown away: that's a note, not a call.
+    if entry in depths:
+        if depths[entry] is None:
+            msg = '%s calls itself, the stack has no bound' % names.get(entry, '0x%03X' % entry)
+            raise PSMPPException(msg)
+        return depths[entry]
+    depths[entry] = None
+
+    name = lambda a: names.get(a, '0x%03X' % a)
+    region = _rom_region(rom, entry, outer)
+    for address in sorted(region):
+        for target in _rom_successors(rom, address)[0]:
+            note = '%s jumps to %s, out of its stack' % (name(entry), name(target))
+            if target not in region and target in outer and note not in notes:
+                notes.append(note)
+
+    deepest = (0, [])
+    for address in sorted(region):
+        instruction = rom[address]
+        if instruction[0] == 'call':
+            (depth, path) = _rom_call_depth(rom, instruction[-1], names, depths,
+                                            outer | region, notes)
+            if depth + 1 > deepest[0]:
+                deepest = (depth + 1, [instruction[-1]] + path)
+        elif instruction[0] == 'call@' and deepest[0] < 1:
+            #into a table of load&return
+            deepest = (1, ['call@ at 0x%03X' % address])
+    depths[entry] = deepest
+    return deepest
+
+def rom_stack(lst_blocks, rom):
+    #(deepest the call stack gets, the calls that get it there, notes):
+    #the deepest mainline path with the deepest interrupt on top of it,
+    #which is one deeper than its calls for the return address
+    (roots, names) = _rom_roots(lst_blocks, rom)
+    interrupts = _rom_interrupts(rom, roots)
+    name = lambda a: names.get(a, '0x%03X' % a) if type(a) == int else a
+    depths = {}
+    notes = []
+
+    mainline = (0, [])
+    for entry in roots:
+        if entry in interrupts:
+            continue
+        (depth, path) = _rom_call_depth(rom, entry, names, depths, set(roots), notes)
+        if depth > mainline[0] or len(mainline[1]) == 0:
+            mainline = (depth, [name(entry)] + [name(a) for a in path])
+
+    interrupt = (0, [])
+    for entry in interrupts:
+        (depth, path) = _rom_call_depth(rom, entry, names, depths, set(roots), notes)
+        if depth + 1 > interrupt[0]:
+            interrupt = (depth + 1, ['interrupt %s' % name(entry)] + \
+                         [name(a) for a in path])
+
+    return (mainline[0] + interrupt[0], mainline[1] + interrupt[1], notes)
+
+def _rom_entry(rom, entry, labels):
+    #[calls, jumps, returni] of the code from entry up to the labels (an
+    #address -> label map), for pblaze-ld to work out the stack with:
+    #what it calls, the labels it jumps or runs on to and the targets
+    #that aren't addresses in the rom, and can it end in returni
+    region = set()
+    calls = []
+    jumps = []
+    returni = False
+    todo = [entry]
+    while len(todo):
+        address = todo.pop()
+        if type(address) == int and address != entry and address in labels:
+            address = [labels[address]]
+        if type(address) != int:
+            if address[0] not in jumps:
+                jumps.append(address[0])
+            continue
+        if address in region or address >= len(rom):
+            continue
+        region.add(address)
+        instruction = rom[address]
+        if instruction[0] == 'call' and instruction[-1] not in calls:
+            calls.append(instruction[-1])
+        elif instruction[0] == 'call@' and None not in calls:
+            calls.append(None)
+        elif instruction[0] == 'returni':
+            returni = True
+        todo.extend(_rom_successors(rom, address)[0])
+    return [calls, jumps, returni]
+
+def format_timing(report):
+    text = []
+    text.append(';clocks, %d per instruction' % report['clocks per instruction'])
+    text.append(';%-22s %-7s %8s %8s' % ('function', 'address', 'min', 'max'))
+    clocks = lambda c: 'no bound' if c is None else '%d' % c
+    for function in report['functions']:
+        name = function['name']
+        if function['interrupt']:
+            name += ' (interrupt)'
+        line = '%-23s 0x%03X  %8s %8s' % (name, function['address'],
+                clocks(function['min']), clocks(function['max']))
+        if function['forever']:
+            line += '  then %s-%s per pass, forever' % \
+                    tuple([clocks(c) for c in function['forever']])
+        text.append(line)
+    if report['interrupt latency'] is not None:
+        text.append(';interrupt latency: %d clocks' % report['interrupt latency'])
+    elif len([f for f in report['functions'] if f['interrupt']]):
+        text.append(';interrupt latency: no bound')
+    for note in report['notes']:
+        text.append(';%s' % note)
+    return '\n'.join(text)
+
 def _parse_register_name(s):
     # (rX)
     if re.match(r'^\(s[0-9a-fA-F]+\)$', s):
@@ -895,6 +1489,22 @@ def _assembly_control(opcode, instruction, cfg):
 
     return objhex
 
+def _assembly_indirect(opcode, instruction, cfg):
+    # jump@ (sX, sY) / call@ (sX, sY): sX is address[11:8], sY address[7:0]
+    if len(instruction) != 3:
+        raise PSMPPException('%s needs a register pair (sX, sY)' % instruction[0])
+    sX = re.sub(r'[\(\)]', '', str(instruction[1]))
+    sY = re.sub(r'[\(\)]', '', str(instruction[2]))
+    objhex = opcode | (_parse_register_name(sX) << 8) | (_parse_register_name(sY) << 4)
+    return objhex
+
+def _assembly_load_return(opcode, instruction, cfg):
+    # load&return sX, kk: always immediate, so not _assembly_alu
+    if len(instruction) != 3 or type(instruction[2]) != int:
+        raise PSMPPException('load&return needs a register and a constant')
+    objhex = opcode | (_parse_register_name(instruction[1]) << 8) | (instruction[2] & 0xFF)
+    return objhex
+
 def _assembly_shift(opcode, instruction, cfg):
     objhex  = opcode | (_parse_register_name(instruction[1]) << 8)
     return objhex
@@ -990,7 +1600,10 @@ def _get_kcpsm6_assembler():
 
         'call'      :(0x20000, _assembly_control),
         'return'    :(0x21000, _assembly_control),
+        'load&return':(0x21000, _assembly_load_return),
         'jump'      :(0x22000, _assembly_control),
+        'call@'     :(0x24000, _assembly_indirect),
+        'jump@'     :(0x26000, _assembly_indirect),
         'disable'   :(0x28000, _assembly_control),
         'enable'    :(0x28001, _assembly_control),
         'returni'   :(0x29000, _assembly_control),
@@ -1001,8 +1614,8 @@ def _get_kcpsm6_assembler():
     return (kcpsm6_cond, kcpsm6_opcodes)
 
 def parse_commandline(argv):
-    s_config = 'ghi:o:36'
-    l_config = ['help', 'psm', 'hex', 'obj', 'mem']
+    s_config = 'ghi:o:36c'
+    l_config = ['help', 'psm', 'hex', 'obj', 'mem', 'wcet', 'rom=']
     try:  
         opts, args = getopt.getopt(argv[1:], s_config, l_config)
 
@@ -1026,7 +1639,27 @@ def parse_commandline(argv):
             map_config['--kcpsm3'] = True
             print('default kcpsm3 mode')
 
+        #check rom size, 1K/2K/4K or words
+        core = '--kcpsm6' if '--kcpsm6' in map_config else '--kcpsm3'
+        if '--rom' in map_config:
+            res = re.match(r'^(\d+)([kK]?)$', map_config['--rom'])
+            rom = None
+            if res:
+                rom = int(res.groups()[0]) * (1024 if res.groups()[1] else 1)
+            if rom not in ROM_SIZES[core]:
+                msg = 'rom of %s words, %s has %s' % (map_config['--rom'], core[2:],
+                        ', '.join(['%d' % n for n in ROM_SIZES[core]]))
+                raise PSMPPException(msg)
+            map_config['--rom'] = rom
+        else:
+            map_config['--rom'] = ROM_SIZES[core][0]
+
         #check output mode
+        if '-c' in map_config:
+            if '--psm' in map_config or '--hex' in map_config or \
+                    '--mem' in map_config or '--wcet' in map_config:
+                raise PSMPPException('-c only makes a relocatable .obj')
+            map_config['--obj'] = True
         if not ('--psm' in map_config or '--hex' in map_config or '--obj' in map_config):
             map_config['--obj'] = True
             print('default obj output mode')
@@ -1083,6 +1716,12 @@ def preprocess(lines, symbols):
                 _preprocess_embedded(res, symbols)
                 continue
 
+            #check loop bound
+            res = regex_loop_bound.match(line)
+            if res:
+                lst_inner_asm.append(['bound', _convert_digit(res.groups()[0])])
+                continue
+
             #check comment, remove comments
             line = re.sub(r';(.*)$', '', line)
 
@@ -1131,12 +1770,7 @@ def preprocess(lines, symbols):
 
     return lst_inner_asm
 
-def dump_hex(lines, cfg):
-    lst_blocks = _convert_list_to_blocks(lines)
-    _arrange_address_to_rom(lst_blocks)
-    map_label_address = _convert_label_to_address(lst_blocks)
-    nr_codes, lst_assembly = _combine_blocks_to_list(lst_blocks)
-
+def _assemble(lst_assembly, cfg):
     if '--kcpsm6' in cfg:
         cond_lut, lut = _get_kcpsm6_assembler()
     else:
@@ -1160,7 +1794,151 @@ def dump_hex(lines, cfg):
             print('Error:', instruction)
             raise
 
-    print('codes %d of 1024 rom (%d%%)'  % (nr_codes, (nr_codes * 100 / 1024)))
+    return text
+
+def dump_relocatable(lines, cfg):
+    '''
+    return list of sections for pblaze-ld to place and link:
+    [
+        {'address' : fixed address or None,
+         'falls'   : runs off its end into the next section,
+         'codes'   : [objhex, ...], labels assembled as 0,
+         'labels'  : {label : offset, ...},
+         'relocs'  : [[offset, 'address'|'upper'|'lower', label], ...],
+         'stack'   : [[offset, calls, jumps, returni], ...]},
+        ...
+    ]
+    'stack' has the start and each label: the labels (or addresses) the
+    code from there up to the next label calls, null for call@, the
+    labels it jumps or runs on to, and can it end in returni.
+    '''
+    lst_blocks = _convert_list_to_blocks(lines)
+    lst_sections = _convert_blocks_to_sections(lst_blocks)
+    lst_fixed = [section[0].address if section[0].fixed else None \
+                 for section in lst_sections]
+
+    #labels are offsets in their section
+    map_label_section = {}
+    lst_base = []
+    base = 0
+    for i in range(len(lst_sections)):
+        offset = 0
+        for inst_block in lst_sections[i]:
+            inst_block.address = offset
+            for l in inst_block.labels:
+                if l in map_label_section:
+                    msg = 'duplicate label "%s"!' % l
+                    raise PSMPPException(msg)
+                map_label_section[l] = (i, offset)
+            offset += len(inst_block)
+        lst_base.append(base)
+        base += offset
+
+    #the sections one after another, jumps inside the object go to
+    #addresses in it and the rest are [target], calls keep their label
+    lst_rom = []
+    for section in lst_sections:
+        for inst_block in section:
+            for lst_instructions in inst_block.codes:
+                instruction = list(lst_instructions)
+                if instruction[0] in ['jump', 'call'] and len(instruction) > 1:
+                    l = instruction[-1]
+                    if l in map_label_section:
+                        (j, offset) = map_label_section[l]
+                        target = lst_base[j] + offset
+                    else:
+                        try:
+                            target = [_convert_digit(l)]
+                        except:
+                            target = [l]
+                    if instruction[0] == 'jump':
+                        instruction[-1] = target
+                    elif type(target) != int:
+                        instruction[-1] = target[0]
+                    else:
+                        instruction[-1] = l
+                lst_rom.append(instruction)
+
+    map_entry_label = {}
+    for (l, (j, offset)) in sorted(map_label_section.items()):
+        map_entry_label.setdefault(lst_base[j] + offset, l)
+
+    lst_result = []
+    lst_externs = []
+    for i in range(len(lst_sections)):
+        section = lst_sections[i]
+        lst_relocs = []
+        lst_assembly = []
+        for inst_block in section:
+            for k in range(len(inst_block.codes)):
+                lst_instructions = inst_block.codes[k]
+                offset = inst_block.address + k
+                for j in range(1, len(lst_instructions)):
+                    res = regex_label_byte.match(str(lst_instructions[j]))
+                    if res:
+                        lst_relocs.append([offset, res.groups()[1], res.groups()[0]])
+                        lst_instructions[j] = 0
+
+                if lst_instructions[0] in ['jump', 'call']:
+                    l = lst_instructions[-1]
+                    try:
+                        lst_instructions[-1] = _convert_digit(l)
+                    except:
+                        lst_relocs.append([offset, 'address', l])
+                        lst_instructions[-1] = 0
+                lst_assembly.append(lst_instructions)
+
+        for (offset, kind, l) in lst_relocs:
+            if l not in map_label_section and l not in lst_externs:
+                lst_externs.append(l)
+
+        map_section = {}
+        map_section['address'] = lst_fixed[i]
+        map_section['falls']   = _falls_through(section[-1])
+        map_section['codes']   = _assemble(lst_assembly, cfg)
+        map_section['labels']  = dict([(l, offset) for (l, (j, offset)) \
+                                       in map_label_section.items() if j == i])
+        map_section['relocs']  = lst_relocs
+        lst_offsets = sorted(set([0] + list(map_section['labels'].values())))
+        map_section['stack']   = [[offset] + _rom_entry(lst_rom, lst_base[i] + offset, map_entry_label) \
+                                  for offset in lst_offsets]
+        lst_result.append(map_section)
+
+    print('sections %d, codes %d, labels from other objects: %s' % (len(lst_result),
+        sum([len(section['codes']) for section in lst_result]),
+        ', '.join(lst_externs) or 'none'))
+
+    return lst_result
+
+def dump_hex(lines, cfg):
+    lst_blocks = _convert_list_to_blocks(lines)
+    _arrange_address_to_rom(lst_blocks, cfg['--rom'])
+    map_label_address = _convert_label_to_address(lst_blocks)
+    nr_codes, lst_assembly = _combine_blocks_to_list(lst_blocks)
+    if len(lst_assembly) > cfg['--rom']:
+        msg = 'codes end at 0x%03X, past the %d words of rom' % \
+                (len(lst_assembly) - 1, cfg['--rom'])
+        raise PSMPPException(msg)
+
+    lst_padding = _rom_padding(lst_blocks)
+    print('padding %d words%s' % (len(lst_assembly) - nr_codes,
+        ''.join([' 0x%03X-0x%03X' % (first, last) for (first, last) in lst_padding])))
+
+    #overflowing the hardware stack doesn't stop the core, so stop here
+    (depth, path, notes) = rom_stack(lst_blocks, lst_assembly)
+    limit = STACK_DEPTH['--kcpsm6' if '--kcpsm6' in cfg else '--kcpsm3']
+    if depth > limit:
+        msg = 'call stack overflows, %d of %d: %s' % (depth, limit, ' > '.join(path))
+        raise PSMPPException(msg)
+    print('stack %d of %d (%s)' % (depth, limit, ' > '.join(path)))
+    for note in notes:
+        print('stack: %s' % note)
+    if '--wcet' in cfg:
+        cfg['timing'] = rom_timing(lst_blocks, lst_assembly)
+
+    text = _assemble(lst_assembly, cfg)
+
+    print('codes %d of %d rom (%d%%)'  % (nr_codes, cfg['--rom'], (nr_codes * 100 / cfg['--rom'])))
 
     return (map_label_address, text)
 
@@ -1198,10 +1976,10 @@ def dump_asm(lines):
         text.append('%s%-8s %s' % (indent, lst_instructions[0], ops))
     return '\n'.join(text)
 
-def dump_ximem(rom):
+def dump_ximem(rom, size):
     n = len(rom)
     erom = copy.deepcopy(rom)
-    for i in range(n,1024):
+    for i in range(n,size):
         erom.append(0)
 
     n = len(erom)
@@ -1252,7 +2030,28 @@ def pblaze_as(argv):
             print('wrote %d bytes to "%s"' % \
                     (len(text), map_config['-o']))
 
-    if '--hex' in map_config or '--obj' in map_config or '--mem' in map_config:
+    if '-c' in map_config:
+        try:
+            lst_sections = dump_relocatable(lines, map_config)
+        except PSMPPException as e:
+            print(e.msg)
+            sys.exit(-1)
+
+        map_object = {}
+        map_object['ctime']     = map_config['--st_ctime']
+        map_object['mtime']     = map_config['--st_mtime']
+        map_object['core']      = 'kcpsm6' if '--kcpsm6' in map_config else 'kcpsm3'
+        map_object['rom']       = map_config['--rom']
+        map_object['sections']  = lst_sections
+        map_object['pblaze-cc'] = lst_info
+
+        text_json = json.dumps(map_object, sort_keys=True, indent=4)
+        file_put_contents(map_config['-o'], text_json)
+        print('wrote %d bytes to "%s"' % \
+            (len(text_json), map_config['-o']))
+        lst_labels = []
+
+    elif '--hex' in map_config or '--obj' in map_config or '--mem' in map_config:
         try:
             (map_label_address, lst_hexvalues) = dump_hex(lines, map_config)
         except PSMPPException as e:
@@ -1282,13 +2081,27 @@ def pblaze_as(argv):
                         (len(hexstring), map_config['-o']))
 
         if '--mem' in map_config:
-            l = dump_ximem(lst_hexvalues)
+            l = dump_ximem(lst_hexvalues, map_config['--rom'])
             d = '\n'.join(l)
             fn = map_config['--noext'] + '.mem'
             file_put_contents(fn, d)
             print('wrote %d bytes to "%s"' % \
                     (len(d), fn))
 
+        if '--wcet' in map_config:
+            text = format_timing(map_config['timing'])
+            print(text)
+            fn = map_config['--noext'] + '.wcet'
+            file_put_contents(fn, text)
+            print('wrote %d bytes to "%s"' % \
+                    (len(text), fn))
+
+            text_json = json.dumps(map_config['timing'], sort_keys=True, indent=4)
+            fn = map_config['--noext'] + '.wcet.json'
+            file_put_contents(fn, text_json)
+            print('wrote %d bytes to "%s"' % \
+                    (len(text_json), fn))
+
         if '--obj' in map_config:
             map_object = {}
             map_object['ctime']     = map_config['--st_ctime']
@@ -1296,6 +2109,8 @@ def pblaze_as(argv):
             map_object['labels']    = map_label_address
             map_object['object']    = lst_hexvalues
             map_object['object-hex']= lst_hexstring
+            map_object['core']      = 'kcpsm6' if '--kcpsm6' in map_config else 'kcpsm3'
+            map_object['rom']       = map_config['--rom']
             map_object['pblaze-cc'] = lst_info
 
             text_json = json.dumps(map_object, sort_keys=True, indent=4)
@@ -1350,12 +2165,16 @@ def print_usage(more=False):
     print("  -h           print this help")
     print("  -3           kcpsm3 mode")
     print("  -6           kcpsm6 mode")
+    print("  -c           Output a relocatable object for pblaze-ld to link")
     print("  -i <file>    Select input <file>")
     print("  -o <file>    Place output into <file>, '-' is stdout")
     print("      --psm    Output kcpsm3 assembly")
     print("      --obj    Output kcpsm3 assembly object")
     print("      --hex    Output kcpsm3 binary (hex)")
     print("      --mem    Output kcpsm3 binary (mem)")
+    print("      --rom <size>  Words of rom, 1K (default), or 2K/4K on kcpsm6")
+    print("      --wcet   Min/max clocks of each function and interrupt latency")
+    print("               (<file>.wcet, and <file>.wcet.json)")
     if not more:
         return
     
@@ -1372,6 +2191,14 @@ def print_usage(more=False):
     print("        `cond (ra == rb),   NULL, L_FALSE")
     print("    3. embedded python code, modify macro value")
     print("        ;#!python ...               -   embedded python code")
+    print("    4. label address (kcpsm6 jump tables)")
+    print("        label'upper                 -   address[11:8] of label")
+    print("        label'lower                 -   address[7:0] of label")
+    print("        jump@ (sX, sY), call@ (sX, sY), load&return sX, kk")
+    print("    5. loop bound (--wcet)")
+    print("        ;#!bound N                  -   the loop the next instruction")
+    print("                                        is in goes back to its top")
+    print("                                        at most N times")
 
 
 if __name__ == '__main__':
@@ -38,6 +38,7 @@ import types
 import subprocess
 import getopt
 from io import StringIO
+from contextlib import redirect_stdout
 
 BASEADDR_INTC_CLEAR = 0xF0
 
@@ -52,20 +53,92 @@ IDX_CODE    = 3
 
 labels = []
 
+#const tables, name : list of byte values
+const_tables = {}
+
+#bare function attributes, name : ['always_inline', 'noreturn', ...]
+function_hints = {}
+
 vivado_boot_fix = False
 super_verbose = False
 
+#kcpsm3 or kcpsm6, some flag behaviour differs
+target = 'kcpsm3'
+
+#registers the compiler may use for temporaries (sF is reserved, see kcpsm6.h)
+scratch_registers = ['sF']
+
+#runtime multiply/divide routines: unrolled (fast) or looped (small),
+#None leaves it to the -O level
+muldiv_unrolled = None
+
+#-O level: '0' none, '1' default, '2' speed, 's' size
+opt_level = '1'
+
+#interrupt handlers keep the registers they write from the mainline
+#(register bank B or saved to scratchpad), except shared() ones
+isr_save = True
+
+#a register operand: sX, or the virtual register vN of a local variable
+#until allocate_registers() finds it a home
+REGISTER = r'(?:s[0-9A-F]|v[0-9]+)'
+
+#local variable types, name : number of registers
+LOCAL_TYPES = {'uint8_t': 1, 'bool_t': 1, 'uint16_t': 2, 'uint24_t': 3,
+               'uint32_t': 4}
+
+#virtual registers of local variables, vN : (function, name, byte, bytes)
+local_registers = {}
+
+#scratchpad bytes: 64 on kcpsm3, 64, 128 or 256 on kcpsm6
+scratchpad_size = 64
+
+#__scratch variables, identifier : (function or None, name, bytes)
+scratch_variables = {}
+
+#scratchpad allocations, name : (address, bytes, function, kind),
+#function None is there for the whole program
+scratchpad_used = {}
+
 class MetaInfo(object):
     def __init__(self):
         self.level = 0
         self.lineno = 0
         self.lines = []
         self.filename = ''
+        self.function = None
+        #local variables in scope, name : [(level, registers), ...]
+        self.locals = {}
 
 class ParseException(BaseException):
     def __init__(self, msg):
         self.msg = msg
 
+class ScratchAddress(object):
+    #address of a __scratch variable, plus an offset. It's a number
+    #once allocate_scratchpad() has found it a place.
+    def __init__(self, ident, offset=0):
+        self.ident = ident
+        self.offset = offset
+
+    def __add__(self, other):
+        if type(other) != int:
+            return NotImplemented
+        return ScratchAddress(self.ident, self.offset + other)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        if type(other) != int:
+            return NotImplemented
+        return ScratchAddress(self.ident, self.offset - other)
+
+    def __repr__(self):
+        name = scratch_variables[self.ident][1]
+        if self.offset:
+            return '%s%+d' % (name, self.offset)
+        return name
+
 def file_get_contents(fn):
     f = open(fn, "r")
     d = f.read()
@@ -118,17 +191,17 @@ def _parse_param(param):
         print(param)
     if len(param) == 0:
         return param
-    elif re.match(r'[Z|C]', param):
+    elif re.match(r'^[ZC]$', param):
         return param
-    elif re.match(r'^s[0-9A-F]$', param):
+    elif re.match(r'^%s$' % REGISTER, param):
         return param
-    elif re.match(r'^[&]s[0-9A-F]$', param):
+    elif re.match(r'^[&]%s$' % REGISTER, param):
         return param[1:]
-    elif re.match(r'^(s[0-9A-F].)*s[0-9A-F]$',param):
+    elif re.match(r'^(%s.)*%s$' % (REGISTER, REGISTER), param):
         if super_verbose == True:
             print("match multi-register")
         return param
-    elif re.match(r'^[&](s[0-9A-F].)*s[0-9A-F]$',param):
+    elif re.match(r'^[&](%s.)*%s$' % (REGISTER, REGISTER), param):
         if super_verbose == True:
             print("match multi-register")
         return param[1:]
@@ -136,7 +209,9 @@ def _parse_param(param):
         try:
             res = {'val':0}
             text = 'val = %s' % param
-            exec(text, {}, res)
+            names = dict([(ident, ScratchAddress(ident))
+                          for ident in scratch_variables])
+            exec(text, names, res)
             return res['val']
         except SyntaxError as e:
             traceback.print_exc()
@@ -226,6 +301,50 @@ def parse_do(info, line):
 
     return False
 
+def _parse_statements(text):
+    #'s0 = 0, s1++' -> the assign code of each, for the parts of a for
+    codes = []
+    for part in text.split(','):
+        if not part.strip():
+            continue
+        scratch = MetaInfo()
+        if not parse_assign(scratch, part.strip()):
+            msg = 'Unknown statement "%s"' % part.strip()
+            raise ParseException(msg)
+        codes.append(scratch.lines[-1][IDX_CODE])
+    return codes
+
+def parse_for(info, line):
+    #fmt: for (s0 = 10; s0 != 0; s0--), 'for (...);' has no body
+    res = re.match(r'for\s*\(([^;]*);([^;]*);(.*?)\)\s*(;?)$', line)
+    if not res:
+        return False
+
+    (init, cond, step, empty) = [x.strip() for x in res.groups()]
+    #'for (uint8_t i = 0; ...' declares i for the loop body
+    res = re.match(r'(%s) (.+)$' % '|'.join(LOCAL_TYPES), init)
+    if res:
+        codes = []
+        for text in res.groups()[1].split(','):
+            codes.append(_declare_local(info, res.groups()[0], text,
+                                        info.level + 2))
+        init = [code for code in codes if code is not None]
+        cond = _rename_locals(info, cond)
+        step = _rename_locals(info, step)
+    else:
+        init = _parse_statements(init)
+    if cond:
+        cond = _parse_compound(cond) or _parse_comparison(cond)
+    else:
+        cond = None
+    #label prefix is unique per file and for
+    prefix = 'L_%s_for%d_' % (hashlib.md5(info.filename.encode()).hexdigest(),
+                              len([l for l in info.lines if l[IDX_TYPE] == 'for']))
+    info.lines.append([info.level, info.lineno, 'for',
+        [init, cond, _parse_statements(step), prefix,
+         empty == ';']])
+    return True
+
 def parse_break(info, line):
     line = re.sub(r'[; ]+$', '', line)
     
@@ -235,6 +354,159 @@ def parse_break(info, line):
 
     return False
 
+def _parse_const_value(param):
+    #like _parse_param, but ' ' is a perfectly good byte
+    param = param.strip()
+    if re.match(r"^'(\\?.)'$", param):
+        res = {'val':0}
+        exec('val = %s' % param, {}, res)
+        return ord(res['val'])
+    return _parse_param(param)
+
+def parse_const(info, line):
+    res = re.match(r'(?:static )?const (\w+) (\w+)\s*\[\s*([^\]]*)\]\s*=\s*(.+?)\s*;$', line)
+    if not res:
+        return False
+
+    (ctype, name, size, init) = res.groups()
+    if ctype not in ['uint8_t', 'int8_t', 'char', 'bool_t']:
+        msg = 'const tables are bytes only "%d:%s"' % (info.lineno, line)
+        raise ParseException(msg)
+    if name in const_tables:
+        msg = 'Duplicate const table "%d:%s"' % (info.lineno, name)
+        raise ParseException(msg)
+
+    if init[0] == '"':
+        #string, with the terminating 0 like C
+        res = {'val':0}
+        exec('val = %s' % init, {}, res)
+        values = [ord(c) for c in res['val']] + [0]
+    elif init[0] == '{' and init[-1] == '}':
+        values = [_parse_const_value(v) for v in init[1:-1].split(',')
+                  if len(v.strip())]
+    else:
+        msg = 'Unknown const initializer "%d:%s"' % (info.lineno, line)
+        raise ParseException(msg)
+
+    if len(size.strip()):
+        size = _parse_param(size)
+        if len(values) > size:
+            msg = 'Too many initializers "%d:%s"' % (info.lineno, line)
+            raise ParseException(msg)
+        values += [0] * (size - len(values))
+
+    for v in values:
+        if type(v) != int:
+            msg = 'const tables need constant values "%d:%s"' % (info.lineno, line)
+            raise ParseException(msg)
+    if len(values) == 0 or len(values) > 256:
+        msg = 'const tables are 1 to 256 bytes "%d:%s"' % (info.lineno, line)
+        raise ParseException(msg)
+
+    const_tables[name] = [v & 0xFF for v in values]
+    return True
+
+def parse_switch(info, line):
+    line = re.sub(r'[; ]+$', '', line)
+
+    res = re.match(r'switch\s*\((.+)\)$', line)
+    if res:
+        #label prefix is unique per file and switch
+        prefix = 'L_%s_sw%d_' % (hashlib.md5(info.filename.encode()).hexdigest(),
+                                 len([l for l in info.lines if l[IDX_TYPE] == 'switch']))
+        info.lines.append([info.level, info.lineno, 'switch',
+            [_parse_param(res.groups()[0]), prefix]])
+        return True
+
+    res = re.match(r'case (.+?)\s*:$', line)
+    if res:
+        value = _parse_param(res.groups()[0])
+        if type(value) == str and len(value) == 1:
+            value = ord(value)
+        if type(value) != int or value < 0 or value > 255:
+            msg = 'case needs a constant from 0 to 255 "%d:%s"' % (info.lineno, line)
+            raise ParseException(msg)
+        info.lines.append([info.level, info.lineno, 'case', [value]])
+        return True
+
+    if re.match(r'default\s*:$', line):
+        info.lines.append([info.level, info.lineno, 'default', []])
+        return True
+
+    return False
+
+def _strip_parens(text):
+    #'((a == b))' -> 'a == b', but '(a) & (b)' stays as it is
+    text = text.strip()
+    while text.startswith('(') and text.endswith(')'):
+        depth = 0
+        for i in range(len(text)):
+            if text[i] == '(':
+                depth += 1
+            elif text[i] == ')':
+                depth -= 1
+            if depth == 0 and i != len(text) - 1:
+                return text
+        text = text[1:-1].strip()
+    return text
+
+def _split_condition(text, op):
+    #split text at op, but not inside parentheses
+    parts = []
+    depth = 0
+    start = 0
+    i = 0
+    while i < len(text):
+        if text[i] == '(':
+            depth += 1
+        elif text[i] == ')':
+            depth -= 1
+        elif depth == 0 and text.startswith(op, i):
+            parts.append(text[start:i].strip())
+            i += len(op)
+            start = i
+            continue
+        i += 1
+    parts.append(text[start:].strip())
+    return parts
+
+def _parse_comparison(text):
+    #a single comparison, in whatever form parse_condition takes
+    scratch = MetaInfo()
+    if not parse_condition(scratch, 'if (%s)' % text):
+        msg = 'Unknown condition "%s"' % text
+        raise ParseException(msg)
+    return scratch.lines[-1][IDX_CODE]
+
+def _parse_operand(text):
+    #one side of a && or ||: '(a == b)', '!(a == b)' or another compound
+    text = _strip_parens(text)
+    node = _parse_compound(text)
+    if node:
+        return node
+    res = re.match(r'!\s*(\(.*\))$', text)
+    if res and _strip_parens(res.groups()[0]) != res.groups()[0]:
+        return _invert_condition(_parse_operand(res.groups()[0]))
+    return _parse_comparison(text)
+
+def _parse_compound(text):
+    #'a && (b || !(c))' -> ['&&', a, ['||', b, !c]], with any '!' pushed
+    #down into the comparisons. None if it's just one comparison.
+    text = _strip_parens(text)
+    for op in ['||', '&&']:
+        parts = _split_condition(text, op)
+        if len(parts) > 1:
+            node = _parse_operand(parts[0])
+            for part in parts[1:]:
+                node = [op, node, _parse_operand(part)]
+            return node
+    res = re.match(r'!\s*(\(.*\))$', text)
+    if res:
+        node = _parse_compound(res.groups()[0])
+        if node:
+            return _invert_condition(node)
+    return None
+
 def parse_condition(info, line):
     end_while = False
     #check if end with ';'
@@ -255,6 +527,44 @@ def parse_condition(info, line):
         info.lines.append([info.level, info.lineno, 'else', []])
         return True
 
+    #fmt: if (likely(a == b)), if (unlikely(a)), if (__builtin_expect(a, 0))
+    #the condition is parsed as usual, an 'expect' line in front of it
+    #tells convert_expect which way it usually goes. A do/while already
+    #tests at the bottom, and the line in front would hide its '}'
+    res = re.match(r'(if|else if|while)\s*\((likely|unlikely)\s*\((.+)\)\)$', line)
+    res2 = re.match(r'(if|else if|while)\s*\(__builtin_expect\s*\((.+), ?(\w+)\)\)$', line)
+    if res or res2:
+        if res:
+            cond = res.groups()[0]
+            text = res.groups()[2]
+            expected = res.groups()[1] == 'likely'
+        else:
+            cond = res2.groups()[0]
+            text = res2.groups()[1]
+            expected = _parse_param(res2.groups()[2]) != 0
+        #likely(x) is usually a macro for __builtin_expect(!!(x), 1)
+        text = _strip_parens(re.sub(r'^!\s*!', '', text.strip()))
+        newline = '%s (%s)' % (cond, text)
+        if end_while:
+            newline += ';'
+        if not parse_condition(info, newline):
+            return False
+        if not end_while:
+            info.lines.insert(len(info.lines) - 1,
+                              [info.level, info.lineno, 'expect', [expected]])
+        return True
+
+    #fmt: if (a == b && (c < d || !e))
+    res = re.match(r'(if|else if|while)\s*\((.+)\)$', line)
+    if res and re.search(r'&&|\|\|', line):
+        node = _parse_compound(res.groups()[1])
+        if node:
+            cond = res.groups()[0]
+            if cond == 'while' and end_while:
+                cond = 'dowhile'
+            info.lines.append([info.level, info.lineno, cond, node])
+            return True
+
     #let's try recognizing if (!( blah ))    
     res = re.match(r'(if|else if|while)\s*\(!(\(.*\))\)', line)
     if res:
@@ -403,7 +713,7 @@ def parse_condition(info, line):
         return True
 
     #fmt: if (1)
-    res = re.match(r'(if|else if|while)\s*\((s[0-9a-fA-F]|\d+|[ZC])\)', line)
+    res = re.match(r'(if|else if|while)\s*\((s[0-9a-fA-F]|v[0-9]+|\d+|[ZC])\)', line)
     if res:
         cond    = res.groups()[0]
         param0  = res.groups()[1]
@@ -430,7 +740,7 @@ def parse_assign(info, line):
     line = re.sub(r'[; ]+$', '', line)
 
     #fmt: a += b
-    res = re.match(r'(.+) (=|\+=|-=|<<=|>>=|&=|\|=|\^=) (.+)', line)
+    res = re.match(r'(.+) (=|\+=|-=|\*=|/=|%=|<<=|>>=|&=|\|=|\^=) (.+)', line)
     if res:
         param0  = res.groups()[0]
         assign  = res.groups()[1]
@@ -452,6 +762,121 @@ def parse_assign(info, line):
 
     return False 
 
+def _scope_add(info, name, level, text):
+    #from here to the end of the block, name means text
+    if re.match(r'^(%s|v[0-9]+|[ZC])$' % REGISTER, name):
+        msg = 'Local variable named like a register "%d:%s"' % (info.lineno, name)
+        raise ParseException(msg)
+    scopes = info.locals.setdefault(name, [])
+    if len(scopes) and scopes[-1][0] == level:
+        msg = 'Local variable declared twice "%d:%s"' % (info.lineno, name)
+        raise ParseException(msg)
+    scopes.append((level, text))
+
+def _declare_local(info, kind, text, level):
+    #'x = 5' or 'x' of type kind, visible until the block around level
+    #closes. Returns the initializer, if there is one.
+    res = re.match(r'^(\w+)(?:\s*=\s*(.+))?$', text.strip())
+    if not res:
+        msg = 'Bad local variable "%d:%s"' % (info.lineno, text)
+        raise ParseException(msg)
+    (name, value) = res.groups()
+    if info.function is None or info.level == 0:
+        msg = 'Local variable outside a function "%d:%s"' % (info.lineno, text)
+        raise ParseException(msg)
+    regs = []
+    for i in range(LOCAL_TYPES[kind]):
+        reg = 'v%d' % len(local_registers)
+        local_registers[reg] = (info.function, name, i, LOCAL_TYPES[kind])
+        regs.insert(0, reg)
+    _scope_add(info, name, level, '.'.join(regs))
+    if value is None:
+        return None
+    return ['=', _parse_param('.'.join(regs)),
+            _parse_param(_rename_locals(info, value))]
+
+def _rename_locals(info, line):
+    #local variable names become their (virtual) registers, leaving
+    #strings and characters alone. A closing brace ends the scope of
+    #everything declared inside it.
+    if line.startswith('}'):
+        for name in list(info.locals.keys()):
+            info.locals[name] = [(level, regs) for level, regs in info.locals[name]
+                                 if level <= info.level]
+            if len(info.locals[name]) == 0:
+                del info.locals[name]
+    if len(info.locals) == 0:
+        return line
+
+    #names being declared are new, they get renamed once they exist
+    declared = []
+    res = re.match(r'(?:for\s*\(\s*|__scratch )?(?:%s) ([^;]+)' % \
+                   '|'.join(LOCAL_TYPES), line)
+    if res and not re.match(r'\w+\s*\(', res.groups()[0]):
+        declared = [re.sub(r'[=\[].*', '', text).strip()
+                    for text in res.groups()[0].split(',')]
+
+    def rename(res):
+        name = res.group(0)
+        if name in info.locals and name not in declared:
+            return info.locals[name][-1][1]
+        return name
+
+    parts = re.split(r'("[^"]*"|\'[^\']*\')', line)
+    for i in range(0, len(parts), 2):
+        parts[i] = re.sub(r'\b[A-Za-z_]\w*\b', rename, parts[i])
+    return ''.join(parts)
+
+def parse_local(info, line):
+    #fmt: uint16_t x = 0x1234, y;
+    line = re.sub(r'[; ]+$', '', line)
+    res = re.match(r'(%s) (.+)$' % '|'.join(LOCAL_TYPES), line)
+    if not res or re.match(r'\w+\s*\(', res.groups()[1]):
+        return False
+
+    (kind, declarators) = res.groups()
+    for text in declarators.split(','):
+        code = _declare_local(info, kind, text, info.level)
+        if code is not None:
+            info.lines.append([info.level, info.lineno, 'assign', code])
+    return True
+
+def parse_scratch(info, line):
+    #fmt: __scratch uint8_t buf[8], count;
+    line = re.sub(r'[; ]+$', '', line)
+    res = re.match(r'__scratch (%s) (.+)$' % '|'.join(LOCAL_TYPES), line)
+    if not res:
+        return False
+
+    (kind, declarators) = res.groups()
+    for text in declarators.split(','):
+        res = re.match(r'^(\w+)\s*(?:\[\s*(.+?)\s*\])?$', text.strip())
+        if not res:
+            msg = 'Bad scratchpad variable "%d:%s"' % (info.lineno, text)
+            raise ParseException(msg)
+        (name, count) = res.groups()
+        if count is None:
+            count = 1
+        else:
+            count = _parse_param(count)
+        if type(count) != int or count < 1:
+            msg = 'Scratchpad array needs a constant size "%d:%s"' % \
+                    (info.lineno, text)
+            raise ParseException(msg)
+
+        size = LOCAL_TYPES[kind] * count
+        if info.level == 0:
+            if name in scratch_variables:
+                msg = 'Scratchpad variable declared twice "%d:%s"' % \
+                        (info.lineno, name)
+                raise ParseException(msg)
+            scratch_variables[name] = (None, name, size)
+        else:
+            ident = '__scratch%d' % len(scratch_variables)
+            scratch_variables[ident] = (info.function, name, size)
+            _scope_add(info, name, info.level, ident)
+    return True
+
 def parse_label(info, line):
     if super_verbose == True:
         print("Parsing %s" % line)
@@ -523,6 +948,8 @@ def parse_funcdef(info, line):
         ret = res.groups()[0]
         name = res.groups()[1]
         params = res.groups()[2]
+        info.function = name
+        info.locals = {}
         info.lines.append([info.level, info.lineno, 'funcdef', 
             [name, ret, params]])
         info.lines.append([info.level, info.lineno, 'file', 
@@ -543,9 +970,15 @@ def parse_funccall(info, line):
             info.lines.append([info.level, info.lineno, 'funccall', [fun]])
             return True
 
-        if fun in ['input', 'output', 'outputk', 'store', 'fetch', 'test']:
+        if fun in ['input', 'output', 'outputk', 'store', 'fetch', 'test',
+                   '__delay_cycles', 'shared', '__loop_bound']:
             info.lines.append([info.level, info.lineno, 'funccall',
                 [fun, _parse_param_list(params)]])
+        elif fun == 'rom_fetch':
+            #first parameter is a table name, not something to evaluate
+            params = re.split(r'[,]', params)
+            info.lines.append([info.level, info.lineno, 'funccall',
+                [fun, [params[0].strip()] + _parse_param_list(','.join(params[1:]))]])
         else:
             info.lines.append([info.level, info.lineno, 'funccall',
                 [fun, [params]]])
@@ -556,14 +989,32 @@ def parse_funccall(info, line):
 def parse(text):
     lines = text.split('\n')
     info = MetaInfo()
+    scratch_variables.clear()
+
+    #a const table can span lines, join it into the first line so the
+    #parsers see one statement (and the line numbers still add up)
+    for i in range(len(lines)):
+        if re.match(r'^\s*(static\s+)?const\s', lines[i]):
+            j = i
+            while j + 1 < len(lines) and not re.search(r';\s*$', lines[i]):
+                j += 1
+                if lines[j].startswith('#line'):
+                    continue
+                lines[i] = lines[i] + ' ' + lines[j].strip()
+                lines[j] = ''
 
     #build parser list
     lst_parser = [
             parse_macro,
             parse_block,
+            parse_const,
+            parse_scratch,
+            parse_local,
             parse_return,
             parse_do,
+            parse_for,
             parse_break,
+            parse_switch,
             parse_condition,
             parse_assign,
             parse_funcdecl,
@@ -580,19 +1031,32 @@ def parse(text):
         if re.match(r'^[ \t;]+$', line) or len(line) == 0:
             continue
 
-        line = re.sub(r'[\t ]+', ' ', line)
+        #don't squash the spaces in a const string
+        if not re.match(r'(static )?const ', line):
+            line = re.sub(r'[\t ]+', ' ', line)
+        line = _rename_locals(info, line)
 
-        #try all know parser
-        unknown = True
-        for parser in lst_parser:
-            #print(parser.__name__)
-            if parser(info, line):
-                unknown = False
-                break
+        #'case 1: s0 = 2;' is two statements, and the second is inside the case
+        statements = [(info.level, line)]
+        res = re.match(r'((?:case .+?|default)\s*:) (.+)$', line)
+        if res:
+            statements = [(info.level, res.groups()[0]),
+                          (info.level + 1, res.groups()[1])]
+
+        for level, line in statements:
+            info.level = level
+
+            #try all know parser
+            unknown = True
+            for parser in lst_parser:
+                #print(parser.__name__)
+                if parser(info, line):
+                    unknown = False
+                    break
 
-        if unknown:
-            msg = 'Unknown format "%d:%s"' % (info.lineno, line)
-            raise ParseException(msg)
+            if unknown:
+                msg = 'Unknown format "%d:%s"' % (info.lineno, line)
+                raise ParseException(msg)
 
     if super_verbose == True:
         print("info line dump")
@@ -638,8 +1102,561 @@ def parse(text):
             if singlewhile:
                 info.lines[idx][IDX_TYPE] = 'singlewhile'
         idx = idx + 1
+
+    allocate_scratchpad(info)
+    convert_for(info)
+    convert_expect(info)
+    convert_switch(info)
     return info
 
+def _inside_loop(lines, idx, kinds=['while', 'do', 'for', 'switch']):
+    #is lines[idx] inside a loop (or switch) that starts after lines[0]
+    level = lines[idx][IDX_LEVEL]
+    for i in reversed(range(idx)):
+        if lines[i][IDX_LEVEL] < level:
+            if lines[i][IDX_TYPE] in kinds:
+                return True
+            level = lines[i][IDX_LEVEL]
+    return False
+
+def _for_trips(init, cond, step):
+    #(register, trips, final value) of a counted for, trips is None if
+    #the start isn't a constant. None if it's not a counted for.
+    if len(init) != 1 or len(step) != 1 or cond is None or \
+            cond[0] in ['&&', '||']:
+        return None
+    (assign, reg, start) = init[0]
+    if assign != '=' or type(reg) != str or not re.match(r'^%s$' % REGISTER, reg):
+        return None
+    if step[0] not in [['+=', reg, 1], ['-=', reg, 1]] or \
+            cond[1] != reg or type(cond[2]) != int:
+        return None
+    (compare, bound) = (cond[0], cond[2])
+    up = step[0][0] == '+='
+    if type(start) != int:
+        #only counting down to 0 works without knowing where it starts
+        if not up and bound == 0 and compare in ['!=', '>']:
+            return (reg, None, 0)
+        return None
+    #the value the counter stops at
+    if compare == '!=':
+        final = bound
+    elif up and compare == '<':
+        final = max(bound, start)
+    elif up and compare == '<=' and bound < 255:
+        final = max(bound + 1, start)
+    elif not up and compare == '>':
+        final = min(bound, start)
+    elif not up and compare == '>=' and bound > 0:
+        final = min(bound - 1, start)
+    else:
+        return None
+    if up:
+        trips = (final - start) & 0xFF
+    else:
+        trips = (start - final) & 0xFF
+    return (reg, trips, final)
+
+def _statement_words(lines):
+    #instructions a run of plain statements takes, None if there's
+    #anything else (control flow, labels, inline assembly) in it
+    words = 0
+    for level, lineno, t, code in lines:
+        if t == 'assign' and code[0] not in ['*=', '/=', '%=']:
+            words += len(str(code[1]).split('.'))
+        elif t == 'funccall' and code[0] in ['input', 'output', 'outputk',
+                                             'store', 'fetch']:
+            words += 1
+        else:
+            return None
+    return words
+
+def _for_uses(lines, reg):
+    #can anything in lines see reg, or leave without going round again
+    for level, lineno, t, code in lines:
+        if t in ['return', 'goto', 'label', 'break'] or \
+                (t == 'funccall' and len(code) == 1 and
+                 code[0] not in ['enable_interrupt', 'disable_interrupt']):
+            return True
+        if re.search(r'\b%s\b' % reg, str(code)):
+            return True
+    return False
+
+def _for_writes(lines, reg):
+    #can anything in lines change reg, or leave without going round again
+    for level, lineno, t, code in lines:
+        if t in ['return', 'goto', 'label', 'break'] or \
+                (t == 'funccall' and len(code) == 1 and
+                 code[0] not in ['enable_interrupt', 'disable_interrupt']):
+            return True
+        if not re.search(r'\b%s\b' % reg, str(code)):
+            continue
+        if t == 'assign':
+            if re.search(r'\b%s\b' % reg, str(code[1])):
+                return True
+        elif t == 'funccall':
+            if code[0] not in ['output', 'outputk', 'store', 'test',
+                               '__delay_cycles', 'shared', '__loop_bound']:
+                return True
+        elif t not in ['if', 'else if', 'while', 'dowhile'] or "'--'" in str(code):
+            return True
+    return False
+
+def _lifetime_overlap(edges, handlers):
+    #return overlap(a, b): can functions a and b be running at the same
+    #time, because one calls the other (maybe further down), or one is
+    #an interrupt's and the other the mainline's. edges is caller :
+    #callees, anything not in it (like None) overlaps everything.
+    reach = {}
+    for name in edges:
+        reach[name] = set([name])
+        todo = [name]
+        while len(todo):
+            for callee in edges[todo.pop()]:
+                if callee in edges and callee not in reach[name]:
+                    reach[name].add(callee)
+                    todo.append(callee)
+    called = set()
+    for name in edges:
+        called |= edges[name]
+    isr = set()
+    mainline = set()
+    for name in edges:
+        if name in handlers:
+            isr |= reach[name]
+        elif name not in called:
+            mainline |= reach[name]
+
+    def overlap(a, b):
+        if a not in edges or b not in edges or a == b:
+            return True
+        if a in reach[b] or b in reach[a]:
+            return True
+        return (a in isr and b in mainline) or (b in isr and a in mainline)
+    return overlap
+
+def _scratchpad_place(name, size, function, overlap, kind, top_down=False):
+    #lowest (or highest) address with size bytes that nothing alive at
+    #the same time as function is using
+    addresses = range(scratchpad_size - size + 1)
+    if top_down:
+        addresses = reversed(addresses)
+    for address in addresses:
+        for (other, other_size, other_function, other_kind) in scratchpad_used.values():
+            if address < other + other_size and other < address + size and \
+                    overlap(function, other_function):
+                break
+        else:
+            key = name
+            while key in scratchpad_used:
+                key += "'"
+            scratchpad_used[key] = (address, size, function, kind)
+            return address
+    msg = 'no room for %s (%d bytes) in the %d byte scratchpad' % \
+            (name, size, scratchpad_size)
+    raise ParseException(msg)
+
+def allocate_scratchpad(info):
+    #give every __scratch variable an address, sharing between functions
+    #that can't be running at once, and put the addresses in the code
+    scratchpad_used.clear()
+    edges = {}
+    handlers = set()
+    function = None
+    for level, lineno, t, code in info.lines:
+        #what the program fetches and stores by address itself is
+        #nobody else's, everywhere
+        addresses = []
+        if t == 'funccall' and code[0] in ['fetch', 'store'] and \
+                type(code[1][0]) == int:
+            addresses = [code[1][0]]
+        elif t == 'funccall' and code[0] in ['psm', '__asm__', 'asm', 'assembly']:
+            addresses = [_asm_value(a) for a in re.findall(
+                r'\b(?:fetch|store)\s+\w+\s*,\s*([0-9]\w*)\b', code[1][0])]
+        for address in addresses:
+            if address is None:
+                continue
+            key = 'by hand:0x%02X' % address
+            if 0 <= address < scratchpad_size and key not in scratchpad_used:
+                scratchpad_used[key] = (address, 1, None, 'by hand')
+
+        if t == 'funcdecl' and re.search(r'\binterrupt\b', code[3]):
+            handlers.add(code[0])
+        elif t == 'funcdef':
+            function = code[0]
+            edges.setdefault(function, set())
+        elif t in ['funccall', 'goto'] and function is not None:
+            if code[0] in ['psm', '__asm__', 'asm', 'assembly']:
+                edges[function].update(re.findall(r'\w+', code[1][0]))
+            else:
+                edges[function].add(code[0])
+    overlap = _lifetime_overlap(edges, handlers)
+
+    #whole-program ones first, then biggest first
+    base = {}
+    order = sorted(scratch_variables, key=lambda ident: \
+                   (scratch_variables[ident][0] is not None,
+                    -scratch_variables[ident][2]))
+    for ident in order:
+        (function, name, size) = scratch_variables[ident]
+        if function is not None:
+            name = '%s:%s' % (function, name)
+        base[ident] = _scratchpad_place(name, size, function, overlap, '__scratch')
+        print('scratchpad %s at 0x%02X-0x%02X' % \
+                (name, base[ident], base[ident] + size - 1))
+
+    def resolve(code):
+        if isinstance(code, ScratchAddress):
+            (function, name, size) = scratch_variables[code.ident]
+            if code.offset < 0 or code.offset >= size:
+                msg = 'scratchpad address %r is outside %s' % (code, name)
+                raise ParseException(msg)
+            return base[code.ident] + code.offset
+        if type(code) == list:
+            return [resolve(c) for c in code]
+        return code
+
+    for line in info.lines:
+        line[IDX_CODE] = resolve(line[IDX_CODE])
+
+def scratchpad_map():
+    #text for the .map file: what's where, and how much is left
+    lines = [';scratchpad, %d bytes' % scratchpad_size,
+             ';address    bytes  kind       function          name']
+    used = set()
+    for name in sorted(scratchpad_used, key=lambda n: (scratchpad_used[n][0], n)):
+        (address, size, function, kind) = scratchpad_used[name]
+        used.update(range(address, address + size))
+        lines.append('0x%02X-0x%02X  %5d  %-9s  %-16s  %s' % \
+                (address, address + size - 1, size, kind,
+                 function or '(everywhere)', name.split(':')[-1]))
+    lines.append(';used %d of %d bytes, %d free' % \
+            (len(used), scratchpad_size, scratchpad_size - len(used)))
+    return '\n'.join(lines) + '\n'
+
+def convert_for(info):
+    #for (init; cond; step) body, lowered to the loops we already have
+    #
+    #   counting down to 0  ->  init; do body while (--sX);
+    #   counted, sX unused  ->  sX = trips; do body while (--sX); sX = end
+    #   counted             ->  init; do { body; step } while (sX != end)
+    #   counted, sX written ->  init; do { body; step } while (cond)
+    #   anything else       ->  init; while (cond) { body; step }
+    #
+    #and a counted loop with a short body may be unrolled instead.
+    #break and continue become gotos to labels after the loop and in
+    #front of the step.
+    lines = info.lines
+    idx = 0
+    while idx < len(lines):
+        if lines[idx][IDX_TYPE] != 'for':
+            idx += 1
+            continue
+        level, lineno, t, code = lines[idx]
+        (init, cond, step, prefix, empty) = code
+        label_next = prefix + 'next'
+        label_end = prefix + 'end'
+
+        if empty:
+            end = idx
+            body = []
+        else:
+            end = _body_end(lines, idx)
+            if end is None:
+                msg = 'for needs a body "%d:for"' % lineno
+                raise ParseException(msg)
+            body = lines[idx + 2:end]
+
+        used = []
+        for i in range(len(body)):
+            b_level, b_lineno, b_t, b_code = body[i]
+            if b_t == 'break' and not _inside_loop(body, i):
+                body[i] = [b_level, b_lineno, 'goto', [label_end, None, None, None]]
+                used.append(label_end)
+            elif b_t == 'continue' and not _inside_loop(body, i, ['while', 'do', 'for']):
+                body[i] = [b_level, b_lineno, 'goto', [label_next, None, None, None]]
+                used.append(label_next)
+
+        def assigns(codes, at):
+            return [[at, lineno, 'assign', _inline_rename(c, {})] for c in codes]
+
+        def shifted(part, by):
+            return [[l[IDX_LEVEL] + by] + l[1:] for l in part]
+
+        #the end of a loop body: continue lands here, then the step
+        tail = []
+        if label_next in used:
+            tail.append([level + 2, lineno, 'label', [label_next, None, None, None]])
+
+        counted = _for_trips(init, cond, step)
+        words = _statement_words(body)
+        new_lines = None
+        if counted:
+            (reg, trips, final) = counted
+            hidden = not _for_uses(body, reg)
+            #the body might step sX past the end, or off it, itself
+            writes = _for_writes(body, reg)
+            #the do..while below jumps back one less time than it runs,
+            #at most 255 times when it starts from a register
+            back = 254
+            if trips is not None:
+                back = max(trips - 1, 0)
+            bound = [[level + 2, lineno, 'funccall', ['__loop_bound', [back]]]]
+            if writes:
+                bound = []
+            if trips == 0:
+                print('for at %d: never runs' % lineno)
+                new_lines = assigns(init, level)
+            elif trips is not None and words and not used and not writes and \
+                    opt_level != '0':
+                #straight through, or round the loop as below
+                if final == 0 and step[0][0] == '-=':
+                    (setup, overhead) = (1, 2)
+                elif hidden:
+                    (setup, overhead) = (2, 2)
+                else:
+                    (setup, overhead) = (1, 3)
+                (looped, x) = instructions_cost(setup + words + overhead)
+                (x, looped_clocks) = instructions_cost(setup + trips * (words + overhead))
+                if hidden:
+                    unrolled = 1 + trips * words
+                else:
+                    unrolled = 1 + trips * (words + 1)
+                (unrolled, unrolled_clocks) = instructions_cost(unrolled)
+                if opt_score(unrolled - looped, unrolled_clocks - looped_clocks) < 0:
+                    print('for at %d: unrolled %d times' % (lineno, trips))
+                    new_lines = assigns(init, level)
+                    for i in range(trips):
+                        new_lines += _inline_rename(shifted(body, -2), {})
+                        new_lines += assigns(step, level)
+
+            if new_lines is not None or (writes and trips is None):
+                pass
+            elif final == 0 and step[0][0] == '-=' and not writes:
+                print('for at %d: counts down with %s' % (lineno, reg))
+                new_lines = assigns(init, level)
+                do = [[level, lineno, 'do', []],
+                      [level + 1, lineno, 'block', '{']] + bound + body + tail + \
+                     [[level + 1, lineno, 'block', '}'],
+                      [level, lineno, 'dowhile', ['--', reg, 0]]]
+                if trips is None:
+                    #the start is a register, it might be 0 already
+                    new_lines += [[level, lineno, 'if', ['!=', reg, 0]],
+                                  [level + 1, lineno, 'block', '{']] + \
+                                 shifted(do, 2) + \
+                                 [[level + 1, lineno, 'block', '}']]
+                else:
+                    new_lines += do
+            elif hidden and opt_level != '0':
+                print('for at %d: counts %d down with %s' % (lineno, trips, reg))
+                new_lines = assigns([['=', reg, trips]], level) + \
+                    [[level, lineno, 'do', []],
+                     [level + 1, lineno, 'block', '{']] + bound + body + tail + \
+                    [[level + 1, lineno, 'block', '}'],
+                     [level, lineno, 'dowhile', ['--', reg, 0]]] + \
+                    assigns([['=', reg, final]], level)
+            else:
+                new_lines = assigns(init, level) + \
+                    [[level, lineno, 'do', []],
+                     [level + 1, lineno, 'block', '{']] + bound + body + tail + \
+                    assigns(step, level + 2) + \
+                    [[level + 1, lineno, 'block', '}'],
+                     [level, lineno, 'dowhile', ['!=', reg, final]]]
+                if writes:
+                    #trips > 0, so cond holds on the way in
+                    new_lines[-1][IDX_CODE] = _inline_rename(cond, {})
+
+        if new_lines is None:
+            #no condition is the same as always true
+            if cond is None:
+                cond = ['!=', 1, 0]
+            new_lines = assigns(init, level) + \
+                [[level, lineno, 'while', _inline_rename(cond, {})],
+                 [level + 1, lineno, 'block', '{']] + body + tail + \
+                assigns(step, level + 2) + \
+                [[level + 1, lineno, 'block', '}']]
+
+        if label_end in used:
+            new_lines.append([level, lineno, 'label', [label_end, None, None, None]])
+        lines[idx:end + 1] = new_lines
+
+def convert_switch(info):
+    #flatten switch into a dispatch line, labels and gotos, so the
+    #rest of the passes never see it. Outer switches go first, a
+    #nested one just moves up a few levels and gets picked up next.
+    #
+    #   switch (s0)     ->  dispatch s0, cases, default, prefix
+    #     {             ->
+    #     case 1:       ->  L_..._sw0_case1:
+    #       ...         ->  ...
+    #       break;      ->  goto L_..._sw0_end
+    #     default:      ->  L_..._sw0_default:
+    #       ...         ->  ...
+    #     }             ->  L_..._sw0_end:
+    lines = info.lines
+    while True:
+        idx = 0
+        while idx < len(lines) and lines[idx][IDX_TYPE] != 'switch':
+            idx += 1
+        if idx == len(lines):
+            break
+
+        level, lineno, t, code = lines[idx]
+        param = code[0]
+        prefix = code[1]
+        if type(param) != str or not re.match(r'^%s$' % REGISTER, param):
+            msg = 'switch needs a single register "%d:switch (%s)"' % (lineno, param)
+            raise ParseException(msg)
+
+        if idx + 1 >= len(lines) or lines[idx + 1][IDX_TYPE] != 'block':
+            msg = 'switch needs a body "%d:switch (%s)"' % (lineno, param)
+            raise ParseException(msg)
+        open_level = lines[idx + 1][IDX_LEVEL]
+        end = idx + 2
+        while end < len(lines) and not (lines[end][IDX_TYPE] == 'block' and
+                                        lines[end][IDX_CODE] == '}' and
+                                        lines[end][IDX_LEVEL] == open_level):
+            end += 1
+        if end == len(lines):
+            msg = 'switch without closing brace "%d:switch (%s)"' % (lineno, param)
+            raise ParseException(msg)
+        body = lines[idx + 2:end]
+
+        #cases and statements of this switch are the least indented
+        case_level = min([l[IDX_LEVEL] for l in body
+                          if l[IDX_TYPE] in ['case', 'default']] or [open_level])
+        shift = min([l[IDX_LEVEL] for l in body
+                     if l[IDX_TYPE] not in ['case', 'default', 'block']] or [level])
+        shift -= level
+
+        label_end = prefix + 'end'
+        cases = []
+        label_default = label_end
+        new_lines = []
+        for i in range(len(body)):
+            b_level, b_lineno, b_t, b_code = body[i]
+            if b_t in ['case', 'default'] and b_level == case_level:
+                if b_t == 'case':
+                    if b_code[0] in [c[0] for c in cases]:
+                        msg = 'Duplicate case value "%d:case %d"' % (b_lineno, b_code[0])
+                        raise ParseException(msg)
+                    name = '%scase%d' % (prefix, b_code[0])
+                    cases.append((b_code[0], name))
+                else:
+                    name = prefix + 'default'
+                    label_default = name
+                new_lines.append([level, b_lineno, 'label',
+                                  [name, None, None, None]])
+            elif b_t == 'break' and not _inside_loop(body, i):
+                new_lines.append([b_level - shift, b_lineno, 'goto',
+                                  [label_end, None, None, None]])
+            else:
+                new_lines.append([b_level - shift, b_lineno, b_t, b_code])
+
+        new_lines.insert(0, [level, lineno, 'dispatch',
+                             [param, cases, label_default, prefix]])
+        new_lines.append([level, lines[end][IDX_LINENO], 'label',
+                          [label_end, None, None, None]])
+        lines[idx:end + 1] = new_lines
+
+#a condition that's true exactly when the original is false
+INVERSE_COMPARE = {'==': '!=', '!=': '==', '<': '>=', '>=': '<',
+                   '>': '<=', '<=': '>', '&': '^', '^': '&'}
+#'--' hides its sense in param1, see parse_condition
+INVERSE_DECREMENT = {-1: -2, -2: -1, 0: 1, 1: 0}
+
+def _invert_condition(code):
+    compare, param0, param1 = code[:3]
+    #!(a && b) is !a || !b
+    if compare == '&&':
+        return ['||', _invert_condition(param0), _invert_condition(param1)]
+    if compare == '||':
+        return ['&&', _invert_condition(param0), _invert_condition(param1)]
+    if compare == '--':
+        return [compare, param0, INVERSE_DECREMENT[param1]]
+    return [INVERSE_COMPARE[compare], param0, param1]
+
+def _condition_words(code):
+    #instructions it takes to get a condition down to its last jump
+    compare, param0, param1 = code[:3]
+    if compare in ['&&', '||']:
+        return _condition_words(param0) + _condition_words(param1) + 1
+    if param0 in ['Z', 'C'] or type(param0) == int:
+        return 0
+    return len(param0.split('.'))
+
+def _body_end(lines, idx):
+    #index of the '}' closing the body of lines[idx], None if no body
+    if idx + 1 >= len(lines) or lines[idx + 1][IDX_TYPE] != 'block' or \
+            lines[idx + 1][IDX_CODE] != '{':
+        return None
+    open_level = lines[idx + 1][IDX_LEVEL]
+    for end in range(idx + 2, len(lines)):
+        if lines[end][IDX_TYPE] == 'block' and lines[end][IDX_CODE] == '}' and \
+                lines[end][IDX_LEVEL] == open_level:
+            return end
+    return None
+
+def convert_expect(info):
+    #use likely()/unlikely() to pick the layout. Every instruction is
+    #2 clocks taken or not, so the only thing to win is the
+    #unconditional jump:
+    #
+    #   if (likely(c))  ->  if (!c)         the 'if' body ends with a
+    #     A             ->    B             jump over the 'else', so
+    #   else            ->  else            the likely path goes in
+    #     B             ->    A             the 'else'
+    #
+    #   while (likely(c))   ->  if (c)      test at the bottom, no
+    #     A                 ->    do        jump back to the top,
+    #                       ->      A       one instruction less per
+    #                       ->    while (c) iteration
+    #
+    #anything else is already laid out the best way.
+    lines = info.lines
+    idx = 0
+    while idx < len(lines):
+        if lines[idx][IDX_TYPE] != 'expect':
+            idx += 1
+            continue
+        expected = lines[idx][IDX_CODE][0]
+        del lines[idx]
+        level, lineno, t, code = lines[idx]
+        end = _body_end(lines, idx)
+        if not expected or opt_level == '0' or end is None:
+            continue
+
+        if t in ['if', 'else if']:
+            if end + 1 >= len(lines) or lines[end + 1][IDX_TYPE] != 'else' or \
+                    lines[end + 1][IDX_LEVEL] != level:
+                continue
+            end_else = _body_end(lines, end + 1)
+            if end_else is None:
+                continue
+            print('likely %s at %d: swapped with else' % (t, lineno))
+            lines[idx][IDX_CODE] = _invert_condition(code)
+            lines[idx + 1:end_else + 1] = lines[end + 2:end_else + 1] + \
+                [lines[end + 1]] + lines[idx + 1:end + 1]
+
+        elif t == 'while':
+            body = lines[idx + 2:end]
+            if [l for l in body if l[IDX_TYPE] in ['break', 'continue']]:
+                print('likely while at %d: has break/continue, not rotated' % lineno)
+                continue
+            #the test is duplicated to save the jump back every iteration
+            if opt_score(_condition_words(code), -cost('instruction')[1]) > 0:
+                continue
+            print('likely while at %d: test moved to the bottom' % lineno)
+            end_lineno = lines[end][IDX_LINENO]
+            new_lines = [[level, lineno, 'if', list(code)],
+                         [level + 1, lineno, 'block', '{'],
+                         [level + 2, lineno, 'do', []]]
+            for l in lines[idx + 1:end + 1]:
+                new_lines.append([l[IDX_LEVEL] + 2] + l[1:])
+            new_lines.append([level + 2, end_lineno, 'dowhile', list(code)])
+            new_lines.append([level + 1, end_lineno, 'block', '}'])
+            lines[idx:end + 1] = new_lines
+
 def dump_parse(lines, no_title=False, f=sys.stdout):
     show_title = not no_title
 
@@ -687,7 +1704,7 @@ def convert_list_to_block(info):
             # I have NO IDEA what this was supposed to do.
             # 
             res = re.match('__attribute__[ \t]*\(\((.+)\W*\((.+)\)\)\)', attributes)
-            res2 = re.match('__attribute__\s*\(\(\s*(\w+)\s*\)\)', attributes)
+            res2 = re.match('__attribute__\s*\(\(\s*([\w\s,]+?)\s*\)\)', attributes)
             if res:
                 clear_attrs = []
                 attrs = res.groups()
@@ -703,10 +1720,14 @@ def convert_list_to_block(info):
 
                 map_attribute[name] = clear_attrs
             elif res2:
-                attr = res2.groups()[0]
-                if attr == "noreturn":
-                    print("Function '%s' with attribute noreturn, adding to label list" % name)
-                    labels.append(name)
+                for attr in re.split(r'[\s,]+', res2.groups()[0]):
+                    if attr not in ['noreturn', 'always_inline', 'noinline', 'balanced']:
+                        msg = 'Unknown attribute "%s"' % attr
+                        raise ParseException(msg)
+                    function_hints.setdefault(name, []).append(attr)
+                    if attr == "noreturn":
+                        print("Function '%s' with attribute noreturn, adding to label list" % name)
+                        labels.append(name)
             else:
                 msg = 'Unknown attribute format "%s"' % attributes
                 raise ParseException(msg)
@@ -861,7 +1882,10 @@ def condition_optimizer(map_function):
                             # (if we ever add argument support
                             #  we will expand code before this point!
                             #  so this would become a multiline block!)
-                            if len(code) == 1:
+                            # An && or || can't call from more than
+                            # one place, so it stays an if.
+                            cond = get_transformable_block_code(transformable[0])
+                            if len(code) == 1 and cond[0] not in ['&&', '||']:
                                 transformable.append(block)
                                 stage = "endif"
                             else:
@@ -1228,11 +2252,911 @@ def convert_condition_to_ifgoto2(map_function):
     #            print ' '*line[IDX_LEVEL], line[IDX_TYPE], line[IDX_CODE]
     #        print
 
+#what things cost on each target, as (ROM words, clocks, stack slots).
+#'call' is the call at the call site plus the return in the callee,
+#None means the target can't do it at all.
+TARGET_COSTS = {
+    'kcpsm3': {
+        'stack_depth': 31,
+        'instruction': (1, 2, 0),
+        'call': (1, 4, 1),
+        'jump@': None,
+        'load&return': None,
+        'outputk': None,
+    },
+    'kcpsm6': {
+        'stack_depth': 30,
+        'instruction': (1, 2, 0),
+        'call': (1, 4, 1),
+        'jump@': (1, 2, 0),
+        'load&return': (1, 2, 0),
+        'outputk': (1, 2, 0),
+    },
+}
+
+#how many clocks a ROM word is worth at each -O level. -O0 never gets
+#that far, the passes that would ask are switched off.
+OPT_WORD_CLOCKS = {'0': 2, '1': 2, '2': 0.5, 's': 1000}
+
+def cost(idiom, count=1):
+    #(ROM words, clocks, stack slots) of count idioms on the target
+    each = TARGET_COSTS[target][idiom]
+    if each is None:
+        return None
+    return tuple([x * count for x in each])
+
+def instructions_cost(instructions):
+    #(ROM words, clocks) of straight line code
+    (words, clocks, stack) = cost('instruction', instructions)
+    return (words, clocks)
+
+def opt_score(words, clocks):
+    #one number for ROM words and clocks at the -O level, lower is better
+    return words * OPT_WORD_CLOCKS[opt_level] + clocks
+
+#__delay_cycles: at most this many nops inside a loop body
+DELAY_MAX_PAD = 3
+#__delay_cycles: refuse anything longer than this
+DELAY_MAX_WORDS = 64
+
+def _delay_search(total, nregs):
+    #cheapest way to burn exactly total instructions with nregs
+    #counters, as (words, registers, kind, parameters). Anything a
+    #loop can't cover is padded with nops.
+    best = [(total, 0, 'pad', (total,))]
+    def consider(words, regs, kind, params):
+        if (words, regs) < best[0][:2]:
+            best[0] = (words, regs, kind, params)
+
+    for p in range(DELAY_MAX_PAD + 1):
+        #load, then (sub, jump) per round
+        if nregs >= 1:
+            k = min(256, int((total - 1) / (2 + p)))
+            if k >= 1:
+                pads = total - 1 - k * (2 + p)
+                consider(3 + p + pads, 1, 'loop8', (k, p, pads))
+        #16 bit counter: 2 loads, then (sub, subcy, jump) per round
+        if nregs >= 2:
+            n = min(1 << 16, int((total - 2) / (3 + p)))
+            if n >= 1:
+                pads = total - 2 - n * (3 + p)
+                consider(5 + p + pads, 2, 'loop16', (n, p, pads))
+        #24 bit counter: 3 loads, then (sub, subcy, subcy, jump)
+        if nregs >= 3:
+            n = min(1 << 24, int((total - 3) / (4 + p)))
+            if n >= 1:
+                pads = total - 3 - n * (4 + p)
+                consider(7 + p + pads, 3, 'loop24', (n, p, pads))
+
+    #two nested 8 bit loops, with optional nops in either one
+    if nregs >= 2:
+        for k2 in range(1, 257):
+            for pi in range(2):
+                for po in range(2):
+                    per = 3 + po + k2 * (2 + pi)
+                    k1 = min(256, int((total - 1) / per))
+                    if k1 >= 1:
+                        pads = total - 1 - k1 * per
+                        consider(6 + pi + po + pads, 2, 'nest', (k1, k2, pi, po, pads))
+    return best[0]
+
+def delay_cycles(clocks, regs, label_prefix):
+    #asm lines that take exactly clocks, every instruction is 2 clocks
+    if clocks % 2:
+        print('warning: __delay_cycles(%d) rounded up to %d clocks' % (clocks, clocks + 1))
+        clocks += 1
+    total = int(clocks / 2)
+    if total == 0:
+        return []
+
+    (words, nregs, kind, params) = _delay_search(total, len(regs))
+    if words > DELAY_MAX_WORDS:
+        msg = '__delay_cycles(%d) needs %d words with %d scratch registers, give it more' % \
+            (clocks, words, len(regs))
+        raise ParseException(msg)
+    nop = 'load s0, s0'
+    lines = []
+    if kind == 'pad':
+        lines += [nop] * params[0]
+    elif kind == 'loop8':
+        (k, p, pads) = params
+        lines.append('load %s, %d' % (regs[0], k & 0xFF))
+        lines.append('%s0:' % label_prefix)
+        lines += [nop] * p
+        lines.append('sub %s, 1' % regs[0])
+        lines.append('jump NZ, %s0' % label_prefix)
+        lines += [nop] * pads
+    elif kind in ['loop16', 'loop24']:
+        (n, p, pads) = params
+        width = {'loop16':2, 'loop24':3}[kind]
+        #count down to -1, regs[0] is the LSB
+        for i in reversed(range(width)):
+            lines.append('load %s, %d' % (regs[i], ((n - 1) >> (8 * i)) & 0xFF))
+        lines.append('%s0:' % label_prefix)
+        lines += [nop] * p
+        lines.append('sub %s, 1' % regs[0])
+        for i in range(1, width):
+            lines.append('subcy %s, 0' % regs[i])
+        lines.append('jump NC, %s0' % label_prefix)
+        lines += [nop] * pads
+    elif kind == 'nest':
+        (k1, k2, pi, po, pads) = params
+        lines.append('load %s, %d' % (regs[1], k1 & 0xFF))
+        lines.append('%s0:' % label_prefix)
+        lines.append('load %s, %d' % (regs[0], k2 & 0xFF))
+        lines += [nop] * po
+        lines.append('%s1:' % label_prefix)
+        lines += [nop] * pi
+        lines.append('sub %s, 1' % regs[0])
+        lines.append('jump NZ, %s1' % label_prefix)
+        lines.append('sub %s, 1' % regs[1])
+        lines.append('jump NZ, %s0' % label_prefix)
+        lines += [nop] * pads
+
+    print('__delay_cycles(%d): %s, %d words, %s' % \
+            (clocks, kind, words, ', '.join(regs[:nregs]) or 'no registers'))
+    return lines
+
+def _function_words(map_function, name):
+    #size of a function body, as generate_assembly would write it. What
+    #it places in the scratchpad on the way is only a trial.
+    s = StringIO()
+    saved = dict(scratchpad_used)
+    with redirect_stdout(StringIO()):
+        generate_assembly({name: map_function[name]}, {}, s)
+    scratchpad_used.clear()
+    scratchpad_used.update(saved)
+    words = 0
+    inside = False
+    for text in s.getvalue().split('\n'):
+        text = re.sub(r';.*$', '', text).strip()
+        if text == '%s:' % name:
+            inside = True
+        elif text == '_end_%s:' % name:
+            break
+        elif inside and len(text) and not text.endswith(':'):
+            words += 1
+    return words
+
+def _inline_candidate(map_function, map_attribute, name):
+    #return None if name can be inlined, else the reason why not
+    hints = function_hints.get(name, [])
+    if name in ['init', 'loop'] or name in map_attribute:
+        return 'entry point'
+    if 'noinline' in hints or 'noreturn' in hints or name in labels:
+        return 'noinline'
+    if 'balanced' in hints:
+        return 'balanced'
+    for label, block in map_function[name]:
+        for level, lineno, t, code in block:
+            if t == 'ifcall' or (t == 'funccall' and
+                                 (code[0] in map_function or code[0] in labels)):
+                return 'not a leaf'
+            if t == 'funccall' and code[0] in ['psm', 'asm', '__asm__', 'assembly']:
+                return 'inline assembly'
+            if t == 'return' and code:
+                return 'returns from interrupt'
+    return None
+
+def _inline_sites(map_function, name):
+    #(caller, block index, line index) of every plain call to name
+    sites = []
+    for caller in map_function:
+        for i in range(len(map_function[caller])):
+            label, block = map_function[caller][i]
+            for j in range(len(block)):
+                t = block[j][IDX_TYPE]
+                code = block[j][IDX_CODE]
+                if t == 'funccall' and code == [name]:
+                    sites.append((caller, i, j))
+    return sites
+
+def _inline_referenced(map_function, name):
+    #is name used other than by a plain call (ifcall, goto, psm text)
+    for caller in map_function:
+        for label, block in map_function[caller]:
+            for level, lineno, t, code in block:
+                if t == 'ifcall' and code[3] == name:
+                    return True
+                if t in ['goto', 'ifgoto'] and name in code:
+                    return True
+                if t == 'funccall' and len(code) > 1 and \
+                        re.search(r'\b%s\b' % name, str(code[1])):
+                    return True
+    return False
+
+def _inline_rename(code, map_rename):
+    if type(code) == str:
+        return map_rename.get(code, code)
+    if type(code) == list:
+        return [_inline_rename(c, map_rename) for c in code]
+    if type(code) == tuple:
+        return tuple([_inline_rename(c, map_rename) for c in code])
+    return code
+
+def _inline_site(map_function, name, caller, i, j, suffix):
+    #splice a copy of name's blocks in place of caller's block i line j
+    lst_block = map_function[caller]
+    label, block = lst_block[i]
+    call_level = block[j][IDX_LEVEL]
+
+    #every label the copy defines gets a per-site name
+    map_rename = {}
+    for b_label, b_block in map_function[name]:
+        map_rename[b_label] = b_label + suffix
+        for line in b_block:
+            if line[IDX_TYPE] == 'label':
+                map_rename[line[IDX_CODE][0]] = line[IDX_CODE][0] + suffix
+    label_end = map_function[name][-1][0] + suffix
+
+    new_blocks = []
+    for b_label, b_block in map_function[name]:
+        new_block = []
+        for level, lineno, t, code in b_block:
+            if t == 'file':
+                continue
+            code = _inline_rename(code, map_rename)
+            if t == 'dispatch':
+                code[3] = code[3][:-1] + suffix + '_'
+            elif t == 'return':
+                t = 'goto'
+                code = [label_end, None, None, None]
+            elif t == 'ifreturn':
+                t = 'ifgoto'
+                code[3] = label_end
+            elif t == 'endfunc':
+                t = 'endinline'
+                code = [name]
+            new_block.append([level + call_level - 1, lineno, t, code])
+        new_blocks.append((b_label + suffix, new_block))
+
+    #rest of the caller's block carries on after the copy
+    new_blocks[-1][1].extend(block[j + 1:])
+    if j > 0:
+        new_blocks.insert(0, (label, block[:j]))
+    else:
+        #nothing before the call, the copy takes over the block label
+        first_label, first_block = new_blocks[0]
+        for b_label, b_block in new_blocks:
+            for line in b_block:
+                line[IDX_CODE] = _inline_rename(line[IDX_CODE], {first_label: label})
+        new_blocks[0] = (label, first_block)
+    lst_block[i:i + 1] = new_blocks
+
+def inline_functions(map_function, map_attribute):
+    #inline leaf functions where the cost model (or always_inline)
+    #says so. A function whose calls all went away is dropped. Callers
+    #can turn into leaves themselves, so go round until nothing moves.
+    inline_id = 0
+    changed = True
+    while changed:
+        changed = False
+        for name in sorted(map_function):
+            if name not in map_function:
+                continue
+            reason = _inline_candidate(map_function, map_attribute, name)
+            always = 'always_inline' in function_hints.get(name, [])
+            if opt_level == '0' and not always:
+                continue
+            if reason:
+                if always:
+                    print('cannot inline %s: %s' % (name, reason))
+                continue
+
+            sites = _inline_sites(map_function, name)
+            if len(sites) == 0:
+                continue
+            words = _function_words(map_function, name)
+            removable = not _inline_referenced(map_function, name)
+            growth = len(sites) * (words - 1)
+            if removable:
+                growth -= words + 1
+            #every call site saves a call + return
+            (call_words, call_clocks, call_stack) = cost('call', len(sites))
+            if not always and opt_score(growth, -call_clocks) > 0:
+                continue
+
+            print('inlining %s (%d words) at %d call(s), %+d words' % \
+                    (name, words, len(sites), growth))
+            #back to front, so earlier indices stay put
+            for (caller, i, j) in reversed(sites):
+                _inline_site(map_function, name, caller, i, j, '_in%d' % inline_id)
+                inline_id += 1
+            if removable:
+                del map_function[name]
+            changed = True
+
+#below this many cases a linear compare chain beats splitting
+SWITCH_LINEAR_CASES = 3
+
+def _switch_tree(reg, cases, label_default, prefix, lines):
+    #binary search over sorted cases, return worst case instructions
+    if len(cases) <= SWITCH_LINEAR_CASES:
+        for value, label in cases:
+            lines.append('compare %s, %d' % (reg, value))
+            lines.append('jump Z, %s' % label)
+        lines.append('jump %s' % label_default)
+        return 2 * len(cases) + 1
+
+    mid = int(len(cases) / 2)
+    value, label = cases[mid]
+    label_lt = '%slt%d' % (prefix, value)
+    lines.append('compare %s, %d' % (reg, value))
+    lines.append('jump Z, %s' % label)
+    lines.append('jump C, %s' % label_lt)
+    worst_ge = _switch_tree(reg, cases[mid + 1:], label_default, prefix, lines)
+    lines.append('%s:' % label_lt)
+    worst_lt = _switch_tree(reg, cases[:mid], label_default, prefix, lines)
+    return 3 + max(worst_ge, worst_lt)
+
+def _switch_table(reg, cases, label_default, prefix, lines):
+    #computed jump into a table of 'load reg, value' + 'jump case'
+    #pairs. reg gets scrambled to build the address, each entry puts
+    #back the value it stands for. return worst case instructions
+    sel = scratch_registers[0]
+    low = cases[0][0]
+    high = cases[-1][0]
+    label_table = prefix + 'table'
+    label_range = prefix + 'range'
+    map_case = dict(cases)
+
+    #one compare does both ends, anything below low wraps around
+    if low > 0:
+        lines.append('sub %s, %d' % (reg, low))
+    if high - low < 255:
+        lines.append('compare %s, %d' % (reg, high - low + 1))
+        if low > 0:
+            lines.append('jump NC, %s' % label_range)
+        else:
+            lines.append('jump NC, %s' % label_default)
+    lines.append("load %s, %s'upper" % (sel, label_table))
+    lines.append('sl0 %s' % reg)
+    lines.append('addcy %s, 0' % sel)
+    lines.append("add %s, %s'lower" % (reg, label_table))
+    lines.append('addcy %s, 0' % sel)
+    lines.append('jump@ (%s, %s)' % (sel, reg))
+    worst = len(lines) + 2
+
+    if low > 0 and high - low < 255:
+        lines.append('%s:' % label_range)
+        lines.append('add %s, %d' % (reg, low))
+        lines.append('jump %s' % label_default)
+    lines.append('%s:' % label_table)
+    for value in range(low, high + 1):
+        lines.append('load %s, %d ;keep' % (reg, value))
+        lines.append('jump %s ;keep' % map_case.get(value, label_default))
+    return worst
+
+def switch_dispatch(reg, cases, label_default, prefix):
+    #pick between a compare tree and a jump table, return asm lines
+    cases = sorted(cases)
+    tree = []
+    tree_worst = _switch_tree(reg, cases, label_default, prefix, tree)
+    tree_words = len([l for l in tree if not l.endswith(':')])
+    choice = (tree, tree_worst, tree_words, 'compare tree')
+
+    #needs jump@, and the table can't steal its own index
+    if cost('jump@') and opt_level != '0' and \
+            len(cases) > SWITCH_LINEAR_CASES and reg not in scratch_registers:
+        table = []
+        table_worst = _switch_table(reg, cases, label_default, prefix, table)
+        table_words = len([l for l in table if not l.endswith(':')])
+        (words, clocks) = instructions_cost(table_worst)
+        table_score = opt_score(table_words, clocks)
+        (words, clocks) = instructions_cost(tree_worst)
+        if table_score < opt_score(tree_words, clocks):
+            choice = (table, table_worst, table_words, 'jump table')
+
+    (lines, worst, words, kind) = choice
+    print('switch (%s): %d cases, %s, %d words, worst case %d instructions' % \
+            (reg, len(cases), kind, words, worst))
+    return lines
+
+def _shift_left(regs):
+    #regs are least significant first
+    return ['sl0 %s' % regs[0]] + ['sla %s' % r for r in regs[1:]]
+
+def _shift_right(regs):
+    return ['sr0 %s' % regs[-1]] + ['sra %s' % r for r in reversed(regs[:-1])]
+
+def _add_chain(op, regs, operands):
+    #add/sub with carry through every byte
+    lines = ['%s %s, %s' % (op, regs[0], operands[0])]
+    for num in range(1, len(regs)):
+        lines.append('%scy %s, %s' % (op, regs[num], operands[num]))
+    return lines
+
+def _mul_digits(value):
+    #(binary, canonical signed digit) forms of value, LSB first
+    binary = []
+    v = value
+    while v:
+        binary.append(v & 1)
+        v >>= 1
+    csd = []
+    v = value
+    while v:
+        digit = 0
+        if v & 1:
+            digit = 2 - (v & 3)
+            v -= digit
+        csd.append(digit)
+        v >>= 1
+    return (binary, csd)
+
+def _mul_horner(regs, digits, temps):
+    #regs *= digits (LSB first, top one is 1), temps get a copy of regs
+    lines = []
+    top = len(digits) - 1
+    if any(digits[:top]):
+        for num in range(len(regs)):
+            lines.append('move %s, %s' % (temps[num], regs[num]))
+    for i in reversed(range(top)):
+        lines += _shift_left(regs)
+        if digits[i] == 1:
+            lines += _add_chain('add', regs, temps)
+        elif digits[i] == -1:
+            lines += _add_chain('sub', regs, temps)
+    return lines
+
+def _mul_const(regs, value):
+    value &= (1 << (8 * len(regs))) - 1
+    if value == 0:
+        return ['move %s, 0' % r for r in regs]
+    (binary, csd) = _mul_digits(value)
+    lines = None
+    temps = scratch_registers[:len(regs)]
+    for digits in [binary, csd]:
+        if any(digits[:-1]) and (len(temps) < len(regs) or
+                                 any([r in temps for r in regs])):
+            continue
+        trial = _mul_horner(regs, digits, temps)
+        if lines is None or len(trial) < len(lines):
+            lines = trial
+    return lines
+
+def _div_reciprocal(reg, value, modulo):
+    #8 bit reg /= value as (reg * m) >> k, m has at most 9 bits.
+    #hi.lo gets the product, reg stays intact until the end
+    (hi, lo) = scratch_registers[:2]
+    best = None
+    for k in range(8, 18):
+        m = int(((1 << k) + value - 1) / value)
+        if m >= 512 or m & 0xFF == 0:
+            continue
+        if any([((x * m) >> k) != int(x / value) for x in range(256)]):
+            continue
+        for digits in _mul_digits(m & 0xFF):
+            lines = ['move %s, %s' % (lo, reg), 'move %s, 0' % hi]
+            for digit in reversed(digits[:-1]):
+                lines += _shift_left([lo, hi])
+                if digit:
+                    op = {1:'add', -1:'sub'}[digit]
+                    lines += _add_chain(op, [lo, hi], [reg, 0])
+            shifts = k - 8
+            if m >> 8:
+                #9th bit: add reg << 8, the carry out is bit 16
+                lines += ['add %s, %s' % (hi, reg), 'sra %s' % hi]
+                shifts -= 1
+            lines += ['sr0 %s' % hi] * shifts
+            if best is None or len(lines) < len(best):
+                best = lines
+
+    if not modulo:
+        return best + ['move %s, %s' % (reg, hi)]
+
+    #reg - quotient * value
+    mul = None
+    for digits in _mul_digits(value):
+        lines = ['move %s, %s' % (lo, hi)]
+        for digit in reversed(digits[:-1]):
+            lines.append('sl0 %s' % lo)
+            if digit:
+                lines.append('%s %s, %s' % ({1:'add', -1:'sub'}[digit], lo, hi))
+        if mul is None or len(lines) < len(mul):
+            mul = lines
+    return best + mul + ['sub %s, %s' % (reg, lo)]
+
+def _muldiv_unrolled():
+    if muldiv_unrolled is None:
+        return opt_level == '2'
+    return muldiv_unrolled
+
+def _runtime_registers(n):
+    #(a, b, result, counter) of the runtime routine for n byte operands
+    need = 3 * n + (0 if _muldiv_unrolled() else 1)
+    if len(scratch_registers) < need:
+        msg = '%d bit multiply/divide needs %d scratch registers, have %s (see --scratch)' % \
+                (8 * n, need, ', '.join(scratch_registers))
+        raise ParseException(msg)
+    regs = scratch_registers
+    return (regs[0:n], regs[n:2*n], regs[2*n:3*n], regs[3*n:need])
+
+def runtime_routine(kind, n):
+    #__mulN: a * b -> result, __divN: a / b -> a, a % b -> result.
+    #a and b are destroyed
+    (a, b, result, counter) = _runtime_registers(n)
+    name = '__%s%d' % (kind, 8 * n)
+    lines = ['%s:' % name]
+    lines += ['load %s, 0' % r for r in result]
+    if counter:
+        lines.append('load %s, %d' % (counter[0], 8 * n))
+    rounds = 1 if counter else 8 * n
+
+    for i in range(rounds):
+        loop = 'L_%s%d_loop%s' % (kind, 8 * n, '' if counter else i)
+        lines.append('%s:' % loop)
+        if kind == 'mul':
+            #shift-and-add, lowest bit of b first
+            skip = 'L_%s%d_shift%s' % (kind, 8 * n, '' if counter else i)
+            lines += _shift_right(b)
+            lines.append('jump NC, %s' % skip)
+            lines += _add_chain('add', result, a)
+            lines.append('%s:' % skip)
+            if counter or i < rounds - 1:
+                lines += _shift_left(a)
+        else:
+            #restoring division, a shifts into the remainder
+            suffix = '' if counter else str(i)
+            force = 'L_%s%d_force%s' % (kind, 8 * n, suffix)
+            one = 'L_%s%d_one%s' % (kind, 8 * n, suffix)
+            zero = 'L_%s%d_zero%s' % (kind, 8 * n, suffix)
+            lines += _shift_left(a + result)
+            lines.append('jump C, %s' % force)
+            lines += _add_chain('sub', result, b)
+            lines.append('jump NC, %s' % one)
+            lines += _add_chain('add', result, b)
+            lines.append('jump %s' % zero)
+            lines.append('%s:' % force)
+            lines += _add_chain('sub', result, b)
+            lines.append('%s:' % one)
+            lines.append('or %s, 1' % a[0])
+            lines.append('%s:' % zero)
+        if counter:
+            lines.append('sub %s, 1' % counter[0])
+            lines.append('jump NZ, %s' % loop)
+    lines.append('return')
+    return lines
+
+def _runtime_cost(kind, n):
+    #(ROM words, worst case clocks) of a runtime routine
+    lines = runtime_routine(kind, n)
+    words = len([l for l in lines if not l.endswith(':')])
+    instructions = words
+    loop = [idx for idx in range(len(lines)) if lines[idx].endswith('_loop:')]
+    if len(loop) == 1:
+        #the loop body goes round once per bit
+        body = len([l for l in lines[loop[0]:-1] if not l.endswith(':')])
+        instructions += body * (8 * n - 1)
+    return (words, instructions_cost(instructions)[1])
+
+def _muldiv_inline(regs, operands, lines, kind):
+    #True if inline lines beat calling the runtime routine
+    n = len(regs)
+    try:
+        call = _muldiv_call(kind, regs, operands, '')
+    except ParseException:
+        return True
+    (words, clocks) = instructions_cost(len(lines))
+    (call_words, call_clocks) = instructions_cost(len(call))
+    (routine_words, routine_clocks) = _runtime_cost(kind, n)
+    return opt_score(words, clocks) <= \
+            opt_score(call_words + routine_words, call_clocks + routine_clocks)
+
+def muldiv(assign_type, param0, param1):
+    #return (asm lines, runtime routine needed or None) for *=, /=, %=
+    regs = param0.split('.')
+    regs.reverse()
+    n = len(regs)
+    if type(param1) == str:
+        operands = param1.split('.')
+        operands.reverse()
+        if len(operands) > n:
+            msg = '"%s %s %s" has a wider operand than result' % (param0, assign_type, param1)
+            raise ParseException(msg)
+        operands += [0] * (n - len(operands))
+    else:
+        if param1 < 0:
+            msg = 'only unsigned multiply/divide: "%s %s %d"' % (param0, assign_type, param1)
+            raise ParseException(msg)
+        if assign_type != '*=' and param1 == 0:
+            msg = 'division by zero: "%s %s 0"' % (param0, assign_type)
+            raise ParseException(msg)
+        operands = [(param1 >> (8 * num)) & 0xFF for num in range(n)]
+        if assign_type == '*=':
+            lines = _mul_const(regs, param1)
+            if lines is not None and _muldiv_inline(regs, operands, lines, 'mul'):
+                return (lines, None)
+        elif param1 >= (1 << (8 * n)):
+            if assign_type == '/=':
+                return (['move %s, 0' % r for r in regs], None)
+            return ([], None)
+        elif param1 & (param1 - 1) == 0:
+            #powers of two are shifts and masks
+            shifts = param1.bit_length() - 1
+            if assign_type == '/=':
+                return (_shift_right(regs) * shifts, None)
+            mask = param1 - 1
+            return (['and %s, %d' % (regs[num], (mask >> (8 * num)) & 0xFF)
+                     for num in range(n) if (mask >> (8 * num)) & 0xFF != 0xFF], None)
+        elif n == 1 and len(scratch_registers) >= 2 and \
+                regs[0] not in scratch_registers[:2]:
+            lines = _div_reciprocal(regs[0], param1, assign_type == '%=')
+            if _muldiv_inline(regs, operands, lines, 'div'):
+                return (lines, None)
+
+    kind = 'mul' if assign_type == '*=' else 'div'
+    return (_muldiv_call(kind, regs, operands, assign_type), (kind, n))
+
+def _muldiv_call(kind, regs, operands, assign_type):
+    n = len(regs)
+    (a, b, result, counter) = _runtime_registers(n)
+    used = a + b + result + counter
+    for reg in regs + operands:
+        if reg in used:
+            msg = '%s can\'t be an operand of %s, it is a scratch register' % (reg, assign_type)
+            raise ParseException(msg)
+    lines = []
+    for num in range(n):
+        lines.append('move %s, %s' % (a[num], regs[num]))
+    for num in range(n):
+        lines.append('move %s, %s' % (b[num], operands[num]))
+    lines.append('call __%s%d' % (kind, 8 * n))
+    src = a if assign_type == '/=' else result
+    for num in range(n):
+        lines.append('move %s, %s' % (regs[num], src[num]))
+    return lines
+
+def _const_tables_used(map_function):
+    used = []
+    for name in map_function:
+        for label, block in map_function[name]:
+            for level, lineno, t, code in block:
+                if t == 'funccall' and code[0] == 'rom_fetch' and \
+                        code[1][0] in const_tables and code[1][0] not in used:
+                    used.append(code[1][0])
+    return used
+
+def _const_layout(used):
+    #scratchpad address of each table, for targets without load&return.
+    #They're copied to the top of it at boot.
+    const_base = {}
+    for name in reversed(used):
+        const_base[name] = _scratchpad_place(name, len(const_tables[name]), None,
+                                             lambda a, b: True, 'const', True)
+    for name in used:
+        print('const table %s at scratchpad 0x%02X-0x%02X' % \
+                (name, const_base[name],
+                 const_base[name] + len(const_tables[name]) - 1))
+    return const_base
+
+def condition_instructions(compare, param0, param1, line):
+    #instructions that set the flags for a single comparison, returned
+    #as (compare, instructions, flag if true, flag if false). When both
+    #sides are constants compare comes back as 'always' or 'never' and
+    #there's nothing to test.
+    inverted = False
+    if compare[0] == '$':
+        inverted = True
+        compare = compare[1:]
+        if super_verbose == True:
+            print("inverted ", end=' ')
+
+    if super_verbose == True:
+        print("compare ", compare, " param0 ", param0, " param1 ", param1)
+    # Readability hacks.
+    # Also make more clear what's failing.
+    # These operations aren't natively supported.
+    if compare == '>' or compare == '<=':
+        if super_verbose == True:
+            print("Op %s is not natively supported" % compare)
+            print("Trying to transform it.")
+            print("Param0", param0, "type", type(param0))
+            print("Param1", param1, "type", type(param1))
+        # case str/str is register compare, we can't
+        # do anything easily, we would need a double-flag
+        if (type(param0) == str and \
+            type(param1) == str):
+            print("Register/register compare op", compare,
+                  "cannot be trivially transformed")
+        elif (type(param0) == str and \
+              type(param1) == int):
+            print("converting", "!" if inverted else "",
+                  param0, compare, param1)
+            param1 = param1 + 1
+            if compare == '>':
+                # this is sX > KK (e.g. val > 50)
+                compare = '<'
+                inverted = True if not inverted else False
+            else:
+                # this is sX <= KK (e.g. val <= 50)
+                compare = '<'
+            print("converted to", "!" if inverted else "",
+                  param0, compare, param1)
+    #check if const value
+    # Wait, wait, this is insane. If it's constant
+    # just convert it into either a nop or an unconditional jump.
+    if type(param0) == int and \
+            type(param1) == int:
+        res = {'val':0}
+        text = 'val = %s %s %s' % (param0, compare, param1)
+        exec(text, {}, res)
+        if (res['val'] == True or res['val'] != 0) != inverted:
+            return ('always', [], None, None)
+        return ('never', [], None, None)
+    elif type(param0) == int and \
+            type(param1) != int:
+        msg = 'Param0 must be register when Param1 is digit! "%s"' % \
+                (str(line))
+        raise ParseException(msg)
+
+    instructions = []
+    if compare in ['==', '!=', '<', '>=']:
+        if param0 == 'Z' or param0 == 'C':
+            if super_verbose == True:
+                print("condition check: ", param0, compare, param1)
+            if param1 != 0 or compare == '<' or compare == '>=':
+                msg = 'Condition checks are only == 0 or != 0'
+                raise ParseException(msg)
+            # we can handle the inversion here
+            if inverted:
+                if compare == '==':
+                    compare = '!='
+                else:
+                    compare = '=='
+                inverted = False
+
+        # check double register compare
+        # I should extend this to arbitrary length.
+        elif len(param0.split('.')) > 1:
+            regs = param0.split('.')
+            # reverse the regs order, since they're specified MSB-first
+            regs.reverse()
+            operands = []
+            nregs = len(param0.split('.'))
+            print("multi-register compare: %d regs" % nregs)
+            if type(param1) == str:
+                if len(param1.split('.')) != nregs:
+                    msg = 'Multi-register operations need equal # of operands "%s"' % (str(line))
+                    raise ParseException(msg)
+                operands = param1.split('.')
+                # reverse operands order
+                operands.reverse()
+            else:
+                for num in range(nregs):
+                    operands.append((param1 >> 8*num) & 0xFF)
+            print("regs: ", regs)
+            print("operands: ", operands)
+            for num in range(nregs):
+                if num == 0:
+                    instructions.append('compare %s, %s' % (regs[num], str(operands[num])))
+                else:
+                    instructions.append('comparecy %s, %s' % (regs[num], str(operands[num])))
+        else:
+            instructions.append('compare %s, %s' % (str(param0), str(param1)))
+    # ^ is the opposite of & for a bit test
+    elif compare in ['&','^']:
+        instructions.append('test %s, %s' % (str(param0), str(param1)))
+    elif compare in ['--']:
+        if len(param0.split('.')) > 1:
+            print("multi register subtract-test:", param0, compare)
+            regs = param0.split('.')
+            regs.reverse()
+            for num in range(len(regs)):
+                if num == 0:
+                    instructions.append('sub %s, 1' % (str(regs[num])))
+                else:
+                    instructions.append('subcy %s, 0' % (str(regs[num])))
+        else:
+            if super_verbose == True:
+                print("subtract-test")
+            instructions.append('sub %s, 1' % (str(param0)))
+
+    if param0 =='Z' or param0 == 'C':
+        if compare == '==':
+            # equal zero
+            flage_t = 'N'+param0
+            flage_f = param0
+        else:
+            flage_t = param0
+            flage_f = 'N'+param0
+    elif compare == '==':
+        flage_t = 'Z'
+        flage_f = 'NZ'
+    elif compare == '!=':
+        flage_t = 'NZ'
+        flage_f = 'Z'
+    elif compare == '<':
+        flage_t = 'C'
+        flage_f = 'NC'
+    elif compare == '>=':
+        flage_t = 'NC'
+        flage_f = 'C'
+    #test
+    elif compare == '&':
+        flage_t = 'NZ'
+        flage_f = 'Z'
+    elif compare == '^':
+        flage_t = 'Z'
+        flage_f = 'NZ'
+    elif compare == '--':
+        if super_verbose == True:
+            print("subtract-test: ", end=' ')
+        # carry test: this is s0--. True if not C.
+        if param1 == -1:
+            if super_verbose == True:
+                print("test-subtract")
+            flage_t = 'NC'
+            flage_f = 'C'
+        # carry test: this is !(s0--). True if C.
+        elif param1 == -2:
+            if super_verbose == True:
+                print("test-subtract inverted")
+            flage_t = 'C'
+            flage_f = 'NC'
+        elif param1 == 1:
+            # inverted: matches if Z, fails if NZ
+            if super_verbose == True:
+                print("subtract-test inverted")
+            flage_t = 'Z'
+            flage_f = 'NZ'
+        else:
+            # if (--s0) matches if NZ, fails if Z
+            flage_t = 'NZ'
+            flage_f = 'Z'
+    else:
+        msg = 'Not support "%s"' % str(line)
+        raise ParseException(msg)
+
+    if inverted:
+        (flage_t, flage_f) = (flage_f, flage_t)
+    return (compare, instructions, flage_t, flage_f)
+
+def condition_text(code):
+    #'s0 == 1 && (s1 < 2 || s2 & 4)' for the listing
+    if code[0] not in ['&&', '||']:
+        return '%s %s %s' % (code[1], code[0], code[2])
+    text = []
+    for node in code[1:3]:
+        if node[0] in ['&&', '||'] and node[0] != code[0]:
+            text.append('(%s)' % condition_text(node))
+        else:
+            text.append(condition_text(node))
+    return (' %s ' % code[0]).join(text)
+
+def condition_leaves(code, label_t, label_f, prefix):
+    #short-circuit && and || into single comparisons, as a list of
+    #[label, comparison, label if true, label if false]. Every leaf
+    #but the last has one of its labels on the next leaf, so it only
+    #needs one jump, and the last one picks label_t or label_f.
+    leaves = []
+    count = [0]
+    def walk(node, lt, lf, label):
+        if node[0] not in ['&&', '||']:
+            leaves.append([label, node[:3], lt, lf])
+            return
+        count[0] += 1
+        label_b = '%s_c%d' % (prefix, count[0])
+        if node[0] == '&&':
+            walk(node[1], label_b, lf, label)
+        else:
+            walk(node[1], lt, label_b, label)
+        walk(node[2], lt, lf, label_b)
+    walk(code, label_t, label_f, None)
+    return leaves
+
 def generate_assembly(map_function, map_attribute, f=sys.stdout):
     isr_num = {}
     isr_table = {}
     isr_routine = {}
 
+    delay_id = 0
+    runtime_used = []
+    const_used = _const_tables_used(map_function)
+    const_base = {}
+    if target != 'kcpsm6':
+        const_base = _const_layout(const_used)
+
     if super_verbose == True:
         for name in map_function:
             print("Found function: %s" % name)
@@ -1242,6 +3166,19 @@ def generate_assembly(map_function, map_attribute, f=sys.stdout):
     f.write('\n')
     f.write('address 0x000')
     f.write('\n')
+    #no load&return, copy const tables to scratchpad before anything runs
+    if len(const_base):
+        if vivado_boot_fix == True:
+            f.write('; Vivado Hardware Manager workaround - avoid corruption at address 3\n')
+            f.write('  load s0, s0 ;keep\n')
+            f.write('  load s0, s0 ;keep\n')
+            f.write('  load s0, s0 ;keep\n')
+            f.write('  load s0, s0 ;keep\n')
+        f.write(';const tables\n')
+        for name in const_used:
+            for i in range(len(const_tables[name])):
+                f.write('  load %s, %d\n' % (scratch_registers[0], const_tables[name][i]))
+                f.write('  store %s, %d\n' % (scratch_registers[0], const_base[name] + i))
     #support init/no init style
     keylist = list(map_function.keys())
     if "init" in list(map_function.keys()):
@@ -1400,6 +3337,12 @@ def generate_assembly(map_function, map_attribute, f=sys.stdout):
                     f.write('\n')
                     continue
 
+                elif t in ['endinline']:
+                    f.write('  '*level)
+                    f.write('  ;end of inlined %s' % code[0])
+                    f.write('\n')
+                    continue
+
                 elif t in ['break', 'continue']:
                     f.write('  ' * level)
                     f.write('  ;%s' % (t))
@@ -1474,7 +3417,7 @@ def generate_assembly(map_function, map_attribute, f=sys.stdout):
                     elif code[0] in ['__asm__', 'asm', 'assembly']:
                         f.write('  ' * level)
                         inline_asm = re.search(r'"(.+)"', code[1][0]).groups()[0]
-                        f.write('  %s' % inline_asm)
+                        f.write('  %s ;psm' % inline_asm)
                         f.write('\n')
                     elif code[0] == 'psm':
                         #split text
@@ -1492,7 +3435,90 @@ def generate_assembly(map_function, map_attribute, f=sys.stdout):
                             i += 1
 
                         f.write('  ' * level)
-                        f.write('  %s' % inline_asm)
+                        f.write('  %s ;psm' % inline_asm)
+                        f.write('\n')
+                    elif code[0] == '__delay_cycles':
+                        clocks = code[1][0]
+                        regs = code[1][1:] or scratch_registers
+                        if type(clocks) != int or clocks < 0:
+                            msg = '__delay_cycles needs a constant number of clocks: "%s"' % \
+                                (str(line))
+                            raise ParseException(msg)
+                        for reg in regs:
+                            if type(reg) != str or not re.match(r'^%s$' % REGISTER, reg):
+                                msg = '__delay_cycles scratch must be registers: "%s"' % \
+                                    (str(line))
+                                raise ParseException(msg)
+                        asm = delay_cycles(clocks, regs, '%s_d%d_' % (lable, delay_id))
+                        delay_id += 1
+                        f.write('  ' * level)
+                        f.write('  ;__delay_cycles(%d), %d words' % \
+                                (clocks + clocks % 2,
+                                 len([l for l in asm if not l.endswith(':')])))
+                        f.write('\n')
+                        for text in asm:
+                            f.write('  ' * level)
+                            if text.endswith(':'):
+                                f.write(' %s' % text)
+                            else:
+                                #timing is exact, passes keep their hands off
+                                f.write('  %s ;keep' % text)
+                            f.write('\n')
+                    elif code[0] == 'rom_fetch':
+                        if len(code[1]) != 3 or code[1][0] not in const_tables or \
+                           type(code[1][2]) != str or \
+                           not re.match(r'^%s$' % REGISTER, code[1][2]):
+                            msg = 'rom_fetch needs a const table, an index and a register: "%s"' % \
+                                (str(line))
+                            raise ParseException(msg)
+                        (table, index, reg) = code[1]
+                        values = const_tables[table]
+                        sel = scratch_registers[0]
+                        if type(index) == int:
+                            if index >= len(values):
+                                msg = 'rom_fetch index out of range: "%s"' % (str(line))
+                                raise ParseException(msg)
+                            asm = ['move %s, %d' % (reg, values[index])]
+                        elif target == 'kcpsm6':
+                            #call into the table, load&return hands back sF
+                            for r in [index, reg]:
+                                if r in scratch_registers:
+                                    msg = 'rom_fetch can\'t use scratch register %s (see --scratch): "%s"' % \
+                                        (r, str(line))
+                                    raise ParseException(msg)
+                            asm = ["load %s, %s'upper" % (sel, table)]
+                            if index != reg:
+                                asm.append('move %s, %s' % (reg, index))
+                            asm.append("add %s, %s'lower" % (reg, table))
+                            asm.append('addcy %s, 0' % sel)
+                            asm.append('call@ (%s, %s)' % (sel, reg))
+                            asm.append('move %s, %s' % (reg, sel))
+                        else:
+                            asm = []
+                            if index != reg:
+                                asm.append('move %s, %s' % (reg, index))
+                            asm.append('add %s, %d' % (reg, const_base[table]))
+                            asm.append('fetch %s, (%s)' % (reg, reg))
+                        for text in asm:
+                            f.write('  ' * level)
+                            f.write('  %s' % text)
+                            f.write('\n')
+                    elif code[0] == '__loop_bound':
+                        #for pblaze-as --wcet
+                        if len(code[1]) != 1 or type(code[1][0]) != int or code[1][0] < 0:
+                            msg = '__loop_bound needs a constant: "%s"' % (str(line))
+                            raise ParseException(msg)
+                        f.write('  ' * level)
+                        f.write('  ;#!bound %d' % code[1][0])
+                        f.write('\n')
+                    elif code[0] == 'shared':
+                        #a marker for save_interrupt_context()
+                        for reg in code[1]:
+                            if type(reg) != str or not re.match(r'^s[0-9A-F]$', reg):
+                                msg = 'shared needs registers: "%s"' % (str(line))
+                                raise ParseException(msg)
+                        f.write('  ' * level)
+                        f.write('  ;shared %s' % ', '.join(code[1]))
                         f.write('\n')
                     elif code[0] in labels or code[0] in map_function:
                         f.write('  ' * level)
@@ -1504,93 +3530,79 @@ def generate_assembly(map_function, map_attribute, f=sys.stdout):
 
                 elif t in ['if', 'else if', 'while', 'dowhile', 'singlewhile',
                            'ifreturn', 'ifcall', 'ifgoto']:
-                    compare = code[0]
-                    param0  = code[1]
-                    param1  = code[2]
-                    
-                    inverted = False
-                    if compare[0] == '$':
-                        inverted = True
-                        compare = compare[1:]
-                        if super_verbose == True:
-                            print("inverted ", end=' ')
-                        
-                    if super_verbose == True:
-                        print("compare ", compare, " param0 ", param0, " param1 ", param1)
-                    # Readability hacks.
-                    # Also make more clear what's failing.
-                    # These operations aren't natively supported.
-                    if compare == '>' or compare == '<=':
-                        if super_verbose == True:
-                            print("Op %s is not natively supported" % compare)
-                            print("Trying to transform it.")
-                            print("Param0", param0, "type", type(param0))
-                            print("Param1", param1, "type", type(param1))
-                        # case str/str is register compare, we can't
-                        # do anything easily, we would need a double-flag
-                        if (type(param0) == str and \
-                            type(param1) == str):
-                            print("Register/register compare op", compare,
-                                  "cannot be trivially transformed")
-                        elif (type(param0) == str and \
-                              type(param1) == int):
-                            print("converting", "!" if inverted else "",
-                                  param0, compare, param1)
-                            param1 = param1 + 1
-                            if compare == '>':
-                                # this is sX > KK (e.g. val > 50)
-                                compare = '<'
-                                inverted = True if not inverted else False
-                            else:
-                                # this is sX <= KK (e.g. val <= 50)
-                                compare = '<'
-                            print("converted to", "!" if inverted else "",
-                                  param0, compare, param1)
-                    #check if const value
-                    # Wait, wait, this is insane. If it's constant
-                    # just convert it into either a nop or an unconditional jump. 
-                    if type(param0) == int and \
-                            type(param1) == int:
-                        res = {'val':0}
-                        text = 'val = %s %s %s' % (param0, compare, param1)
-                        exec(text, {}, res)
-                        if res['val'] == True or res['val'] != 0:
-                            if inverted:
-                                compare = 'never'
-                            else:
-                                compare = 'always'
-#                            param0  = 's0'
-#                            if inverted:
-#                                compare = '!='
-#                            else:
-#                                compare = '=='
-#                            param1  = 's0'
-                        else:
-                            if inverted:
-                                compare = "always"
-                            else:
-                                compare = "never"
-#                            param0  = 's0'
-#                            if inverted:
-#                                compare = '=='
-#                            else:
-#                                compare = '!='
-#                            param1  = 's0'
-                    elif type(param0) == int and \
-                            type(param1) != int:
-                        msg = 'Param0 must be register when Param1 is digit! "%s"' % \
-                                (str(line))
-                        raise ParseException(msg)
-
                     label_t = code[3]
                     label_f = code[4]
 
                     f.write('  ' * level)
-                    f.write('  ;%s (%s %s %s), %s, %s' % \
-                            (t, param0, compare, param1, label_t, label_f))
+                    f.write('  ;%s (%s), %s, %s' % \
+                            (t, condition_text(code), label_t, label_f))
                     f.write('\n')
 
-                    f.write('  ' * level)
+                    # these are transformed blocks: label_t is a
+                    # function or a label, or gone for ifreturn
+                    if t not in ['ifreturn', 'ifcall', 'ifgoto'] and \
+                            idx_block + 1 < len(lst_block):
+                        #check jump-jump
+                        label_bb = label_f
+                        while True:
+                            block_next_idx = find_blockidx_of_label(lst_block, label_bb)
+                            block_next = lst_block[block_next_idx][1][0]
+                            if block_next[IDX_TYPE] == 'ifjoin':
+                                label_bb = block_next[IDX_CODE][-1]
+                            else:
+                                break
+                        label_f = label_bb
+
+                        label_bb = label_t
+                        while True:
+                            block_next_idx = find_blockidx_of_label(lst_block, label_bb)
+                            block_next = lst_block[block_next_idx][1][0]
+                            if block_next[IDX_TYPE] == 'ifjoin':
+                                label_bb = block_next[IDX_CODE][-1]
+                            else:
+                                break
+                        label_t = label_bb
+
+                    # && and ||: every comparison but the last either
+                    # jumps straight to where the answer goes or falls
+                    # into the next comparison
+                    leaves = condition_leaves(code, label_t, label_f, lable)
+                    for i in range(len(leaves)):
+                        label, leaf, leaf_t, leaf_f = leaves[i]
+                        # only needed if it's jumped to from further back
+                        if label in [x for j in range(i - 1) for x in leaves[j][2:]]:
+                            f.write('  ' * level)
+                            f.write('  %s:' % label)
+                            f.write('\n')
+                        (compare, instructions, flage_t, flage_f) = \
+                            condition_instructions(leaf[0], leaf[1], leaf[2], line)
+                        for text in instructions:
+                            f.write('  ' * level)
+                            f.write('  %s' % text)
+                            f.write('\n')
+                        if i == len(leaves) - 1:
+                            break
+
+                        if leaf_t == leaves[i + 1][0]:
+                            if compare == 'always':
+                                continue
+                            (condition, label_bb) = (flage_f, leaf_f)
+                        else:
+                            if compare == 'never':
+                                continue
+                            (condition, label_bb) = (flage_t, leaf_t)
+                        f.write('  ' * level)
+                        if compare in ['always', 'never']:
+                            if t == 'ifreturn' and label_bb == label_t:
+                                f.write('  return')
+                            else:
+                                f.write('  jump %s' % label_bb)
+                        elif t == 'ifreturn' and label_bb == label_t:
+                            f.write('  return %s' % condition)
+                        else:
+                            f.write('  jump %s, %s' % (condition, label_bb))
+                        f.write('\n')
+
                     # handle constants straight away
                     if compare in ['always', 'never']:
                         if t == 'ifreturn' or t == 'ifcall' or t == 'ifgoto':
@@ -1602,7 +3614,7 @@ def generate_assembly(map_function, map_attribute, f=sys.stdout):
                             if t == 'ifreturn':
                                 f.write('  ' * level)
                                 f.write('  return')
-                                f.write('\n')                                
+                                f.write('\n')
                                 continue
                             # n.b. we ALWAYS use label_t here regardless of inverted or not
                             if t == 'ifcall' or t == 'ifgoto':
@@ -1613,172 +3625,28 @@ def generate_assembly(map_function, map_attribute, f=sys.stdout):
                                 continue
                         # ok so now it's an unconditional jump to either true or false
                         f.write('  ' * level)
-                        f.write('  jump %s' % label_t if compare == 'always' else label_f)
+                        f.write('  jump %s' % (label_t if compare == 'always' else label_f))
                         f.write('\n')
                         continue
-                    elif compare in ['==', '!=', '<', '>=']:
-                        if param0 == 'Z' or param0 == 'C':
-                            if super_verbose == True:
-                                print("condition check: ", param0, compare, param1)
-                            if param1 != 0 or compare == '<' or compare == '>=':
-                                msg = 'Condition checks are only == 0 or != 0'
-                                raise ParseException(msg)
-                            # we can handle the inversion here
-                            if inverted:
-                                if compare == '==':
-                                    compare = '!='
-                                else:
-                                    compare = '=='
-                                inverted = False
-                            
-                        # check double register compare
-                        # I should extend this to arbitrary length.
-                        elif len(param0.split('.')) > 1:
-                            regs = param0.split('.')
-                            # reverse the regs order, since they're specified MSB-first
-                            regs.reverse()
-                            operands = []
-                            nregs = len(param0.split('.'))
-                            print("multi-register compare: %d regs" % nregs)
-                            if type(param1) == str:
-                                if len(param1.split('.')) != nregs:
-                                    msg = 'Multi-register operations need equal # of operands "%s"' % (str(line))
-                                    raise ParseException(msg)
-                                operands = param1.split('.')
-                                # reverse operands order
-                                operands.reverse()
-                            else:
-                                for num in range(nregs):
-                                    operands.append((param1 >> 8*num) & 0xFF)
-                            print("regs: ", regs)
-                            print("operands: ", operands)
-                            for num in range(nregs):
-                                if num == 0:
-                                    f.write('  compare %s, %s' % (regs[num], str(operands[num])))
-                                else:
-                                    f.write('\n')
-                                    f.write('  ' * level)
-                                    f.write('  comparecy %s, %s' % (regs[num], str(operands[num])))        
-                        else:
-                            f.write('  compare %s, %s' % (str(param0), str(param1)))
-                    # ^ is the opposite of & for a bit test
-                    elif compare in ['&','^']:
-                        f.write('  test %s, %s' % (str(param0), str(param1)))
-                    elif compare in ['--']:
-                        if len(param0.split('.')) > 1:
-                            print("multi register subtract-test:", param0, compare)
-                            regs = param0.split('.')
-                            regs.reverse()
-                            for num in range(len(regs)):
-                                if num == 0:                                    
-                                    f.write('  sub %s, 1' % (str(regs[num])))
-                                else:
-                                    f.write('\n')
-                                    f.write('  ' * level)
-                                    f.write('  subcy %s, 0' % (str(regs[num])))
-                        else:
-                            if super_verbose == True:
-                                print("subtract-test")
-                            f.write('  sub %s, 1' % (str(param0)))
-                        
-                    f.write('\n')
-
-                    if param0 =='Z' or param0 == 'C':
-                        if compare == '==':
-                            # equal zero
-                            flage_t = 'N'+param0
-                            flage_f = param0
-                        else:
-                            flage_t = param0
-                            flage_f = 'N'+param0
-                    elif compare == '==':
-                        flage_t = 'Z'
-                        flage_f = 'NZ'
-                    elif compare == '!=':
-                        flage_t = 'NZ'
-                        flage_f = 'Z'
-                    elif compare == '<':
-                        flage_t = 'C'
-                        flage_f = 'NC'
-                    elif compare == '>=':
-                        flage_t = 'NC'
-                        flage_f = 'C'
-                    #test
-                    elif compare == '&':
-                        flage_t = 'NZ'
-                        flage_f = 'Z'
-                    elif compare == '^':
-                        flage_t = 'Z'
-                        flage_f = 'NZ'
-                    elif compare == '--':
-                        if super_verbose == True:
-                            print("subtract-test: ", end=' ')
-                        # carry test: this is s0--. True if not C.
-                        if param1 == -1:
-                            if super_verbose == True:
-                                print("test-subtract")
-                            flage_t = 'NC'
-                            flage_f = 'C'
-                        # carry test: this is !(s0--). True if C.
-                        elif param1 == -2:
-                            if super_verbose == True:
-                                print("test-subtract inverted")
-                            flage_t = 'C'
-                            flage_f = 'NC'
-                        elif param1 == 1:
-                            # inverted: matches if Z, fails if NZ
-                            if super_verbose == True:
-                                print("subtract-test inverted")
-                            flage_t = 'Z'
-                            flage_f = 'NZ'
-                        else:
-                            # if (--s0) matches if NZ, fails if Z
-                            flage_t = 'NZ'
-                            flage_f = 'Z'
-                    else:
-                        msg = 'Not support "%s"' % str(line)
-                        raise ParseException(msg)
 
                     #optimize jump
                     # these optimizations are transformed blocks:
                     # they're not condition jumps, they're conditional
                     # returns or function calls.
                     if t == 'ifreturn':
-                        condition = flage_t if not inverted else flage_f
                         f.write('  ' * level)
-                        f.write('  return %s' % condition)
+                        f.write('  return %s' % flage_t)
                         f.write('\n')
                         continue
                     elif t == 'ifcall' or t == 'ifgoto':
                         # ifcalls just map to 
                         opStr = 'call' if t == 'ifcall' else 'jump'
-                        condition = flage_t if not inverted else flage_f
                         f.write('  ' * level)
-                        f.write('  %s %s, %s' % (opStr, condition, label_t))
+                        f.write('  %s %s, %s' % (opStr, flage_t, label_t))
                         f.write('\n')
                         continue
                     elif idx_block + 1 < len(lst_block):
                         next_block_label = lst_block[idx_block + 1][0]
-                        #check jump-jump
-                        label_bb = label_f
-                        while True:
-                            block_next_idx = find_blockidx_of_label(lst_block, label_bb)
-                            block_next = lst_block[block_next_idx][1][0]
-                            if block_next[IDX_TYPE] == 'ifjoin':
-                                label_bb = block_next[IDX_CODE][-1]
-                            else:
-                                break
-                        label_f = label_bb
-
-                        label_bb = label_t
-                        while True:
-                            block_next_idx = find_blockidx_of_label(lst_block, label_bb)
-                            block_next = lst_block[block_next_idx][1][0]
-                            if block_next[IDX_TYPE] == 'ifjoin':
-                                label_bb = block_next[IDX_CODE][-1]
-                            else:
-                                break
-                        label_t = label_bb
 
                         if next_block_label == label_f:
                             f.write('  ' * level)
@@ -1800,6 +3668,18 @@ def generate_assembly(map_function, map_attribute, f=sys.stdout):
                     f.write('  jump %s, %s' % (flage_t, label_t))
                     f.write('\n')
 
+                elif t == 'dispatch':
+                    f.write('  ' * level)
+                    f.write('  ;switch (%s)' % code[0])
+                    f.write('\n')
+                    for text in switch_dispatch(code[0], code[1], code[2], code[3]):
+                        f.write('  ' * level)
+                        if text.endswith(':'):
+                            f.write(' %s' % text)
+                        else:
+                            f.write('  %s' % text)
+                        f.write('\n')
+
                 elif t == 'goto':
                     f.write('  ' * level)
                     f.write('  ;end of while')
@@ -1812,7 +3692,15 @@ def generate_assembly(map_function, map_attribute, f=sys.stdout):
                     assign_type = code[0]
                     param0  = code[1]
                     param1  = code[2]
-                    if len(param0.split('.')) > 1:
+                    if assign_type in ['*=', '/=', '%=']:
+                        (asm, routine) = muldiv(assign_type, param0, param1)
+                        if routine and routine not in runtime_used:
+                            runtime_used.append(routine)
+                        for text in asm:
+                            f.write('  ' * level)
+                            f.write('  %s' % text)
+                            f.write('\n')
+                    elif len(param0.split('.')) > 1:
                         # paired register math
                         print("multi register assembly:", param0, assign_type, param1)
                         regs = param0.split('.')
@@ -2015,6 +3903,36 @@ def generate_assembly(map_function, map_attribute, f=sys.stdout):
         f.write('\n')
         pass
 
+    #multiply/divide routines, only the ones something calls
+    for (kind, n) in runtime_used:
+        f.write(';%s' % ('-' * 60))
+        f.write('\n')
+        f.write(';runtime')
+        f.write('\n')
+        for text in runtime_routine(kind, n):
+            if text.startswith('__'):
+                f.write('%s' % text)
+            elif text.endswith(':'):
+                f.write(' %s' % text)
+            else:
+                f.write('  %s' % text)
+            f.write('\n')
+        f.write('\n')
+
+    #const tables, one load&return per byte
+    if target == 'kcpsm6':
+        for name in const_used:
+            f.write(';%s' % ('-' * 60))
+            f.write('\n')
+            f.write(';const table')
+            f.write('\n')
+            f.write('%s:' % name)
+            f.write('\n')
+            for v in const_tables[name]:
+                f.write('  load&return %s, %d ;keep' % (scratch_registers[0], v))
+                f.write('\n')
+            f.write('\n')
+
     f.write('\n')
     f.write(';ISR')
     f.write('\n')
@@ -2027,19 +3945,1823 @@ def generate_assembly(map_function, map_attribute, f=sys.stdout):
         f.write('\n')
     pass
 
+#
+# assembly post-processing
+#
+# generate_assembly() writes its output one statement at a time, so
+# anything that has to look across statements (flag tracking, etc.)
+# works on the generated text instead. Every line is split into an
+# AsmLine, the passes rewrite the list, and it's joined back together.
+#
+# Lines ending in ';psm' came from psm()/asm() and lines ending in
+# ';keep' are there on purpose (padding, workarounds). Passes never
+# touch them, and treat them as using and clobbering everything.
+#
+
+ASM_REGISTERS = ['s%X' % i for i in range(16)]
+ASM_FLAGS = ['Z', 'C']
+ASM_EVERYTHING = set(ASM_REGISTERS + ASM_FLAGS)
+
+ASM_LOAD_OPS = ['load', 'move', 'mov']
+ASM_ALU_OPS = ['and', 'or', 'xor', 'add', 'sub']
+ASM_CARRY_OPS = ['addcy', 'subcy']
+ASM_CMP_OPS = ['compare', 'test']
+ASM_CMPCY_OPS = ['comparecy', 'testcy']
+ASM_SHIFT_OPS = ['sla', 'rl', 'slx', 'sl0', 'sl1',
+                 'sra', 'srx', 'rr', 'sr0', 'sr1']
+ASM_CONDITIONS = ['Z', 'NZ', 'C', 'NC']
+
+class AsmLine(object):
+    def __init__(self, text):
+        self.text = text
+        self.indent = ''
+        self.label = None
+        self.op = None
+        self.args = []
+        self.comment = ''
+        self.fixed = False
+        self.modified = False
+        self.removed = None
+
+        res = re.match(r'^(\s*)([^;]*?)\s*(;.*)?$', text)
+        self.indent = res.groups()[0]
+        body = res.groups()[1]
+        if res.groups()[2]:
+            self.comment = res.groups()[2]
+
+        if len(body) == 0:
+            return
+
+        res = re.match(r'^(\w+):$', body)
+        if res:
+            self.label = res.groups()[0]
+            return
+
+        parts = body.split(None, 1)
+        self.op = parts[0].lower()
+        if len(parts) > 1:
+            rest = parts[1]
+            if self.op.endswith('@'):
+                rest = re.sub(r'[\(\)]', '', rest)
+            self.args = [a.strip() for a in rest.split(',')]
+        self.fixed = self.comment.replace(' ', '') in [';psm', ';keep']
+
+    def __str__(self):
+        if not self.modified:
+            return self.text
+        if self.op is None:
+            return '%s%s' % (self.indent, self.comment)
+        if self.op.endswith('@'):
+            text = '%s%s (%s)' % (self.indent, self.op, ', '.join(self.args))
+        elif len(self.args):
+            text = '%s%s %s' % (self.indent, self.op, ', '.join(self.args))
+        else:
+            text = '%s%s' % (self.indent, self.op)
+        if self.comment:
+            text += ' ' + self.comment
+        return text
+
+    def instruction(self):
+        if self.op is None:
+            return ''
+        if len(self.args):
+            return '%s %s' % (self.op, ', '.join(self.args))
+        return self.op
+
+    def remove(self, reason):
+        self.removed = (self.instruction(), reason)
+        self.comment = ';optimized away %s (%s)' % (self.instruction(), reason)
+        self.op = None
+        self.args = []
+        self.modified = True
+
+    def condition(self):
+        # flag condition of jump/call/return, if any
+        if self.op in ['jump', 'call'] and len(self.args) == 2:
+            return self.args[0].upper()
+        if self.op == 'return' and len(self.args) == 1:
+            return self.args[0].upper()
+        return None
+
+def _asm_register(tok):
+    # sX, or (sX) for indirect input/output/fetch/store, or a local's vN
+    res = re.match(r'^\(?s([0-9a-fA-F])\)?$', tok)
+    if res:
+        return 's' + res.groups()[0].upper()
+    res = re.match(r'^\(?(v[0-9]+)\)?$', tok)
+    if res:
+        return res.groups()[0]
+    return None
+
+def _asm_virtuals(text):
+    # local variable registers still waiting for allocate_registers()
+    return set(re.findall(r'\bv[0-9]+\b', text))
+
+def _asm_value(tok):
+    # same digit rules as pblaze-as: 0x.. hex, 0.. octal, else decimal
+    if type(tok) == int:
+        return tok
+    if re.match(r'^0[xX][0-9a-fA-F]+$', tok):
+        return int(tok, 16)
+    if re.match(r'^0[0-7]+$', tok):
+        return int(tok, 8)
+    if re.match(r'^-?[0-9]+$', tok):
+        return int(tok, 10)
+    res = re.match(r'^\'(\\?)(.)\'$', tok)
+    if res and not res.groups()[0]:
+        return ord(res.groups()[1])
+    return None
+
+def _asm_is_barrier(line):
+    if line.op is None:
+        return False
+    if line.fixed:
+        return True
+    return line.op not in ASM_LOAD_OPS + ASM_ALU_OPS + ASM_CARRY_OPS + \
+            ASM_CMP_OPS + ASM_CMPCY_OPS + ASM_SHIFT_OPS + \
+            ['star', 'input', 'fetch', 'output', 'outputk', 'store',
+             'jump', 'call', 'return', 'returni', 'hwbuild',
+             'load&return']
+
+def _asm_effects(line):
+    #return (uses, defs): sets of registers and flags
+    uses = set()
+    defs = set()
+    op = line.op
+    if op is None:
+        return (uses, defs)
+    if _asm_is_barrier(line):
+        return (ASM_EVERYTHING | _asm_virtuals(line.instruction()),
+                set(ASM_EVERYTHING))
+
+    regs = [_asm_register(a) for a in line.args]
+
+    if op in ASM_LOAD_OPS:
+        defs.add(regs[0])
+        if regs[1]:
+            uses.add(regs[1])
+    elif op == 'star':
+        if regs[1]:
+            uses.add(regs[1])
+    elif op in ASM_ALU_OPS + ASM_CARRY_OPS:
+        uses.add(regs[0])
+        if regs[1]:
+            uses.add(regs[1])
+        if op in ASM_CARRY_OPS:
+            uses.update(ASM_FLAGS)
+        defs.update([regs[0]] + ASM_FLAGS)
+    elif op in ASM_CMP_OPS + ASM_CMPCY_OPS:
+        uses.add(regs[0])
+        if regs[1]:
+            uses.add(regs[1])
+        if op in ASM_CMPCY_OPS:
+            uses.update(ASM_FLAGS)
+        defs.update(ASM_FLAGS)
+    elif op in ASM_SHIFT_OPS + ['hwbuild']:
+        uses.add(regs[0])
+        if op in ['sla', 'sra']:
+            uses.add('C')
+        defs.update([regs[0]] + ASM_FLAGS)
+    elif op in ['input', 'fetch']:
+        defs.add(regs[0])
+        if regs[1]:
+            uses.add(regs[1])
+    elif op in ['output', 'store']:
+        uses.add(regs[0])
+        if regs[1]:
+            uses.add(regs[1])
+    elif op == 'outputk':
+        pass
+    elif op == 'jump':
+        cond = line.condition()
+        if cond:
+            uses.add(cond[-1])
+    else:
+        # call, return, returni, load&return: whatever is in the
+        # registers might be an argument or a result.
+        uses.update(ASM_EVERYTHING)
+        if op == 'load&return':
+            defs.add(regs[0])
+
+    return (uses, defs)
+
+def _asm_label_map(lines):
+    map_label = {}
+    for idx in range(len(lines)):
+        if lines[idx].label:
+            map_label[lines[idx].label] = idx
+    return map_label
+
+def _asm_referenced_labels(lines):
+    referenced = set()
+    for line in lines:
+        if line.op is None:
+            continue
+        for arg in line.args:
+            referenced.add(arg)
+        if line.fixed:
+            # can't tell what inline assembly refers to
+            referenced.update(re.findall(r'\w+', line.text))
+    return referenced
+
+def _asm_successors(lines, idx, map_label):
+    #return list of successor index, None means "somewhere unknown"
+    line = lines[idx]
+    nexts = []
+    if idx + 1 < len(lines):
+        nexts = [idx + 1]
+
+    if line.op is None or line.op == 'call':
+        return nexts
+    if line.op == 'jump':
+        target = map_label.get(line.args[-1], None)
+        if line.condition():
+            return nexts + [target]
+        return [target]
+    if line.op in ['return', 'returni', 'jump@', 'load&return']:
+        if line.condition():
+            return nexts
+        return []
+    return nexts
+
+def _asm_functions(lines):
+    #return (map of function name to entry index, owning function of
+    #each line, map of function to its call sites, functions whose
+    #callers we can't see)
+    map_entry = {}
+    owner = []
+    name = None
+    for idx in range(len(lines)):
+        line = lines[idx]
+        if line.label is not None and line.indent == '' and \
+                not line.label.startswith('_end_'):
+            name = line.label
+            map_entry[name] = idx
+        owner.append(name)
+
+    callers = {}
+    unknown = set()
+    for idx in range(len(lines)):
+        line = lines[idx]
+        if line.op is None:
+            continue
+        if line.fixed:
+            unknown.update([n for n in re.findall(r'\w+', line.text)
+                            if n in map_entry])
+            continue
+        if len(line.args) == 0 or line.args[-1] not in map_entry:
+            continue
+        if line.op == 'call':
+            callers.setdefault(line.args[-1], []).append(idx)
+        elif owner[idx] != line.args[-1]:
+            # jumped into from somewhere else, returns go who knows where
+            unknown.add(line.args[-1])
+    for name in map_entry:
+        if name not in callers:
+            unknown.add(name)
+
+    return (map_entry, owner, callers, unknown)
+
+def _asm_interrupt_functions(lines):
+    #return (interrupt handlers, every function an interrupt can run)
+    (map_entry, owner, callers, unknown) = _asm_functions(lines)
+    handlers = set()
+    labels = {}
+    for idx in range(len(lines)):
+        if lines[idx].op == 'returni' and owner[idx] in map_entry:
+            handlers.add(owner[idx])
+        if lines[idx].label is not None:
+            labels[lines[idx].label] = owner[idx]
+
+    reachable = set(handlers)
+    todo = list(handlers)
+    while len(todo):
+        name = todo.pop()
+        for idx in range(len(lines)):
+            line = lines[idx]
+            if owner[idx] != name or line.op not in ['call', 'jump']:
+                continue
+            #a jump into the middle of another function runs it too
+            target = labels.get(line.args[-1])
+            if target in map_entry and target not in reachable:
+                reachable.add(target)
+                todo.append(target)
+
+    return (handlers, reachable)
+
+def _asm_interrupt_context(lines):
+    #return (shared, private): the registers interrupt code passes to
+    #and from the mainline (shared() in it), and the other ones it
+    #writes, which save_interrupt_context() keeps from the mainline
+    (map_entry, owner, callers, unknown) = _asm_functions(lines)
+    (handlers, reachable) = _asm_interrupt_functions(lines)
+    shared = set()
+    private = set()
+    for idx in range(len(lines)):
+        line = lines[idx]
+        if owner[idx] not in reachable or line.op == 'address':
+            continue
+        if line.op is None:
+            res = re.match(r'^;shared ((?:s[0-9A-F], )*s[0-9A-F])$', line.comment)
+            if res:
+                shared.update(res.groups()[0].split(', '))
+            continue
+        #inline assembly too, for what it really writes
+        copy = AsmLine(str(line))
+        copy.fixed = False
+        uses, defs = _asm_effects(copy)
+        private |= defs & set(ASM_REGISTERS)
+    if not isr_save:
+        return (shared, set())
+    return (shared, private - shared)
+
+def _asm_interrupt_clobbers(lines):
+    #registers an interrupt might change under the mainline's feet
+    (map_entry, owner, callers, unknown) = _asm_functions(lines)
+    (handlers, reachable) = _asm_interrupt_functions(lines)
+    (shared, private) = _asm_interrupt_context(lines)
+    clobbers = set()
+    for idx in range(len(lines)):
+        if owner[idx] in reachable and lines[idx].op != 'address':
+            uses, defs = _asm_effects(lines[idx])
+            clobbers |= defs - set(ASM_FLAGS)
+    return clobbers - private
+
+def _asm_stack_depths(lines):
+    #return (return addresses on the stack while each function runs,
+    #None if it's recursive; what an interrupt adds on top, 0 if none)
+    (map_entry, owner, callers, unknown) = _asm_functions(lines)
+    (handlers, reachable) = _asm_interrupt_functions(lines)
+    edges = []
+    for idx in range(len(lines)):
+        line = lines[idx]
+        if line.op not in ['call', 'jump'] or line.args[-1] not in map_entry:
+            continue
+        if owner[idx] == line.args[-1]:
+            continue
+        edges.append((owner[idx], line.args[-1], 1 if line.op == 'call' else 0))
+
+    depth = dict([(name, 0) for name in map_entry])
+    for i in range(len(map_entry) + 1):
+        changed = set()
+        for (caller, callee, push) in edges:
+            if caller in depth and depth[caller] + push > depth[callee]:
+                depth[callee] = depth[caller] + push
+                changed.add(callee)
+        if len(changed) == 0:
+            break
+    #still growing after every chain had its chance: recursion
+    for name in changed:
+        depth[name] = None
+
+    isr = 0
+    for name in reachable:
+        if depth[name] is None:
+            isr = None
+        elif isr is not None:
+            isr = max(isr, depth[name] + 1)
+    return (depth, isr)
+
+def _asm_liveness(lines, interrupted=None, escaped=None):
+    #return live-out set of each line
+    #
+    #calls and returns are followed into and out of the functions
+    #in this file, so a value only a caller needs stays alive up to
+    #the return, and a value the callee never reads dies at the call.
+    #
+    #anything an interrupt handler reads is live everywhere, the
+    #interrupt can come in at any point. What the interrupted code
+    #needs back from it (interrupted, by default whatever the handler
+    #doesn't keep to itself) is live at a returni. Where the code goes
+    #somewhere out of sight, escaped (by default everything) is live.
+    map_label = _asm_label_map(lines)
+    (map_entry, owner, callers, unknown) = _asm_functions(lines)
+    (handlers, reachable) = _asm_interrupt_functions(lines)
+    (shared, private) = _asm_interrupt_context(lines)
+    if interrupted is None:
+        interrupted = set(ASM_REGISTERS) - private
+    if escaped is None:
+        escaped = ASM_EVERYTHING
+    n = len(lines)
+    effects = [_asm_effects(line) for line in lines]
+    succs = [_asm_successors(lines, idx, map_label) for idx in range(n)]
+    live_in = [set() for idx in range(n)]
+    live_out = [set() for idx in range(n)]
+
+    changed = True
+    while changed:
+        changed = False
+        isr_live = set()
+        for name in handlers:
+            #a local is never the interrupt's to read, it only looks
+            #like it through a function both of them call
+            isr_live |= (live_in[map_entry[name]] & set(ASM_REGISTERS)) - private
+        for idx in reversed(range(n)):
+            line = lines[idx]
+            out = set(isr_live)
+            for s in succs[idx]:
+                if s is None:
+                    out = set(escaped)
+                    break
+                out |= live_in[s]
+
+            uses, defs = effects[idx]
+            cond = set()
+            if line.op is not None and line.condition():
+                cond.add(line.condition()[-1])
+
+            if line.fixed:
+                new_in = uses | (out - defs)
+            elif line.op == 'call' and line.args[-1] in map_entry:
+                # the callee may or may not write anything
+                new_in = live_in[map_entry[line.args[-1]]] | out | cond
+            elif line.op == 'return' and owner[idx] not in unknown:
+                new_in = out | cond
+                for c in callers[owner[idx]]:
+                    new_in |= live_out[c]
+            elif line.op == 'returni':
+                # flags come back from the interrupted code
+                new_in = set(interrupted)
+            else:
+                new_in = uses | (out - defs)
+
+            if new_in != live_in[idx] or out != live_out[idx]:
+                live_in[idx] = new_in
+                live_out[idx] = out
+                changed = True
+
+    return live_out
+
+#
+# flag tracking
+#
+# A flag "fact" says what Z or C currently holds:
+#   ('zero', (sX, ...))       Z: all of these registers are zero
+#   ('const', 0)              C: known value
+#   ('compare', sX, Y) etc.   result of that compare/test
+#   ('compare', fact, sX, Y)  chained comparecy/testcy result
+# Anything else is None (unknown).
+#
+
+def _flag_fact_mentions(fact, reg):
+    if fact is None:
+        return False
+    for elem in fact:
+        if elem == reg:
+            return True
+        if type(elem) == tuple and _flag_fact_mentions(elem, reg):
+            return True
+    return False
+
+def _flag_transfer(state, line):
+    (z, c) = state
+    op = line.op
+    if op is None:
+        return state
+    if _asm_is_barrier(line) or op in ['call', 'load&return']:
+        return (None, None)
+
+    uses, defs = _asm_effects(line)
+    for reg in defs:
+        if reg in ASM_FLAGS:
+            continue
+        if _flag_fact_mentions(z, reg):
+            z = None
+        if _flag_fact_mentions(c, reg):
+            c = None
+
+    if len(line.args) == 0:
+        return (z, c)
+    x = _asm_register(line.args[0])
+    y = None
+    if len(line.args) > 1:
+        y = _asm_register(line.args[1])
+        if y is None:
+            y = _asm_value(line.args[1])
+
+    if op in ASM_CMP_OPS:
+        if y is None:
+            return (None, None)
+        if (op == 'compare' and y == 0) or \
+           (op == 'test' and (y == x or y == 0xFF)):
+            z = ('zero', (x,))
+            if op == 'compare':
+                c = ('const', 0)
+            else:
+                c = (op, x, y)
+        else:
+            z = (op, x, y)
+            c = (op, x, y)
+    elif op in ASM_CMPCY_OPS:
+        if y is None:
+            return (None, None)
+        if op == 'comparecy' and y == 0 and c == ('const', 0) and \
+           z is not None and z[0] == 'zero':
+            z = ('zero', z[1] + (x,))
+        elif z is not None and c is not None:
+            z = (op, z, c, x, y)
+            c = (op, c, x, y)
+        else:
+            z = None
+            c = None
+    elif op in ['and', 'or', 'xor']:
+        z = ('zero', (x,))
+        c = ('const', 0)
+    elif op in ['add', 'sub'] + ASM_SHIFT_OPS:
+        z = ('zero', (x,))
+        c = None
+    elif op in ASM_CARRY_OPS:
+        # kcpsm6 chains Z through addcy/subcy, kcpsm3 doesn't
+        if target == 'kcpsm3':
+            z = ('zero', (x,))
+        elif z is not None and z[0] == 'zero':
+            z = ('zero', z[1] + (x,))
+        else:
+            z = None
+        c = None
+    elif op == 'hwbuild':
+        z = None
+        c = ('const', 1)
+
+    return (z, c)
+
+def optimize_flags(lines):
+    live_out = _asm_liveness(lines)
+    referenced = _asm_referenced_labels(lines)
+    volatile = _asm_interrupt_clobbers(lines)
+    state = (None, None)
+    removed = 0
+
+    idx = 0
+    while idx < len(lines):
+        line = lines[idx]
+        if line.label is not None:
+            # labels at column 0 are entry points
+            if line.label in referenced or line.indent == '':
+                state = (None, None)
+            idx += 1
+            continue
+        if line.op is None:
+            idx += 1
+            continue
+        if line.op == 'address':
+            state = (None, None)
+            idx += 1
+            continue
+
+        if line.op in ASM_CMP_OPS and not line.fixed:
+            #collect compare/comparecy chain
+            chain = [idx]
+            nxt = idx + 1
+            while nxt < len(lines):
+                if lines[nxt].op is None and lines[nxt].label is None:
+                    nxt += 1
+                    continue
+                if lines[nxt].op in ASM_CMPCY_OPS and not lines[nxt].fixed:
+                    chain.append(nxt)
+                    nxt += 1
+                    continue
+                break
+
+            result = (None, None)
+            for i in chain:
+                result = _flag_transfer(result, lines[i])
+
+            live = live_out[chain[-1]]
+            redundant = True
+            for i in chain:
+                uses, defs = _asm_effects(lines[i])
+                if len(uses & volatile) and ('Z' in live or 'C' in live):
+                    # an interrupt may have changed it since
+                    redundant = False
+            if 'Z' in live and (result[0] is None or result[0] != state[0]):
+                redundant = False
+            if 'C' in live and (result[1] is None or result[1] != state[1]):
+                redundant = False
+
+            if redundant:
+                reason = 'flags already set'
+                if 'Z' not in live and 'C' not in live:
+                    reason = 'flags not used'
+                for i in chain:
+                    lines[i].remove(reason)
+                    removed += 1
+            else:
+                state = result
+            idx = chain[-1] + 1
+            continue
+
+        state = _flag_transfer(state, line)
+        if line.op in ['jump', 'return', 'returni', 'jump@'] and \
+           line.condition() is None:
+            state = (None, None)
+        idx += 1
+
+    if removed:
+        print('flag tracking: removed %d compare/test instruction(s)' % removed)
+    return removed
+
+#
+# constant propagation / dead stores
+#
+
+def _asm_evaluate(op, x, y):
+    #value of sX after "op sX, y", or None if it depends on the flags
+    if op in ASM_LOAD_OPS:
+        return y
+    if op == 'and':
+        return x & y
+    if op == 'or':
+        return x | y
+    if op == 'xor':
+        return x ^ y
+    if op == 'add':
+        return (x + y) & 0xFF
+    if op == 'sub':
+        return (x - y) & 0xFF
+    if op == 'sl0':
+        return (x << 1) & 0xFF
+    if op == 'sl1':
+        return ((x << 1) | 1) & 0xFF
+    if op == 'slx':
+        return ((x << 1) | (x & 1)) & 0xFF
+    if op == 'rl':
+        return ((x << 1) | (x >> 7)) & 0xFF
+    if op == 'sr0':
+        return x >> 1
+    if op == 'sr1':
+        return (x >> 1) | 0x80
+    if op == 'srx':
+        return (x >> 1) | (x & 0x80)
+    if op == 'rr':
+        return (x >> 1) | ((x & 1) << 7)
+    return None
+
+def _asm_constant_transfer(state, line):
+    op = line.op
+    if op is None:
+        return state
+    if _asm_is_barrier(line) or op in ['call', 'load&return']:
+        return {}
+
+    uses, defs = _asm_effects(line)
+    regs = [r for r in defs if r not in ASM_FLAGS]
+    if len(regs) == 0:
+        return state
+
+    new_state = dict(state)
+    x = regs[0]
+    value = None
+    if op in ASM_LOAD_OPS + ASM_ALU_OPS or op in ASM_SHIFT_OPS:
+        y = None
+        if len(line.args) > 1:
+            y = _asm_register(line.args[1])
+            if y is not None:
+                y = state.get(y, None)
+            else:
+                y = _asm_value(line.args[1])
+        if op in ASM_LOAD_OPS:
+            if y is not None:
+                value = y & 0xFF
+        elif x in state and (y is not None or op in ASM_SHIFT_OPS):
+            value = _asm_evaluate(op, state[x], y)
+
+    if value is None:
+        new_state.pop(x, None)
+    else:
+        new_state[x] = value
+    return new_state
+
+def _asm_constant_states(lines):
+    #return known register values in front of each line
+    referenced = _asm_referenced_labels(lines)
+    volatile = _asm_interrupt_clobbers(lines)
+    states = []
+    state = {}
+    for line in lines:
+        if line.label is not None:
+            if line.label in referenced or line.indent == '':
+                state = {}
+        elif line.op == 'address':
+            state = {}
+        states.append(state)
+        state = _asm_constant_transfer(state, line)
+        for reg in volatile:
+            state.pop(reg, None)
+        if line.op in ['jump', 'return', 'returni', 'jump@'] and \
+           line.condition() is None:
+            state = {}
+    return states
+
+def optimize_constants(lines):
+    states = _asm_constant_states(lines)
+    removed = 0
+    for idx in range(len(lines)):
+        line = lines[idx]
+        if line.op not in ASM_LOAD_OPS or line.fixed:
+            continue
+        x = _asm_register(line.args[0])
+        y = _asm_register(line.args[1])
+        if x == y:
+            # load sX, sX is how you write a nop, leave it
+            continue
+        state = states[idx]
+        if y is not None:
+            value = state.get(y, None)
+        else:
+            value = _asm_value(line.args[1])
+        if value is not None and state.get(x, None) == (value & 0xFF):
+            line.remove('%s already %d' % (x, value & 0xFF))
+            removed += 1
+    if removed:
+        print('constant propagation: removed %d load(s)' % removed)
+    return removed
+
+#outputk only has 4 bits of port
+OUTPUTK_MAX_PORT = 15
+
+def optimize_output(lines):
+    #output of a known constant: outputk if the port fits, else the
+    #lowest register that holds the same value, so the load can go
+    states = _asm_constant_states(lines)
+    changed = 0
+    for idx in range(len(lines)):
+        line = lines[idx]
+        if line.op != 'output' or line.fixed:
+            continue
+        x = _asm_register(line.args[0])
+        port = _asm_value(line.args[1])
+        state = states[idx]
+        if x not in state or port is None:
+            continue
+        value = state[x]
+        if cost('outputk') and port <= OUTPUTK_MAX_PORT:
+            line.op = 'outputk'
+            line.args = ['%d' % value, line.args[1]]
+            line.comment = ';was output %s' % x
+            line.modified = True
+            changed += 1
+            continue
+        same = sorted([reg for reg in state if state[reg] == value],
+                      key=lambda reg: int(reg[1:], 16))
+        if same[0] != x:
+            line.args[0] = same[0]
+            line.comment = ';was output %s' % x
+            line.modified = True
+            changed += 1
+    if changed:
+        print('output: rewrote %d constant output(s)' % changed)
+    return changed
+
+def optimize_dead_stores(lines):
+    live_out = _asm_liveness(lines)
+    removed = 0
+    for idx in range(len(lines)):
+        line = lines[idx]
+        if line.op is None or line.fixed:
+            continue
+        # input can have side effects on the port, keep it
+        if line.op not in ASM_LOAD_OPS + ASM_ALU_OPS + ASM_CARRY_OPS + \
+                ASM_SHIFT_OPS + ['fetch']:
+            continue
+        if line.op in ASM_LOAD_OPS and \
+           _asm_register(line.args[0]) == _asm_register(line.args[1]):
+            continue
+        uses, defs = _asm_effects(line)
+        if len(defs & live_out[idx]) == 0:
+            line.remove('result not used')
+            removed += 1
+    if removed:
+        print('dead store elimination: removed %d instruction(s)' % removed)
+    return removed
+
+def optimize_jumps(lines):
+    #a jump to the very next instruction does nothing
+    removed = 0
+    for idx in range(len(lines)):
+        line = lines[idx]
+        if line.op != 'jump' or line.fixed:
+            continue
+        nxt = idx + 1
+        while nxt < len(lines) and lines[nxt].op is None:
+            if lines[nxt].label == line.args[-1]:
+                line.remove('next instruction')
+                removed += 1
+                break
+            nxt += 1
+    if removed:
+        print('jump optimization: removed %d jump(s)' % removed)
+    return removed
+
+def _asm_unconditional(line):
+    #nothing falls through past this line
+    return line.op in ['jump', 'return', 'returni', 'jump@', 'load&return'] and \
+            not line.condition()
+
+def _fold_signature(lines, name, indices, refs_outside):
+    #body of a function with its own labels numbered, None if it
+    #can't be folded
+    map_local = {name: '@self'}
+    for idx in indices:
+        if lines[idx].label:
+            if lines[idx].label in refs_outside:
+                return None
+            map_local[lines[idx].label] = '@%d' % len(map_local)
+    body = []
+    last = None
+    for idx in indices:
+        line = lines[idx]
+        if line.op is None:
+            if line.label:
+                body.append(map_local[line.label] + ':')
+            continue
+        body.append((line.op, tuple([map_local.get(a, a) for a in line.args])))
+        last = line
+    #falls into the next function, where it is matters
+    if last is None or not _asm_unconditional(last):
+        return None
+    return tuple(body)
+
+def fold_functions(lines):
+    #functions with identical bodies: keep one, calls to the others go
+    #to it and their names stay behind as labels. Returns the new lines
+    (map_entry, owner, callers, unknown) = _asm_functions(lines)
+    by_function = {}
+    for idx in range(len(lines)):
+        if owner[idx] in map_entry and idx > map_entry[owner[idx]]:
+            by_function.setdefault(owner[idx], []).append(idx)
+
+    #labels anybody outside the function refers to
+    refs = {}
+    for idx in range(len(lines)):
+        line = lines[idx]
+        if line.op is None:
+            continue
+        words = line.args
+        if line.fixed:
+            words = re.findall(r'\w+', line.text)
+        for word in words:
+            refs.setdefault(word, set()).add(owner[idx])
+
+    kept = {}
+    aliases = {}
+    for name in sorted(map_entry, key=lambda n: map_entry[n]):
+        if name not in by_function or 'balanced' in function_hints.get(name, []):
+            continue
+        outside = set([label for label in refs if len(refs[label] - set([name]))])
+        sig = _fold_signature(lines, name, by_function[name], outside - set([name]))
+        if sig is None:
+            continue
+        if sig not in kept:
+            kept[sig] = name
+            continue
+        aliases.setdefault(kept[sig], []).append(name)
+        for line in lines:
+            if line.op is not None and not line.fixed and \
+                    line.args and line.args[-1] == name:
+                line.args[-1] = kept[sig]
+                line.modified = True
+        for idx in by_function[name]:
+            line = lines[idx]
+            if line.op is not None:
+                line.remove('same as %s' % kept[sig])
+            elif line.label:
+                line.comment = ';%s: same as %s' % (line.label, kept[sig])
+                line.label = None
+                line.modified = True
+        lines[map_entry[name]].comment = ';folded into %s' % kept[sig]
+        lines[map_entry[name]].label = None
+        lines[map_entry[name]].modified = True
+        print('folded %s into %s' % (name, kept[sig]))
+
+    if len(aliases) == 0:
+        return lines
+    result = []
+    for idx in range(len(lines)):
+        result.append(lines[idx])
+        if lines[idx].label in aliases and idx == map_entry[lines[idx].label]:
+            #indented, it's not a function of its own anymore
+            result += [AsmLine(' %s:' % name) for name in aliases[lines[idx].label]]
+    return result
+
+def _tail(lines, idx, stops):
+    #straight line code ending at idx, last first, as (line index,
+    #labels right before it). Labels in stops end it
+    tail = []
+    labels = []
+    prev = idx - 1
+    while prev >= 0:
+        line = lines[prev]
+        if line.fixed or line.label in stops:
+            break
+        if line.label:
+            labels.append(line.label)
+        elif line.op is not None:
+            if _asm_unconditional(line):
+                break
+            tail.append((idx, labels))
+            idx = prev
+            labels = []
+        prev -= 1
+    tail.append((idx, labels))
+    return tail
+
+def _retarget(lines, labels, target):
+    for line in lines:
+        if line.op is not None and line.args and line.args[-1] in labels:
+            line.args[-1] = target
+            line.modified = True
+
+def cross_jump(lines):
+    #identical tails: all but one copy jump into the one that's left.
+    #Returns the new lines
+    (map_entry, owner, callers, unknown) = _asm_functions(lines)
+    (handlers, reachable) = _asm_interrupt_functions(lines)
+    skip = set([name for name in map_entry
+                if 'balanced' in function_hints.get(name, [])])
+    ends = {}
+    for idx in range(len(lines)):
+        line = lines[idx]
+        if line.op in ['jump', 'return'] and _asm_unconditional(line) and \
+                not line.fixed and owner[idx] not in skip:
+            ends.setdefault(line.instruction(), []).append(idx)
+
+    #labels that can't be moved: functions and whatever inline
+    #assembly mentions
+    stops = set(map_entry)
+    for line in lines:
+        if line.fixed:
+            stops.update(re.findall(r'\w+', line.text))
+
+    (jump_words, jump_clocks) = instructions_cost(1)
+    entry = {}
+    merged = 0
+    for key in ends:
+        keepers = []
+        for idx in ends[key]:
+            tail = _tail(lines, idx, stops)
+            best = None
+            for keeper in keepers:
+                #interrupt code saves what it writes, the mainline doesn't
+                if (owner[idx] in reachable) != (owner[keeper[0][0]] in reachable):
+                    continue
+                length = 0
+                while length < min(len(tail), len(keeper)) and \
+                        lines[tail[length][0]].instruction() == \
+                        lines[keeper[length][0]].instruction():
+                    length += 1
+                if length >= 2 and (best is None or length > best[0]):
+                    best = (length, keeper)
+            if best is None:
+                keepers.append(tail)
+                continue
+
+            (length, keeper) = best
+            (start, labels_in) = tail[length - 1]
+            #reached only through labels: point them at the keeper and
+            #it's free, else it costs a jump
+            prev = start - 1
+            while prev >= 0 and lines[prev].op is None:
+                prev -= 1
+            free = prev >= 0 and _asm_unconditional(lines[prev]) and \
+                    len(labels_in) and \
+                    all([lines[i].label in [None] + labels_in for i in range(prev + 1, start)])
+            if free:
+                saved = length
+                clocks = 0
+            else:
+                saved = length - jump_words
+                clocks = jump_clocks
+            if opt_score(-saved, clocks) >= 0:
+                keepers.append(tail)
+                continue
+
+            target = keeper[length - 1][0]
+            entry.setdefault(target, 'L_xj_%d' % target)
+            #labels in the middle of the tail go to the same spot
+            for pos in range(length - 1):
+                if any([line.op is not None and line.args and
+                        line.args[-1] in tail[pos][1] for line in lines]):
+                    entry.setdefault(keeper[pos][0], 'L_xj_%d' % keeper[pos][0])
+                    _retarget(lines, tail[pos][1], entry[keeper[pos][0]])
+            for (idx2, labels) in tail[:length]:
+                lines[idx2].remove('same as %s' % entry[target])
+            if free:
+                _retarget(lines, labels_in, entry[target])
+            else:
+                first = lines[start]
+                first.op = 'jump'
+                first.args = [entry[target]]
+                first.comment = ';the rest is the same as %s' % entry[target]
+                first.removed = None
+            merged += 1
+
+    if merged == 0:
+        return lines
+    print('cross jumping: merged %d tail(s)' % merged)
+    result = []
+    for idx in range(len(lines)):
+        if idx in entry:
+            result.append(AsmLine(' %s:' % entry[idx]))
+        result.append(lines[idx])
+    return result
+
+#procedural abstraction: repeated straight line code turns into a call
+#to a shared copy. Only these are moved, none of them touch the flow
+#of control, and call/return leave the flags alone.
+OUTLINE_OPS = ASM_LOAD_OPS + ASM_ALU_OPS + ASM_CARRY_OPS + ASM_CMP_OPS + \
+        ASM_CMPCY_OPS + ASM_SHIFT_OPS + \
+        ['input', 'fetch', 'output', 'outputk', 'store']
+#longest sequence worth looking for
+OUTLINE_MAX = 32
+
+def _outline_runs(lines, owner, skip):
+    #lists of line indices of straight line code, labels split them
+    runs = []
+    run = []
+    for idx in range(len(lines)):
+        line = lines[idx]
+        if line.op is None and line.label is None:
+            continue
+        if line.op in OUTLINE_OPS and not line.fixed and \
+                owner[idx] not in skip and \
+                (len(run) == 0 or owner[run[0]] == owner[idx]):
+            run.append(idx)
+            continue
+        if len(run) >= 2:
+            runs.append(run)
+        run = []
+        if line.op in OUTLINE_OPS and not line.fixed and owner[idx] not in skip:
+            run = [idx]
+    if len(run) >= 2:
+        runs.append(run)
+    return runs
+
+def _outline_best(lines, runs, owner, room):
+    #(score, sequence, occurrences) of the best thing to outline, or None
+    found = {}
+    for run in runs:
+        if room.get(owner[run[0]], 0) < 1:
+            continue
+        texts = [lines[idx].instruction() for idx in run]
+        for start in range(len(run) - 1):
+            for length in range(2, min(OUTLINE_MAX, len(run) - start) + 1):
+                key = tuple(texts[start:start + length])
+                found.setdefault(key, []).append(run[start:start + length])
+
+    (call_words, call_clocks, call_stack) = cost('call')
+    best = None
+    for key in found:
+        if len(found[key]) < 2:
+            continue
+        #in line order, no overlaps
+        sites = []
+        for site in sorted(found[key]):
+            if len(sites) and site[0] <= sites[-1][-1]:
+                continue
+            sites.append(site)
+        if len(sites) < 2:
+            continue
+        (words, clocks) = instructions_cost(len(key))
+        #each site shrinks to a call, the copy needs a return
+        saved = len(sites) * (words - call_words) - words - call_words
+        score = opt_score(-saved, len(sites) * call_clocks)
+        if score < 0 and (best is None or score < best[0]):
+            best = (score, key, sites)
+    return best
+
+def outline_functions(lines):
+    #move repeated sequences into shared subroutines, return new lines
+    outlined = []
+    while True:
+        (map_entry, owner, callers, unknown) = _asm_functions(lines)
+        (depth, isr) = _asm_stack_depths(lines)
+        if isr is None:
+            break
+        #stack slots each function still has for one more call, and
+        #one spare in case the call lands in interrupt code
+        limit = TARGET_COSTS[target]['stack_depth'] - isr
+        if isr:
+            limit -= 1
+        room = {}
+        for name in map_entry:
+            if depth[name] is not None:
+                room[name] = limit - depth[name] - 1
+        skip = set([name for name in map_entry
+                    if 'balanced' in function_hints.get(name, []) or
+                    name.startswith('__out')])
+        best = _outline_best(lines, _outline_runs(lines, owner, skip), owner, room)
+        if best is None:
+            break
+
+        (score, key, sites) = best
+        name = '__out%d' % len(outlined)
+        for site in sites:
+            first = lines[site[0]]
+            for idx in site[1:]:
+                lines[idx].remove('outlined into %s' % name)
+            first.comment = ';outlined: %s' % first.instruction()
+            first.op = 'call'
+            first.args = [name]
+            first.modified = True
+        print('outlined %d instructions into %s at %d sites' % (len(key), name, len(sites)))
+        outlined.append((name, key))
+
+    if len(outlined) == 0:
+        return lines
+    #before the interrupt vectors, they have to stay at the end
+    isr = len(lines)
+    for idx in range(len(lines)):
+        if lines[idx].comment == ';ISR':
+            isr = idx
+    body = []
+    for (name, key) in outlined:
+        body.append(AsmLine(';%s' % ('-' * 60)))
+        body.append(AsmLine(';outlined'))
+        body.append(AsmLine('%s:' % name))
+        body += [AsmLine('  %s' % text) for text in key]
+        body.append(AsmLine('  return'))
+        body.append(AsmLine(''))
+    return lines[:isr] + body + lines[isr:]
+
+#__attribute__((balanced)): every path through the function takes the
+#same number of instructions, padded with this
+BALANCE_NOP = 'load s0, s0 ;keep'
+
+def _balance_spans(lines, start, end):
+    #__delay_cycles expansions are loops of a known length, each one is
+    #a single step: index of its comment -> (instructions, next index)
+    spans = {}
+    idx = start
+    while idx < end:
+        res = None
+        if lines[idx].op is None:
+            res = re.match(r'^;__delay_cycles\((\d+)\), (\d+) words', lines[idx].comment)
+        if res is None:
+            idx += 1
+            continue
+        words = int(res.groups()[1])
+        nxt = idx + 1
+        while words:
+            if lines[nxt].op is not None:
+                words -= 1
+            nxt += 1
+        spans[idx] = (int(int(res.groups()[0]) / 2), nxt)
+        idx = nxt
+    return spans
+
+def _balance_sole_entry(lines, idx_label, refs):
+    #True if the jump to this label is the only way to get there
+    if refs.get(lines[idx_label].label, 0) != 1:
+        return False
+    idx = idx_label - 1
+    while idx >= 0 and lines[idx].op is None:
+        if lines[idx].label and refs.get(lines[idx].label, 0):
+            return False
+        idx -= 1
+    if idx < 0:
+        return False
+    prev = lines[idx]
+    if prev.condition():
+        return False
+    return prev.op in ['jump', 'return', 'returni', 'jump@', 'load&return']
+
+def _balance_function(lines, name, funcs, costs, busy, plan):
+    #longest path (in instructions) from the entry of name to its
+    #return, adding what it takes to make every other path as long to
+    #plan as (kind, line index, nops)
+    if name in costs:
+        return costs[name]
+    if name in busy:
+        raise ParseException('balanced function "%s" is recursive' % name)
+    busy.add(name)
+
+    (map_entry, owner, map_label) = funcs
+    start = map_entry[name]
+    end = start
+    while end < len(lines) and owner[end] == name:
+        end += 1
+    spans = _balance_spans(lines, start, end)
+    inside = set()
+    for idx in spans:
+        inside.update(range(idx + 1, spans[idx][1]))
+
+    def fail(idx, why):
+        msg = 'can\'t balance "%s": %s at "%s"' % (name, why, lines[idx].text.strip())
+        raise ParseException(msg)
+
+    #None: falls out of the function, only an error if it's reachable
+    dist = {}
+    def after(idx, nxt):
+        if nxt >= end or dist[nxt] is None:
+            fail(idx, 'falls through')
+        return dist[nxt]
+    def jump_target(idx):
+        target = lines[idx].args[-1]
+        if target == name:
+            return None
+        nxt = map_label.get(target, None)
+        if nxt is None or nxt < start or nxt >= end:
+            fail(idx, 'leaves the function')
+        if nxt <= idx:
+            fail(idx, 'loop')
+        return nxt
+
+    for idx in reversed(range(start, end)):
+        if idx in inside:
+            continue
+        line = lines[idx]
+        cond = line.condition()
+        if idx in spans:
+            (n, nxt) = spans[idx]
+            dist[idx] = n + after(idx, nxt)
+        elif line.op is None:
+            dist[idx] = dist.get(idx + 1, None)
+        elif line.op == 'jump':
+            nxt = jump_target(idx)
+            taken = 0 if nxt is None else after(idx, nxt)
+            if cond is None:
+                dist[idx] = 1 + taken
+                continue
+            fall = after(idx, idx + 1)
+            dist[idx] = 1 + max(taken, fall)
+            if fall < taken:
+                plan.append(('fall', idx, taken - fall))
+            elif taken < fall:
+                plan.append(('taken', idx, fall - taken))
+        elif line.op == 'return':
+            dist[idx] = 1
+            if cond:
+                #jump to a padded return instead
+                fall = after(idx, idx + 1)
+                dist[idx] = 1 + fall
+                plan.append(('return', idx, fall - 1))
+        elif line.op == 'call':
+            callee = line.args[-1]
+            if cond or 'balanced' not in function_hints.get(callee, []) or \
+               callee not in map_entry:
+                fail(idx, 'call to something that isn\'t balanced')
+            cost = _balance_function(lines, callee, funcs, costs, busy, plan)
+            dist[idx] = 1 + cost + after(idx, idx + 1)
+        elif line.op in ['returni', 'jump@', 'call@', 'load&return']:
+            fail(idx, 'unknown timing')
+        else:
+            dist[idx] = 1 + after(idx, idx + 1)
+
+    busy.remove(name)
+    costs[name] = dist[start]
+    return costs[name]
+
+def balance_functions(lines):
+    #pad every __attribute__((balanced)) function, return the new lines
+    (map_entry, owner, callers, unknown) = _asm_functions(lines)
+    map_label = _asm_label_map(lines)
+    names = [name for name in map_entry
+             if 'balanced' in function_hints.get(name, [])]
+    if len(names) == 0:
+        return lines
+
+    costs = {}
+    plan = []
+    for name in names:
+        _balance_function(lines, name, (map_entry, owner, map_label),
+                          costs, set(), plan)
+
+    refs = {}
+    for line in lines:
+        if line.op is None:
+            continue
+        words = line.args
+        if line.fixed:
+            words = re.findall(r'\w+', line.text)
+        for word in words:
+            refs[word] = refs.get(word, 0) + 1
+
+    def nops(indent, n):
+        return [AsmLine(indent + BALANCE_NOP) for i in range(n)]
+
+    insert = {}
+    stubs = {}
+    padded = {}
+    for (kind, idx, n) in plan:
+        line = lines[idx]
+        padded[owner[idx]] = padded.get(owner[idx], 0) + n
+        if kind == 'fall':
+            insert.setdefault(idx, []).extend(nops(line.indent, n))
+            continue
+        target = map_label.get(line.args[-1], None)
+        if kind == 'taken' and _balance_sole_entry(lines, target, refs):
+            insert.setdefault(target, []).extend(nops(line.indent, n))
+            continue
+        #a detour through a few nops at the end of the function
+        stub = 'L_bal_%d' % idx
+        body = [AsmLine(' %s:' % stub)]
+        if kind == 'return':
+            body += nops(line.indent, n)
+            body.append(AsmLine(line.indent + 'return'))
+            line.args = [line.condition(), stub]
+            line.op = 'jump'
+        else:
+            body += nops(line.indent, n - 1)
+            body.append(AsmLine(line.indent + 'jump %s' % line.args[-1]))
+            line.args[-1] = stub
+        line.modified = True
+        stubs.setdefault(owner[idx], []).extend(body)
+
+    for name in stubs:
+        last = max([idx for idx in range(len(lines))
+                    if owner[idx] == name and lines[idx].op is not None])
+        insert.setdefault(last, []).extend(stubs[name])
+
+    for name in names:
+        clocks = costs[name] * 2
+        if name == 'loop':
+            print('balanced %s: %d clocks per iteration, %d nop(s) added' % \
+                    (name, clocks, padded.get(name, 0)))
+        else:
+            print('balanced %s: %d clocks per call, %d nop(s) added' % \
+                    (name, clocks, padded.get(name, 0)))
+
+    result = []
+    for idx in range(len(lines)):
+        result.append(lines[idx])
+        result += insert.get(idx, [])
+    return result
+
+#
+# local variables
+#
+# Every byte of a local variable is a virtual register vN until the
+# whole program is assembly and its liveness is known. Then two locals
+# that are never alive at the same time can share a register: color
+# the interference graph with s0-sE (less the --scratch registers and
+# whatever an interrupt handler writes). A local left without a color
+# lives in the scratchpad, fetched into a free register around each
+# instruction that touches it.
+#
+
+def _asm_call_clobbers(lines, effects, map_entry, owner):
+    #registers each function, or anything it calls, might write
+    clobbers = dict([(name, set()) for name in map_entry])
+    edges = []
+    for idx in range(len(lines)):
+        line = lines[idx]
+        if owner[idx] not in clobbers:
+            continue
+        uses, defs = effects[idx]
+        clobbers[owner[idx]] |= defs - set(ASM_FLAGS)
+        if line.op not in ['call', 'jump']:
+            continue
+        if line.args[-1] in map_entry:
+            edges.append((owner[idx], line.args[-1]))
+        elif line.op == 'call':
+            clobbers[owner[idx]] |= set(ASM_REGISTERS)
+
+    changed = True
+    while changed:
+        changed = False
+        for (caller, callee) in edges:
+            if not clobbers[callee] <= clobbers[caller]:
+                clobbers[caller] |= clobbers[callee]
+                changed = True
+    return clobbers
+
+def _asm_rename_virtuals(line, args, comment):
+    #args(vN) and comment(vN.vM...) say what the virtual registers become
+    if line.op is None and line.label is not None:
+        return
+    if line.op is not None:
+        new = [re.sub(r'\bv[0-9]+\b', lambda res: args(res.group(0)), a)
+               for a in line.args]
+        if new != line.args:
+            line.args = new
+            line.modified = True
+    new = re.sub(r'\bv[0-9]+(?:\.v[0-9]+)*\b',
+                 lambda res: comment(res.group(0)), line.comment)
+    if new != line.comment:
+        line.comment = new
+        line.modified = True
+
+def _local_text(regs):
+    #source name of virtual register(s) 'vB.vA', for comments
+    regs = regs.split('.')
+    if not all([r in local_registers for r in regs]):
+        return '.'.join(regs)
+    (function, name, byte, size) = local_registers[regs[0]]
+    whole = [local_registers[r][:2] == (function, name) for r in regs]
+    if len(regs) == size and all(whole) and \
+            [local_registers[r][2] for r in regs] == list(reversed(range(size))):
+        return name
+    names = []
+    for r in regs:
+        (function, name, byte, size) = local_registers[r]
+        names.append(name if size == 1 else '%s[%d]' % (name, byte))
+    return '.'.join(names)
+
+def _locals_split(lines, owner):
+    #an inlined function's locals are different variables in every
+    #function it got inlined into
+    first = {}
+    rename = {}
+    for idx in range(len(lines)):
+        if lines[idx].op is None:
+            continue
+        for reg in sorted(_asm_virtuals(lines[idx].instruction())):
+            first.setdefault(reg, owner[idx])
+            if first[reg] != owner[idx] and (owner[idx], reg) not in rename:
+                fresh = 'v%d' % len(local_registers)
+                local_registers[fresh] = local_registers[reg]
+                rename[(owner[idx], reg)] = fresh
+
+    if len(rename) == 0:
+        return
+    for idx in range(len(lines)):
+        new = lambda reg: rename.get((owner[idx], reg), reg)
+        _asm_rename_virtuals(lines[idx], new,
+                             lambda regs: '.'.join([new(r) for r in regs.split('.')]))
+
+def allocate_registers(lines):
+    #return lines with every local variable in a physical register or
+    #the scratchpad
+    if not any([line.op is not None and _asm_virtuals(line.instruction())
+                for line in lines]):
+        return lines
+    (map_entry, owner, callers, unknown) = _asm_functions(lines)
+    _locals_split(lines, owner)
+
+    #inline assembly is a barrier to the optimizer, but here what it
+    #reads and writes has to be exact
+    view = []
+    for line in lines:
+        copy = AsmLine(str(line))
+        copy.fixed = False
+        view.append(copy)
+    effects = [_asm_effects(line) for line in view]
+    clobbers = _asm_call_clobbers(view, effects, map_entry, owner)
+    (handlers, reachable) = _asm_interrupt_functions(view)
+    isr_clobbers = _asm_interrupt_clobbers(view) & set(ASM_REGISTERS)
+    #an interrupt handler has to give its shared() registers back (all
+    #of them with --no-isr-save), but the code it interrupts only cares
+    #about what the handler reads
+    (shared, private) = _asm_interrupt_context(view)
+    live_out = _asm_liveness(view, shared if isr_save else ASM_REGISTERS)
+    mainline = _asm_liveness(view, [])
+    for idx in range(len(view)):
+        if owner[idx] not in reachable:
+            live_out[idx] = mainline[idx]
+
+    #interference: whatever a line writes is in the way of everything
+    #alive after it, except a move's source (they hold the same value)
+    graph = {}
+    local_owner = {}
+    weight = {}
+    partners = {}
+    for idx in range(len(view)):
+        line = view[idx]
+        if line.op is None:
+            continue
+        for reg in _asm_virtuals(line.instruction()):
+            graph.setdefault(reg, set())
+            local_owner[reg] = owner[idx]
+            weight[reg] = weight.get(reg, 0) + 1
+            if lines[idx].comment.replace(' ', '') == ';keep':
+                #timed code, a fetch or store would throw it off
+                weight[reg] = float('inf')
+
+    for idx in range(len(view)):
+        line = view[idx]
+        if line.op in [None, 'address']:
+            continue
+        uses, defs = effects[idx]
+        defs = defs - set(ASM_FLAGS)
+        if line.op == 'call':
+            defs = defs | clobbers.get(line.args[-1], set(ASM_REGISTERS))
+        source = None
+        if line.op in ASM_LOAD_OPS:
+            source = _asm_register(line.args[1])
+            if source is not None:
+                partners.setdefault(line.args[0], []).append(source)
+                partners.setdefault(source, []).append(line.args[0])
+        for d in defs:
+            for l in live_out[idx] - set(ASM_FLAGS):
+                if d == l or l == source:
+                    continue
+                if d in graph:
+                    graph[d].add(l)
+                if l in graph:
+                    graph[l].add(d)
+
+    colors = {}
+    for reg in graph:
+        colors[reg] = [r for r in ASM_REGISTERS if r not in scratch_registers and
+                       r not in graph[reg]]
+        if local_owner[reg] not in reachable:
+            colors[reg] = [r for r in colors[reg] if r not in isr_clobbers]
+
+    #simplify: anything with fewer neighbors than colors can always be
+    #colored later. When nothing is, the cheapest local to spill goes.
+    stack = []
+    remaining = set(graph.keys())
+    order = lambda reg: int(reg[1:])
+    while len(remaining):
+        degree = dict([(reg, len(graph[reg] & remaining)) for reg in remaining])
+        easy = [reg for reg in remaining if degree[reg] < len(colors[reg])]
+        if len(easy):
+            reg = min(easy, key=order)
+        else:
+            reg = max(sorted(remaining, key=order),
+                      key=lambda reg: degree[reg] / weight[reg])
+        stack.append(reg)
+        remaining.remove(reg)
+
+    assigned = {}
+    spilled = []
+    for reg in reversed(stack):
+        taken = set([assigned.get(n, n) for n in graph[reg]])
+        free = [r for r in colors[reg] if r not in taken]
+        if len(free) == 0:
+            spilled.append(reg)
+            continue
+        assigned[reg] = free[0]
+        for partner in partners.get(reg, []):
+            partner = assigned.get(partner, partner)
+            if partner in free:
+                assigned[reg] = partner
+                break
+
+    #spilled locals get a scratchpad byte each from the top down, shared
+    #with functions that can't be running at the same time
+    edges = dict([(name, set()) for name in map_entry])
+    for idx in range(len(view)):
+        line = view[idx]
+        if line.op in ['call', 'jump'] and owner[idx] in edges and \
+                line.args[-1] in map_entry:
+            edges[owner[idx]].add(line.args[-1])
+    overlap = _lifetime_overlap(edges, handlers)
+    slots = {}
+    for reg in sorted(spilled, key=order):
+        (function, name, byte, size) = local_registers[reg]
+        slots[reg] = _scratchpad_place('%s:%s' % (local_owner[reg], _local_text(reg)),
+                                       1, local_owner[reg], overlap, 'spill', True)
+        if weight[reg] == float('inf'):
+            msg = 'no register left for local %s in timed code in %s' % \
+                    (name, function)
+            raise ParseException(msg)
+
+    phys = lambda regs: set([assigned.get(r, r) for r in regs])
+    result = []
+    for idx in range(len(lines)):
+        line = lines[idx]
+        if line.op is None:
+            result.append(line)
+            continue
+        regs = _asm_virtuals(line.instruction())
+        reload = {}
+        before = []
+        after = []
+        uses, defs = effects[idx]
+        if len(regs & set(slots.keys())):
+            busy = phys(uses | defs | regs | live_out[idx])
+            if owner[idx] not in reachable:
+                busy |= isr_clobbers
+            free = [r for r in ASM_REGISTERS if r not in busy and
+                    r not in scratch_registers]
+            for reg in sorted(regs & set(slots.keys()), key=order):
+                if len(free) == 0:
+                    (function, name, byte, size) = local_registers[reg]
+                    msg = 'no register free to reload local %s in %s: "%s"' % \
+                            (name, owner[idx], line.instruction())
+                    raise ParseException(msg)
+                reload[reg] = free.pop(0)
+                text = _local_text(reg)
+                if reg in uses:
+                    before.append(AsmLine('%sfetch %s, %d ;%s' % \
+                            (line.indent, reload[reg], slots[reg], text)))
+                if reg in defs:
+                    after.append(AsmLine('%sstore %s, %d ;%s' % \
+                            (line.indent, reload[reg], slots[reg], text)))
+        _asm_rename_virtuals(line,
+                             lambda reg: reload.get(reg, assigned.get(reg, reg)),
+                             _local_text)
+        if not line.fixed and line.op in ASM_LOAD_OPS and \
+                line.args[0] == line.args[1] and len(regs):
+            line.remove('same register')
+        result += before + [line] + after
+
+    for idx in range(len(result)):
+        if result[idx].op is None:
+            _asm_rename_virtuals(result[idx], None, _local_text)
+
+    #one line per local, MSB first like everywhere else
+    report = []
+    for reg in sorted(graph.keys(), key=order):
+        (function, name, byte, size) = local_registers[reg]
+        where = assigned.get(reg, '(0x%02X)' % slots.get(reg, 0))
+        for (key, places) in report:
+            if key == (local_owner[reg], name) and byte not in places:
+                places[byte] = where
+                break
+        else:
+            report.append(((local_owner[reg], name), {byte: where}))
+    for ((function, name), places) in report:
+        print('local %s:%s in %s' % (function, name,
+                '.'.join([places[b] for b in sorted(places, reverse=True)])))
+
+    return result
+
+def _asm_register_effects(line):
+    #(registers line reads, registers it writes); a call or return only
+    #passes registers along, the code at the other end is what reads them
+    if line.op in [None, 'address', 'enable', 'disable']:
+        return (set(), set())
+    copy = AsmLine(str(line))
+    copy.fixed = False
+    uses, defs = _asm_effects(copy)
+    if line.op in ['call', 'return', 'returni', 'load&return'] and \
+            not line.fixed:
+        uses = set()
+    return (uses & set(ASM_REGISTERS), defs & set(ASM_REGISTERS))
+
+def _asm_mainline_functions(lines):
+    #every function the mainline can run: the ones interrupts can't,
+    #and whatever they call. None stands for code outside functions.
+    (map_entry, owner, callers, unknown) = _asm_functions(lines)
+    (handlers, reachable) = _asm_interrupt_functions(lines)
+    #(the vector's jump to a handler lands in whichever function came
+    #last, nothing in the mainline really goes there)
+    edges = dict([(name, set()) for name in map_entry])
+    for idx in range(len(lines)):
+        line = lines[idx]
+        if line.op in ['call', 'jump'] and owner[idx] in edges and \
+                line.args[-1] in map_entry and line.args[-1] not in handlers:
+            edges[owner[idx]].add(line.args[-1])
+    todo = [name for name in map_entry if name not in reachable]
+    seen = set(todo)
+    while len(todo):
+        for callee in edges[todo.pop()]:
+            if callee not in seen:
+                seen.add(callee)
+                todo.append(callee)
+    seen.add(None)
+    return seen
+
+def warn_interrupt_context(lines):
+    #an interrupt write, without shared(), is kept from the mainline:
+    #if the mainline reads that register before it ever writes it, the
+    #code probably meant to pass something along
+    (map_entry, owner, callers, unknown) = _asm_functions(lines)
+    (handlers, reachable) = _asm_interrupt_functions(lines)
+    (shared, private) = _asm_interrupt_context(lines)
+    if len(private) == 0:
+        return
+    seen = _asm_mainline_functions(lines)
+    #(enabling interrupts reads nothing, and a mainline function's
+    #caller out of sight doesn't count)
+    view = [AsmLine('') if line.op in ['enable', 'disable'] else line
+            for line in lines]
+    live_out = _asm_liveness(view, [], set())
+    reads = set()
+    for name in unknown & seen - reachable:
+        reads |= live_out[map_entry[name]]
+    for reg in sorted(private & reads, key=lambda reg: int(reg[1:], 16)):
+        print('warning: interrupt code writes %s, which the mainline reads; ' \
+              'the mainline won\'t see it without shared(&%s)' % (reg, reg))
+
+def save_interrupt_context(lines):
+    #return lines with interrupt handlers keeping the mainline's
+    #registers: on kcpsm6 by running on register bank B (star copies the
+    #shared ones across), else by store/fetch around the handler.
+    #Whichever takes fewer words; only registers the mainline uses are
+    #saved to scratchpad.
+    (map_entry, owner, callers, unknown) = _asm_functions(lines)
+    (handlers, reachable) = _asm_interrupt_functions(lines)
+    (shared, private) = _asm_interrupt_context(lines)
+    if len(handlers) == 0 or not isr_save:
+        return lines
+
+    #what the interrupt code reads from the mainline and writes, and
+    #what the mainline (and functions it shares with the interrupt)
+    #touches
+    live_out = _asm_liveness(lines, [])
+    isr_uses = set()
+    for name in handlers:
+        isr_uses |= live_out[map_entry[name]] & set(ASM_REGISTERS)
+    seen = _asm_mainline_functions(lines)
+    isr_defs = set()
+    mainline = set()
+    for idx in range(len(lines)):
+        (uses, defs) = _asm_register_effects(lines[idx])
+        if owner[idx] in reachable:
+            isr_defs |= defs
+        if owner[idx] in seen:
+            mainline |= uses | defs
+
+    order = lambda reg: int(reg[1:], 16)
+    save = sorted(private & mainline, key=order)
+    copy_in = sorted((isr_uses - private) & set(ASM_REGISTERS), key=order)
+    copy_out = sorted(isr_defs & shared, key=order)
+    returns = [idx for idx in range(len(lines))
+               if lines[idx].op == 'returni' and owner[idx] in reachable]
+    save_words = len(save) * (1 + len(returns))
+    bank_words = len(handlers) * (1 + len(copy_in)) + \
+            len(returns) * len(copy_out)
+    banked = target == 'kcpsm6' and bank_words <= save_words and \
+            not any([line.op in ['regbank', 'star'] for line in lines])
+    if not banked and len(save) == 0:
+        return lines
+
+    entry = {}
+    leave = {}
+    if banked:
+        #returni gives the mainline its bank back
+        for name in handlers:
+            entry[map_entry[name]] = \
+                    ['  star %s, %s ;shared' % (reg, reg) for reg in copy_in] + \
+                    ['  regbank B ;interrupt context']
+        for idx in returns:
+            leave[idx] = ['  star %s, %s ;shared' % (reg, reg) for reg in copy_out]
+        for name in sorted(handlers):
+            print('interrupt %s: register bank B' % name)
+    else:
+        function = None
+        if len(handlers) == 1:
+            function = list(handlers)[0]
+        always = lambda a, b: True
+        base = _scratchpad_place('isr save', len(save), function, always,
+                                 'isr save', True)
+        for name in handlers:
+            entry[map_entry[name]] = ['  store %s, %d ;interrupt context' % \
+                    (save[i], base + i) for i in range(len(save))]
+        for idx in returns:
+            leave[idx] = ['  fetch %s, %d ;interrupt context' % \
+                    (save[i], base + i) for i in range(len(save))]
+        for name in sorted(handlers):
+            print('interrupt %s: saves %s in scratchpad 0x%02X-0x%02X' % \
+                    (name, ', '.join(save), base, base + len(save) - 1))
+
+    result = []
+    for idx in range(len(lines)):
+        result += [AsmLine(text) for text in leave.get(idx, [])]
+        result.append(lines[idx])
+        result += [AsmLine(text) for text in entry.get(idx, [])]
+    return result
+
+def optimize_assembly(text):
+    #return (text, report of removed instructions)
+    lines = [AsmLine(l) for l in text.split('\n')]
+    lines = allocate_registers(lines)
+    warn_interrupt_context(lines)
+    while opt_level != '0':
+        removed = optimize_jumps(lines)
+        removed += optimize_flags(lines)
+        removed += optimize_constants(lines)
+        removed += optimize_output(lines)
+        removed += optimize_dead_stores(lines)
+        if removed == 0:
+            break
+    if opt_level != '0':
+        lines = fold_functions(lines)
+        lines = outline_functions(lines)
+        lines = cross_jump(lines)
+    lines = save_interrupt_context(lines)
+    lines = balance_functions(lines)
+
+    (map_entry, owner, callers, unknown) = _asm_functions(lines)
+    report = []
+    for idx in range(len(lines)):
+        if lines[idx].removed:
+            (instruction, reason) = lines[idx].removed
+            report.append('%-20s %-24s %s' % (owner[idx], instruction, reason))
+    if len(report):
+        print('optimizer removed %d instruction(s)' % len(report))
+
+    return ('\n'.join([str(line) for line in lines]), report)
+
 usage = '''\
 usage : %s [option] file
 
  -l         add Vivado JTAG loader workaround
+ -3         kcpsm3 target (default)
+ -6         kcpsm6 target
  -h         help
  -I         include path
  -o <file>  output file name
  -g         dump mid-information
+ -O0 -O1 -O2 -Os
+            no optimization, default, speed, size
+ --scratch=sX,sY,...
+            registers the compiler may clobber (default sF)
+ --muldiv=looped|unrolled
+            multiply/divide routines small or fast (default looped)
+ --scratchpad=64|128|256
+            scratchpad bytes, kcpsm6 only has a choice (default 64)
+ --no-isr-save
+            interrupt handlers don't keep the mainline's registers
 ''' % os.path.split(sys.argv[0])[1]
 
 def parse_commandline():
-    format_s = 'I:o:ghlv'
-    format_l = []
+    format_s = 'I:o:O:ghlv36'
+    format_l = ['scratch=', 'muldiv=', 'scratchpad=', 'no-isr-save']
     opts, args = getopt.getopt(sys.argv[1:], format_s, format_l)
 
     map_options = {}
@@ -2069,6 +5791,46 @@ if __name__ == '__main__':
 
         if '-v' in map_options:
             super_verbose = True
+
+        if '--scratch' in map_options:
+            scratch_registers = [r.strip() for r in map_options['--scratch'].split(',')]
+            for reg in scratch_registers:
+                if not re.match(r'^s[0-9A-F]$', reg):
+                    raise ParseException('--scratch needs registers, not "%s"' % reg)
+            print('scratch registers: %s' % ', '.join(scratch_registers))
+
+        if '-O' in map_options:
+            opt_level = map_options['-O']
+            if opt_level not in OPT_WORD_CLOCKS:
+                raise ParseException('unknown optimization level -O%s' % opt_level)
+            print('optimization level -O%s' % opt_level)
+
+        if '--muldiv' in map_options:
+            if map_options['--muldiv'] not in ['looped', 'unrolled']:
+                raise ParseException('--muldiv is looped or unrolled, not "%s"' % \
+                                     map_options['--muldiv'])
+            muldiv_unrolled = map_options['--muldiv'] == 'unrolled'
+
+        if '--no-isr-save' in map_options:
+            isr_save = False
+
+        if '-6' in map_options:
+            target = 'kcpsm6'
+            print('kcpsm6 mode')
+        elif '-3' in map_options:
+            target = 'kcpsm3'
+            print('kcpsm3 mode')
+        else:
+            print('default kcpsm3 mode')
+
+        if '--scratchpad' in map_options:
+            sizes = {'kcpsm3': ['64'], 'kcpsm6': ['64', '128', '256']}[target]
+            if map_options['--scratchpad'] not in sizes:
+                raise ParseException('%s scratchpad is %s bytes, not "%s"' % \
+                                     (target, ' or '.join(sizes),
+                                      map_options['--scratchpad']))
+            scratchpad_size = int(map_options['--scratchpad'])
+            print('scratchpad: %d bytes' % scratchpad_size)
             
         if '-o' not in map_options:
             fn_name = os.path.split(lst_args[0])[1]
@@ -2148,6 +5910,7 @@ if __name__ == '__main__':
         convert_condition_to_ifgoto2(map_function)
         # NOTE NOTE NOTE
         condition_optimizer(map_function)
+        inline_functions(map_function, map_attribute)
         # This is probably the point at which we can do the
         # optimization.
         if '-g' in map_options:
@@ -2167,10 +5930,20 @@ if __name__ == '__main__':
 
         #dump assembly result
         print('using BASEADDR_INTC_CLEAR = 0x%02x' % BASEADDR_INTC_CLEAR)
-        generate_assembly(map_function, map_attribute, f)
+        s = StringIO()
+        generate_assembly(map_function, map_attribute, s)
+        (text, report) = optimize_assembly(s.getvalue())
+        f.write(text)
+        if '-g' in map_options:
+            fn = '%s.opt.tmp' % map_options['path_noext']
+            file_put_contents(fn, '\n'.join(report) + '\n')
         print('wrote %d bytes to "%s"' % (f.tell(), map_options['-o']))
         f.close()
 
+        fn = '%s.map' % map_options['path_noext']
+        file_put_contents(fn, scratchpad_map())
+        print('wrote scratchpad map to "%s"' % fn)
+
 
     except ParseException as e:
         traceback.print_exc()
@@ -30,6 +30,20 @@ from mako.template import Template
 
 dualport = False
 
+#words of rom -> (BRAM_TDP_MACRO size, words in each, how many of them),
+#18 bits wide on the core's side
+BRAM_LAYOUT = {
+    1024: ('18Kb', 1024, 1),
+    2048: ('36Kb', 2048, 1),
+    4096: ('36Kb', 2048, 2),
+}
+
+#'load s0, 0', what pblaze-as pads the rom with
+PADDING = {'kcpsm3': 0x00000, 'kcpsm6': 0x01000}
+
+#return addresses the hardware call stack holds
+STACK_DEPTH = {'kcpsm3': 31, 'kcpsm6': 30}
+
 # sigh, this is big
 tpl_oneport = '''\
 `timescale 1 ps / 1ps
@@ -48,15 +62,15 @@ tpl_oneport = '''\
 module ${project} (address, instruction, enable, clk, rdl);
 parameter USE_JTAG_LOADER = "FALSE";
 localparam BRAM_PORT_WIDTH = 18;
-localparam BRAM_ADR_WIDTH = (BRAM_PORT_WIDTH == 18) ? 10 : 11;
+localparam BRAM_ADR_WIDTH = (BRAM_PORT_WIDTH == 18) ? ${bram_adr_width} : ${bram_adr_width + 1};
 localparam BRAM_WE_WIDTH = (BRAM_PORT_WIDTH == 18) ? 2 : 1;
-input [9:0] address;
+input [${adr_width - 1}:0] address;
 input clk;
 input enable;
 output [17:0] instruction;
 output rdl; // download reset
 
-wire [BRAM_ADR_WIDTH-1:0] jtag_addr;
+wire [${adr_width - 1}:0] jtag_addr;
 wire jtag_we;
 wire jtag_clk;
 wire [17:0] jtag_din;
@@ -81,10 +95,10 @@ generate
      jtag_loader_6 #(.C_JTAG_LOADER_ENABLE(1),
                      .C_FAMILY("7S"),
                      .C_NUM_PICOBLAZE(1),
-                     .C_BRAM_MAX_ADDR_WIDTH(10),
+                     .C_BRAM_MAX_ADDR_WIDTH(${adr_width}),
                      .C_PICOBLAZE_INSTRUCTION_DATA_WIDTH(18),
                      .C_JTAG_CHAIN(2),
-                     .C_ADDR_WIDTH_0(10))
+                     .C_ADDR_WIDTH_0(${adr_width}))
                    u_loader( .picoblaze_reset(rdl),
                              .jtag_en(jtag_en),
                              .jtag_din(jtag_din),
@@ -104,7 +118,7 @@ generate
      assign jtag_we = 0;
      assign jtag_clk = 0;
      assign jtag_din = {18{1'b0}};
-     assign jtag_addr = {BRAM_ADR_WIDTH{1'b0}};
+     assign jtag_addr = {${adr_width}{1'b0}};
   end
 endgenerate
 
@@ -123,9 +137,24 @@ endgenerate
    end
 // synthesis translate_on
 
+%if len(brams) > 1:
+// ${len(brams)} BRAMs of ${bram_words} words, the top of the address picks
+// one and a clock later, when its data comes out, which one it was
+reg [${bank_width - 1}:0] bank_a = 0;
+reg [${bank_width - 1}:0] bank_b = 0;
+%for bram in brams:
+wire [17:0] ${bram['doa']};
+wire [17:0] ${bram['dob']};
+%endfor
+always @(posedge clk) if (enable) bank_a <= address[${adr_width - 1}:${bram_adr_width}];
+always @(posedge jtag_clk) if (jtag_en) bank_b <= jtag_addr[${adr_width - 1}:${bram_adr_width}];
+assign instruction = ${mux_a};
+assign bram_macro_dout = ${mux_b};
+%endif
 
+%for bram in brams:
 BRAM_TDP_MACRO #(
-    .BRAM_SIZE("18Kb"),
+    .BRAM_SIZE("${bram_size}"),
     .DOA_REG(0),
     .DOB_REG(0),
     .INIT_A(18'h00000),
@@ -138,67 +167,45 @@ BRAM_TDP_MACRO #(
     .WRITE_MODE_A("WRITE_FIRST"),
     .WRITE_MODE_B("WRITE_FIRST"),
     // The following INIT_xx declarations specify the initial contents of the RAM
-    // Address 0 to 255
-%for (row, v) in group0_data:
+%for (first, last, rows) in bram['data']:
+    // Address ${first} to ${last}
+%for (row, v) in rows:
     .INIT_${row}(256'h${v}),
 %endfor
 
-    // Address 256 to 511
-%for (row, v) in group1_data:
-    .INIT_${row}(256'h${v}),
 %endfor
-
-    // Address 512 to 767
-%for (row, v) in group2_data:
-    .INIT_${row}(256'h${v}),
-%endfor
-
-    // Address 768 to 1023
-%for (row, v) in group3_data:
-    .INIT_${row}(256'h${v}),
-%endfor
-
     // The next set of INITP_xx are for the parity bits
-    // Address 0 to 255
-%for (row, v) in group0_parity:
-    .INITP_${row}(256'h${v}),
-%endfor
-
-    // Address 256 to 511
-%for (row, v) in group1_parity:
+%for (first, last, rows) in bram['parity']:
+    // Address ${first} to ${last}
+%for (row, v) in rows:
     .INITP_${row}(256'h${v}),
 %endfor
 
-    // Address 512 to 767
-%for (row, v) in group2_parity:
-    .INITP_${row}(256'h${v}),
 %endfor
-
-    // Address 768 to 1023
-%for (row, v) in group3_parity:
-    .INITP_${row}(256'h${v}),
-%endfor
-
     // Output value upon SSR assertion
     .SRVAL_A(18'h000000),
     .SRVAL_B({BRAM_PORT_WIDTH{1'b0}})
-) ramdp_1024_x_18(
+) ${bram['name']}(
     .DIA (18'h00000),
     .ENA (enable),
     .WEA ({BRAM_WE_WIDTH{1'b0}}),
     .RSTA(1'b0),
     .CLKA (clk),
-    .ADDRA (address),
+    .ADDRA (${bram['addra']}),
     // swizzle the parity bits into their proper place
-    .DOA ({instruction[17],instruction[15:8],instruction[16],instruction[7:0]}),
+    .DOA ({${bram['doa']}[17],${bram['doa']}[15:8],${bram['doa']}[16],${bram['doa']}[7:0]}),
     .DIB (bram_macro_din),
-    .DOB (bram_macro_dout),
-    .ENB (jtag_en),
+    .DOB (${bram['dob']}),
+    .ENB (${bram['enb']}),
     .WEB ({BRAM_WE_WIDTH{jtag_we}}),
     .RSTB(1'b0),
     .CLKB (jtag_clk),
-    .ADDRB(jtag_addr)
+    .ADDRB(${bram['addrb']})
 );
+%if not loop.last:
+
+%endif
+%endfor
 
 endmodule
 '''
@@ -220,13 +227,13 @@ tpl_dualport = '''\
 
 module ${project} (address, instruction, enable, clk, bram_adr_i, bram_dat_o, bram_dat_i, bram_en_i, bram_we_i, bram_rd_i);
 parameter BRAM_PORT_WIDTH = 9;
-localparam BRAM_ADR_WIDTH = (BRAM_PORT_WIDTH == 18) ? 10 : 11;
+localparam BRAM_ADR_WIDTH = (BRAM_PORT_WIDTH == 18) ? ${bram_adr_width} : ${bram_adr_width + 1};
 localparam BRAM_WE_WIDTH = (BRAM_PORT_WIDTH == 18) ? 2 : 1;
-input [9:0] address;
+input [${adr_width - 1}:0] address;
 input clk;
 input enable;
 output [17:0] instruction;
-input [BRAM_ADR_WIDTH-1:0] bram_adr_i;
+input [${bram_adr_i_msb}:0] bram_adr_i;
 output [BRAM_PORT_WIDTH-1:0] bram_dat_o;
 input [BRAM_PORT_WIDTH-1:0] bram_dat_i;
 input bram_we_i;
@@ -248,9 +255,24 @@ input bram_rd_i;
    end
 // synthesis translate_on
 
+%if len(brams) > 1:
+// ${len(brams)} BRAMs of ${bram_words} words, the top of the address picks
+// one and a clock later, when its data comes out, which one it was
+reg [${bank_width - 1}:0] bank_a = 0;
+reg [${bank_width - 1}:0] bank_b = 0;
+%for bram in brams:
+wire [17:0] ${bram['doa']};
+wire [BRAM_PORT_WIDTH-1:0] ${bram['dob']};
+%endfor
+always @(posedge clk) if (enable) bank_a <= address[${adr_width - 1}:${bram_adr_width}];
+always @(posedge clk) if (bram_en_i) bank_b <= bram_adr_i[BRAM_ADR_WIDTH +: ${bank_width}];
+assign instruction = ${mux_a};
+assign bram_dat_o = ${mux_b};
+%endif
 
+%for bram in brams:
 BRAM_TDP_MACRO #(
-    .BRAM_SIZE("18Kb"),
+    .BRAM_SIZE("${bram_size}"),
     .DOA_REG(0),
     .DOB_REG(0),
     .INIT_A(18'h00000),
@@ -263,68 +285,46 @@ BRAM_TDP_MACRO #(
     .WRITE_MODE_A("WRITE_FIRST"),
     .WRITE_MODE_B("WRITE_FIRST"),
     // The following INIT_xx declarations specify the initial contents of the RAM
-    // Address 0 to 255
-%for (row, v) in group0_data:
-    .INIT_${row}(256'h${v}),
-%endfor
-
-    // Address 256 to 511
-%for (row, v) in group1_data:
-    .INIT_${row}(256'h${v}),
-%endfor
-
-    // Address 512 to 767
-%for (row, v) in group2_data:
+%for (first, last, rows) in bram['data']:
+    // Address ${first} to ${last}
+%for (row, v) in rows:
     .INIT_${row}(256'h${v}),
 %endfor
 
-    // Address 768 to 1023
-%for (row, v) in group3_data:
-    .INIT_${row}(256'h${v}),
 %endfor
-
     // The next set of INITP_xx are for the parity bits
-    // Address 0 to 255
-%for (row, v) in group0_parity:
-    .INITP_${row}(256'h${v}),
-%endfor
-
-    // Address 256 to 511
-%for (row, v) in group1_parity:
+%for (first, last, rows) in bram['parity']:
+    // Address ${first} to ${last}
+%for (row, v) in rows:
     .INITP_${row}(256'h${v}),
 %endfor
 
-    // Address 512 to 767
-%for (row, v) in group2_parity:
-    .INITP_${row}(256'h${v}),
-%endfor
-
-    // Address 768 to 1023
-%for (row, v) in group3_parity:
-    .INITP_${row}(256'h${v}),
 %endfor
-
     // Output value upon SSR assertion
     .SRVAL_A(18'h000000),
     .SRVAL_B({BRAM_PORT_WIDTH{1'b0}})
-) ramdp_1024_x_18(
+) ${bram['name']}(
     .DIA (18'h00000),
     .ENA (enable),
     .WEA ({BRAM_WE_WIDTH{1'b0}}),
     .RSTA(1'b0),
     .CLKA (clk),
-    .ADDRA (address),
+    .ADDRA (${bram['addra']}),
     // swizzle the parity bits into their proper place
-    .DOA ({instruction[17],instruction[15:8],instruction[16],instruction[7:0]}),
+    .DOA ({${bram['doa']}[17],${bram['doa']}[15:8],${bram['doa']}[16],${bram['doa']}[7:0]}),
     .DIB (bram_dat_i),
     // it's your OWN damn job to deswizzle outside this module
-    .DOB (bram_dat_o),
-    .ENB (bram_en_i),
+    .DOB (${bram['dob']}),
+    .ENB (${bram['enb']}),
     .WEB ({BRAM_WE_WIDTH{bram_we_i}}),
     .RSTB(1'b0),
     .CLKB (clk),
-    .ADDRB(bram_adr_i)
+    .ADDRB(${bram['addrb']})
 );
+%if not loop.last:
+
+%endif
+%endfor
 
 endmodule
 '''
@@ -342,11 +342,16 @@ def file_put_contents(filename, s):
     fout.close()
 
 usage = '''\
-usage: %s [option] [file]
+usage: %s [option] [file...]
 
   -h                print this help
   -o <file>         Place output into <file>, '-' is stdout.
   --dualport        Use a dualport RAM to share RAM usage (no JTAG loader option)
+  --archive         Put the objects into a library archive (<file>.lib)
+
+  One object from pblaze-as, or any number of relocatable ones
+  (pblaze-as -c) to link together. From an archive only the members
+  with a label the link is missing go in.
 ''' % os.path.split(sys.argv[0])[1]
 
 class PBLDException(BaseException):
@@ -355,7 +360,7 @@ class PBLDException(BaseException):
 
 def parse_commandline():
     s_config = 'ho:'
-    l_config = ['help','dualport']
+    l_config = ['help','dualport','archive']
 
     try:
         opts, args = getopt.getopt(sys.argv[1:], s_config, l_config)
@@ -371,17 +376,17 @@ def parse_commandline():
         if '-o' not in map_config:
             name_without_path = os.path.split(args[0])[1]
             name_without_ext = os.path.splitext(name_without_path)[0]
-            map_config['-o'] = name_without_ext + '.v'
+            if '--archive' in map_config:
+                map_config['-o'] = name_without_ext + '.lib'
+            else:
+                map_config['-o'] = name_without_ext + '.v'
         else:
             name_without_path = os.path.split(map_config['-o'])[1]
             name_without_ext = os.path.splitext(name_without_path)[0]
 
         map_config['--project'] = name_without_ext
 
-        if len(args) != 1:
-            raise PBLDException('Just support one object file!')
-
-        map_config['-i'] = args[0]
+        map_config['-i'] = args
 
     except PBLDException as e:
         print(e.msg)
@@ -391,13 +396,370 @@ def parse_commandline():
 
     return map_config
 
-def load_object(map_config):
-    #load object
-    s = file_get_contents(map_config['-i'])
-    map_object = json.loads(s)
+def arrange_sections(lst_sections, lst_owner, size):
+    #addresses of the sections, placed the way pblaze-as does in one
+    #source: the first one at reset (unless something has address 0) and
+    #the ones with an address directive at it, each with the section that
+    #falls into it from its object right in front. The sections nothing
+    #falls into or out of are packed into the gaps, biggest first, each
+    #into the gap it leaves least of, and past the last fixed one only
+    #when nothing else fits. The gap after a fixed one that runs off its
+    #end stays padding.
+    #What falls off the end of an object goes at the end.
+    n = len(lst_sections)
+    section_len = lambda i: len(lst_sections[i]['codes'])
+    falls_into = lambda i: i + 1 < n and lst_owner[i + 1] == lst_owner[i] and \
+            lst_sections[i + 1]['address'] is not None
+
+    reset = 0
+    if 0 in [section['address'] for section in lst_sections]:
+        reset = None
+
+    lst_fixed = []
+    lst_movable = []
+    lst_trailing = []
+    for i in range(n):
+        section = lst_sections[i]
+        if section['address'] is not None or i == reset:
+            start = section['address'] or 0
+            lst_placed = [i]
+            if i > 0 and i - 1 != reset and lst_sections[i - 1]['address'] is None and \
+                    lst_sections[i - 1]['falls'] and falls_into(i - 1):
+                start -= section_len(i - 1)
+                lst_placed = [i - 1, i]
+            lst_fixed.append((start, lst_placed))
+        elif not section['falls']:
+            lst_movable.append(i)
+        elif not falls_into(i):
+            lst_trailing.append(i)
+
+    lst_address = [None] * n
+    lst_gaps = []
+    address = 0
+    closed = False
+    for (start, lst_placed) in sorted(lst_fixed):
+        if start < address:
+            msg = 'sections overlap at 0x%03X' % start
+            raise PBLDException(msg)
+        if start > address and not closed:
+            lst_gaps.append([address, start, []])
+        address = start
+        for i in lst_placed:
+            lst_address[i] = address
+            address += section_len(i)
+        closed = lst_sections[lst_placed[-1]]['falls']
+    if address < size or len(lst_trailing):
+        lst_gaps.append([address, size, []])
+
+    for i in sorted(lst_movable, key=lambda i: -section_len(i)):
+        best = None
+        for gap in lst_gaps:
+            left = gap[1] - gap[0] - sum([section_len(j) for j in gap[2]])
+            if left < section_len(i) or gap[1] == size and (best is not None or closed):
+                continue
+            if best is None or left < best[0]:
+                best = (left, gap)
+        if best is None:
+            msg = 'no room in %d words of rom for %d more words' % (size, section_len(i))
+            raise PBLDException(msg)
+        best[1][2].append(i)
+
+    for (address, end, lst_placed) in lst_gaps:
+        if end == size:
+            lst_placed.extend(lst_trailing)
+        for i in sorted(lst_placed):
+            lst_address[i] = address
+            address += section_len(i)
+
+    return lst_address
+
+def _entry_region(map_entries, entry, stops=()):
+    #the entries the code from entry runs through, following its jumps
+    #but not into stops (code it leaves for, like a jump to boot)
+    region = set()
+    todo = [entry]
+    while len(todo):
+        address = todo.pop()
+        if address in region or address not in map_entries or \
+                address != entry and address in stops:
+            continue
+        region.add(address)
+        todo.extend(map_entries[address][1])
+    return region
+
+def _entry_depth(map_entries, entry, names, depths, outer, notes):
+    #(return addresses on the stack at most while entry runs, the
+    #functions called on the way there), following its jumps into the
+    #other objects as the same function. A jump to a root or back into
+    #a caller's code (outer) leaves it, as in pblaze-as.
+    if entry in depths:
+        if depths[entry] is None:
+            msg = '%s calls itself, the stack has no bound' % names.get(entry, '0x%03X' % entry)
+            raise PBLDException(msg)
+        return depths[entry]
+    depths[entry] = None
+
+    name = lambda a: names.get(a, '0x%03X' % a)
+    region = _entry_region(map_entries, entry, outer)
+    for address in sorted(region):
+        for target in map_entries[address][1]:
+            note = '%s jumps to %s, out of its stack' % (name(entry), name(target))
+            if target not in region and target in outer and note not in notes:
+                notes.append(note)
+
+    deepest = (0, [])
+    for address in sorted(region):
+        for target in map_entries[address][0]:
+            if target is None:
+                #into a table of load&return
+                (depth, path) = (0, [])
+            else:
+                (depth, path) = _entry_depth(map_entries, target, names, depths,
+                                             outer | region, notes)
+            if depth + 1 > deepest[0]:
+                name = names.get(target, '0x%03X' % target) if target is not None else 'call@'
+                deepest = (depth + 1, [name] + path)
+    depths[entry] = deepest
+    return deepest
+
+def link_stack(lst_sections, lst_owner, lst_address, lst_local, map_labels):
+    #(deepest the call stack gets, the calls that get it there), the way
+    #pblaze-as works it out for one source: the deepest path from reset
+    #or a fixed section nothing jumps, calls or falls into, with the
+    #deepest interrupt (one of those that can end in returni) on top
+    n = len(lst_sections)
+    find = lambda i, l: l if type(l) == int else lst_local[lst_owner[i]].get(l, map_labels.get(l))
+
+    map_entries = {}
+    names = {}
+    referenced = set()
+    for i in range(n):
+        section = lst_sections[i]
+        #the compiler's own labels only when there's nothing else
+        for (l, offset) in sorted(section['labels'].items(), key=lambda x: \
+                (re.match(r'L_[a-z0-9]*_[0-9]*|JOIN_[0-9]*|_end_', x[0]) is not None, x[0])):
+            names.setdefault(lst_address[i] + offset, l)
+        for (offset, calls, jumps, returni) in section['stack']:
+            map_entries[lst_address[i] + offset] = \
+                    ([c if c is None else find(i, c) for c in calls],
+                     [find(i, j) for j in jumps], returni)
+        for (offset, kind, l) in section['relocs']:
+            if kind == 'address':
+                referenced.add(find(i, l))
+
+    roots = [0]
+    for i in range(n):
+        if lst_sections[i]['address'] is None or lst_address[i] == 0 or \
+                lst_address[i] in referenced:
+            continue
+        if i > 0 and lst_owner[i - 1] == lst_owner[i] and lst_sections[i - 1]['falls']:
+            continue
+        roots.append(lst_address[i])
+        #the vector is just a jump to the handler, go by its name
+        section = lst_sections[i]
+        if lst_address[i] not in names and len(section['codes']) == 1 and \
+                not section['falls'] and len(section['relocs']):
+            target = find(i, section['relocs'][0][2])
+            if target in names:
+                names[lst_address[i]] = names[target]
+
+    depths = {}
+    notes = []
+    mainline = (0, [])
+    interrupt = (0, [])
+    for entry in roots:
+        (depth, path) = _entry_depth(map_entries, entry, names, depths, set(roots), notes)
+        name = names.get(entry, '0x%03X' % entry)
+        region = _entry_region(map_entries, entry)
+        if entry != 0 and any([map_entries[a][2] for a in region]):
+            if depth + 1 > interrupt[0]:
+                interrupt = (depth + 1, ['interrupt %s' % name] + path)
+        elif depth > mainline[0] or len(mainline[1]) == 0:
+            mainline = (depth, [name] + path)
+
+    return (mainline[0] + interrupt[0], mainline[1] + interrupt[1], notes)
+
+def link_objects(lst_objects, lst_names):
+    #one rom from relocatable objects: place their sections, then fill in
+    #the labels, from the object itself first and then from the others
+    for key in ['core', 'rom']:
+        values = set([map_object[key] for map_object in lst_objects])
+        if len(values) > 1:
+            msg = 'objects for different %s: %s' % (key, ', '.join(sorted(map(str, values))))
+            raise PBLDException(msg)
+    core = lst_objects[0]['core']
+    size = lst_objects[0]['rom']
+
+    lst_sections = []
+    lst_owner = []
+    for k in range(len(lst_objects)):
+        for section in lst_objects[k]['sections']:
+            lst_sections.append(section)
+            lst_owner.append(k)
+    lst_address = arrange_sections(lst_sections, lst_owner, size)
+
+    lst_local = [{} for map_object in lst_objects]
+    map_labels = {}
+    set_twice = set()
+    for i in range(len(lst_sections)):
+        for (l, offset) in lst_sections[i]['labels'].items():
+            lst_local[lst_owner[i]][l] = lst_address[i] + offset
+            if l in map_labels:
+                set_twice.add(l)
+            else:
+                map_labels[l] = lst_address[i] + offset
+
+    end = max([lst_address[i] + len(lst_sections[i]['codes']) for i in range(len(lst_sections))])
+    lst_rom = [PADDING[core]] * end
+    for i in range(len(lst_sections)):
+        codes = list(lst_sections[i]['codes'])
+        for (offset, kind, l) in lst_sections[i]['relocs']:
+            if l in lst_local[lst_owner[i]]:
+                address = lst_local[lst_owner[i]][l]
+            elif l in set_twice:
+                msg = '%s: label "%s" is in more than one object!' % (lst_names[lst_owner[i]], l)
+                raise PBLDException(msg)
+            elif l in map_labels:
+                address = map_labels[l]
+            else:
+                msg = '%s: not found label "%s"!' % (lst_names[lst_owner[i]], l)
+                raise PBLDException(msg)
+
+            if kind == 'upper':
+                codes[offset] |= (address >> 8) & 0xF
+            elif kind == 'lower':
+                codes[offset] |= address & 0xFF
+            else:
+                codes[offset] |= address
+        lst_rom[lst_address[i]:lst_address[i] + len(codes)] = codes
+
+    nr_codes = sum([len(section['codes']) for section in lst_sections])
+    print('linked %d objects, codes %d of %d rom, padding %d words' % \
+        (len(lst_objects), nr_codes, size, end - nr_codes))
+
+    #overflowing the hardware stack doesn't stop the core, so stop here
+    if len([section for section in lst_sections if 'stack' not in section]):
+        print('stack not checked, objects from before pblaze-as -c recorded it')
+    else:
+        (depth, path, notes) = link_stack(lst_sections, lst_owner, lst_address,
+                                          lst_local, map_labels)
+        limit = STACK_DEPTH[core]
+        if depth > limit:
+            msg = 'call stack overflows, %d of %d: %s' % (depth, limit, ' > '.join(path))
+            raise PBLDException(msg)
+        print('stack %d of %d (%s)' % (depth, limit, ' > '.join(path)))
+        for note in notes:
+            print('stack: %s' % note)
+
+    map_object = {}
+    map_object['ctime']     = lst_objects[0]['ctime']
+    map_object['mtime']     = lst_objects[0]['mtime']
+    map_object['labels']    = map_labels
+    map_object['object']    = lst_rom
+    map_object['core']      = core
+    map_object['rom']       = size
+    map_object['pblaze-cc'] = []
+    for obj in lst_objects:
+        map_object['pblaze-cc'].extend(obj.get('pblaze-cc', []))
+    return map_object
 
-    #fill zero to fix 1024
-    n_padding = 1024 - len(map_object['object'])
+def _missing_labels(lst_objects):
+    #labels the objects use and none of them has
+    set_defined = set()
+    set_used = set()
+    for map_object in lst_objects:
+        for section in map_object['sections']:
+            set_defined.update(section['labels'])
+            set_used.update([l for (offset, kind, l) in section['relocs']])
+    return set_used - set_defined
+
+def extract_members(lst_objects, lst_names, lst_archives):
+    #add the first archive member with a label the objects are missing,
+    #and again with what that one is missing, until no archive has any
+    while True:
+        set_missing = _missing_labels(lst_objects)
+        member = None
+        for (fn, map_archive) in lst_archives:
+            for (name, map_object) in map_archive['members']:
+                if map_object in lst_objects:
+                    continue
+                set_labels = set()
+                for section in map_object['sections']:
+                    set_labels.update(section['labels'])
+                if set_missing & set_labels:
+                    member = ('%s(%s)' % (fn, name), map_object, set_missing & set_labels)
+                    break
+            if member:
+                break
+        if member is None:
+            return
+
+        (name, map_object, set_wanted) = member
+        print('%s for %s' % (name, ', '.join(sorted(set_wanted))))
+        lst_objects.append(map_object)
+        lst_names.append(name)
+
+def write_archive(map_config):
+    #the objects, and the members of archives, as members of one archive.
+    #A member with the same name as one before it replaces it.
+    lst_members = []
+    for fn in map_config['-i']:
+        obj = json.loads(file_get_contents(fn))
+        if 'members' in obj:
+            lst_new = obj['members']
+        elif 'sections' in obj:
+            lst_new = [[os.path.split(fn)[1], obj]]
+        else:
+            msg = '%s is not relocatable, assemble it with pblaze-as -c' % fn
+            raise PBLDException(msg)
+        for (name, map_object) in lst_new:
+            lst_members = [m for m in lst_members if m[0] != name]
+            lst_members.append([name, map_object])
+
+    text_json = json.dumps({'members': lst_members}, sort_keys=True, indent=4)
+    file_put_contents(map_config['-o'], text_json)
+    print('wrote %d members, %d bytes to "%s"' % \
+        (len(lst_members), len(text_json), map_config['-o']))
+
+def load_object(map_config):
+    #load objects, relocatable ones are linked into one, with the members
+    #of the archives they need
+    lst_objects = []
+    lst_names = []
+    lst_archives = []
+    for fn in map_config['-i']:
+        obj = json.loads(file_get_contents(fn))
+        if 'members' in obj:
+            lst_archives.append((fn, obj))
+        else:
+            lst_objects.append(obj)
+            lst_names.append(fn)
+
+    if len(lst_objects) == 0:
+        raise PBLDException('nothing to link, only archives')
+    if len(lst_objects) == 1 and len(lst_archives) == 0 and \
+            'sections' not in lst_objects[0]:
+        map_object = lst_objects[0]
+    else:
+        for (fn, obj) in zip(lst_names, lst_objects):
+            if 'sections' not in obj:
+                msg = '%s is not relocatable, assemble it with pblaze-as -c' % fn
+                raise PBLDException(msg)
+        extract_members(lst_objects, lst_names, lst_archives)
+        map_object = link_objects(lst_objects, lst_names)
+
+    #objects from before the rom size was in them are all 1024
+    map_object.setdefault('rom', 1024)
+    if map_object['rom'] not in BRAM_LAYOUT:
+        msg = 'no BRAM layout for a rom of %d words' % map_object['rom']
+        raise PBLDException(msg)
+    if len(map_object['object']) > map_object['rom']:
+        msg = '%d codes don\'t fit a rom of %d words' % \
+                (len(map_object['object']), map_object['rom'])
+        raise PBLDException(msg)
+
+    #fill zero to fix rom size
+    n_padding = map_object['rom'] - len(map_object['object'])
     if n_padding > 0:
         print('append %d zero to rom' % n_padding)
         for i in range(n_padding):
@@ -405,20 +767,20 @@ def load_object(map_config):
 
     return map_object
 
-def convert_to_blockram(map_object):
+def convert_to_blockram(lst_object):
     #split to data and parity
     row_data    = 0
     row_parity  = 0
     lst_data    = []
     lst_parity  = []
 
-    n = len(map_object['object'])
+    n = len(lst_object)
     lst_d_cols = []
     lst_p_cols = []
     for i in range(n):
         #bit17_16 save to p
         #bit15_00 save to d
-        v = map_object['object'][i]
+        v = lst_object[i]
         p = (v & 0x30000) >> 16
         d = v & 0xFFFF
         lst_d_cols.append(d)
@@ -454,20 +816,62 @@ def convert_to_blockram(map_object):
 
     return (lst_data, lst_parity)
 
-def render(map_config, map_object, lst_data, lst_parity,debug_data):
-    n = len(lst_data)
-    step = int(n / 4)
-    group0_data = lst_data[0*step:1*step]
-    group1_data = lst_data[1*step:2*step]
-    group2_data = lst_data[2*step:3*step]
-    group3_data = lst_data[3*step:4*step]
-
-    n = len(lst_parity)
-    step = int(n / 4)
-    group0_parity = lst_parity[0*step:1*step]
-    group1_parity = lst_parity[1*step:2*step]
-    group2_parity = lst_parity[2*step:3*step]
-    group3_parity = lst_parity[3*step:4*step]
+def _group_rows(lst_rows, words, address):
+    #rows of 256 words, under the address they start at
+    groups = []
+    step = int(256 / words)
+    for i in range(0, len(lst_rows), step):
+        first = address + i * words
+        groups.append((first, first + 255, lst_rows[i:i + step]))
+    return groups
+
+def render(map_config, map_object, debug_data):
+    (bram_size, bram_words, n_brams) = BRAM_LAYOUT[map_object['rom']]
+    bram_adr_width = bram_words.bit_length() - 1
+    adr_width = map_object['rom'].bit_length() - 1
+    bank_width = n_brams.bit_length() - 1
+    bram_adr_i_msb = 'BRAM_ADR_WIDTH%+d' % (bank_width - 1)
+    bram_adr_i_msb = bram_adr_i_msb.replace('+0', '')
+
+    if '--dualport' not in map_config:
+        (adrb, enb) = ('jtag_addr', 'jtag_en')
+        dob = 'bram_macro_dout'
+    else:
+        (adrb, enb) = ('bram_adr_i', 'bram_en_i')
+        dob = 'bram_dat_o'
+
+    brams = []
+    for i in range(n_brams):
+        bram = {}
+        first = i * bram_words
+        lst_object = map_object['object'][first:first + bram_words]
+        (lst_data, lst_parity) = convert_to_blockram(lst_object)
+        #16 words in each INIT_xx, 128 in each INITP_xx
+        bram['data'] = _group_rows(lst_data, 16, first)
+        bram['parity'] = _group_rows(lst_parity, 128, first)
+        if n_brams == 1:
+            bram['name'] = 'ramdp_%d_x_18' % bram_words
+            bram['addra'] = 'address'
+            bram['doa'] = 'instruction'
+            bram['dob'] = dob
+            bram['enb'] = enb
+            bram['addrb'] = adrb
+        else:
+            bram['name'] = 'ramdp_%d_x_18_%d' % (bram_words, i)
+            bram['addra'] = 'address[%d:0]' % (bram_adr_width - 1)
+            bram['doa'] = 'instruction_%d' % i
+            bram['dob'] = '%s_%d' % (dob, i)
+            bram['enb'] = "%s && %s[BRAM_ADR_WIDTH +: %d] == %d" % \
+                    (enb, adrb, bank_width, i)
+            bram['addrb'] = '%s[BRAM_ADR_WIDTH-1:0]' % adrb
+        brams.append(bram)
+
+    #pick the BRAM the data came out of
+    mux_a = brams[0]['doa']
+    mux_b = brams[0]['dob']
+    for i in range(1, n_brams):
+        mux_a = "(bank_a == %d) ? %s : %s" % (i, brams[i]['doa'], mux_a)
+        mux_b = "(bank_b == %d) ? %s : %s" % (i, brams[i]['dob'], mux_b)
 
     tmpl = None
     if '--dualport' not in map_config:
@@ -480,19 +884,33 @@ def render(map_config, map_object, lst_data, lst_parity,debug_data):
             ctime=map_object['ctime'],
             mtime=map_object['mtime'],
             debug_data=debug_data,
-            group0_data=group0_data,
-            group1_data=group1_data,
-            group2_data=group2_data,
-            group3_data=group3_data,
-            group0_parity=group0_parity,
-            group1_parity=group1_parity,
-            group2_parity=group2_parity,
-            group3_parity=group3_parity)
+            adr_width=adr_width,
+            bram_adr_width=bram_adr_width,
+            bram_size=bram_size,
+            bram_words=bram_words,
+            bank_width=bank_width,
+            bram_adr_i_msb=bram_adr_i_msb,
+            brams=brams,
+            mux_a=mux_a,
+            mux_b=mux_b)
     return text
 
 if __name__ == '__main__':
     map_config = parse_commandline()
-    map_object = load_object(map_config)
+    if '--archive' in map_config:
+        try:
+            write_archive(map_config)
+        except PBLDException as e:
+            print(e.msg)
+            sys.exit(-1)
+        print()
+        sys.exit(0)
+
+    try:
+        map_object = load_object(map_config)
+    except PBLDException as e:
+        print(e.msg)
+        sys.exit(-1)
     
     # let's try to construct debugging info!
     labels = map_object['labels']
@@ -504,7 +922,7 @@ if __name__ == '__main__':
     i=0
     current_function = None
     debug_data = []
-    while i < 1024:
+    while i < map_object['rom']:
         label = ""
         # are we out of labels?
         if nextline == None:
@@ -547,8 +965,7 @@ if __name__ == '__main__':
         debug_data.append((i, label))
         i = i + 1
                         
-    (lst_data, lst_parity) = convert_to_blockram(map_object)
-    text = render(map_config, map_object, lst_data, lst_parity, debug_data)
+    text = render(map_config, map_object, debug_data)
 
     #insert pblaze-cc information
     lst_text = []